@@ -3,8 +3,9 @@ import os,sys,shutil,subprocess
 from typing import AsyncIterable
 os.environ["ANONYMIZED_TELEMETRY"] = "false"
 import asyncio
+import aiohttp
 from quart import Quart, request, jsonify, send_from_directory, Response
-from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import parse_options_header
 import traceback
 from dotenv import load_dotenv
 import signal
@@ -12,16 +13,30 @@ import time
 import json
 
 from buweb.service.session import SessionStore, BwSession
+from buweb.service.upload import QuotaExceededException
+from buweb.service.runtime import TaskRuntime
+from buweb.service.registry import SessionRegistry, LocalRegistry, SQLiteRegistry, NodeInfo
 from buweb.model.model import LLM
 
 from logging import Logger,getLogger
 logger:Logger = getLogger(__name__)
 
-Pool:ThreadPoolExecutor = ThreadPoolExecutor(20)
+# タスク実行用の常駐イベントループ(BUWEB_TASK_LOOPS未指定ならCPUコア数)
+Runtime:TaskRuntime = TaskRuntime( int(os.getenv('BUWEB_TASK_LOOPS','0')) or None )
 SessionsDir="./tmp/sessions"
 novncdir="third_party/noVNC-1.5.0"
 
-session_store = SessionStore( dir=SessionsDir, Pool=Pool )
+# BUWEB_REGISTRYに共有ファイルを指定すると複数ノードでセッションを分散する
+RegistryPath:str|None = os.getenv('BUWEB_REGISTRY')
+Registry:SessionRegistry = SQLiteRegistry(RegistryPath) if RegistryPath else LocalRegistry()
+# 他ノードから転送されたリクエストに付けるヘッダ
+FORWARDED_HEADER="X-Buweb-Forwarded"
+
+# BUWEB_TASK_WORKERSを指定するとタスクをワーカープロセスで実行する
+session_store = SessionStore( dir=SessionsDir, runtime=Runtime, n_workers=int(os.getenv('BUWEB_TASK_WORKERS','0')),
+                              registry=Registry, node_url=os.getenv('BUWEB_NODE_URL'), node_host=os.getenv('BUWEB_NODE_HOST'),
+                              mem_reserve_mb=int(os.getenv('BUWEB_MEM_RESERVE_MB','1024')) )
+proxy_session:aiohttp.ClientSession|None = None
 
 def cleanup_sessions():
     print("### CLEANUP SESSIONS ###")
@@ -30,6 +45,51 @@ def cleanup_sessions():
         asyncio.run( session_store.cleanup_all() )
 
 app = Quart(__name__)
+# アップロードはセッションの容量で制限するので、リクエストの上限はそれに合わせる
+UPLOAD_MAX_BYTES:int = int(os.getenv('BUWEB_UPLOAD_MAX_MB','100'))*1024*1024
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + 1024*1024
+
+@app.before_serving
+async def startup():
+    global proxy_session
+    # スイーパーとウォームプールを開始
+    await session_store.start()
+    # 他ノードへの転送用(keep-aliveで使い回す)
+    proxy_session = aiohttp.ClientSession( timeout=aiohttp.ClientTimeout(total=None, sock_connect=10) )
+
+@app.after_serving
+async def shutdown():
+    if proxy_session is not None:
+        await proxy_session.close()
+
+def forward_headers() ->dict[str,str]:
+    headers = { k:v for k,v in request.headers.items() if k.lower() in ('content-type','x-session-id','accept') }
+    headers[FORWARDED_HEADER] = session_store.node_id
+    return headers
+
+async def proxy_stream(node:NodeInfo, api:str, headers:dict[str,str], params:dict[str,str]|None=None) ->AsyncIterable[bytes]:
+    """他ノードのSSEをそのまま中継する"""
+    assert proxy_session is not None
+    async with proxy_session.get(f"{node.url}/api/{api}", headers=headers, params=params) as resp:
+        async for chunk in resp.content.iter_any():
+            yield chunk
+
+async def request_body() ->AsyncIterable[bytes]:
+    async for chunk in request.body:
+        yield chunk
+
+async def proxy_request(node:NodeInfo, api:str) ->Response:
+    """他ノードのセッションへのAPIを転送する(アップロードはメモリに溜めずに流す)"""
+    assert proxy_session is not None
+    headers = forward_headers()
+    body = None
+    if request.method not in ('GET','HEAD'):
+        body = request_body()
+        if request.content_length is not None:
+            headers['Content-Length'] = str(request.content_length)
+    async with proxy_session.request(request.method, f"{node.url}/api/{api}", data=body, headers=headers) as resp:
+        data = await resp.read()
+        return Response(data, status=resp.status, content_type=resp.headers.get('Content-Type'))
 
 @app.route('/', defaults={'path': 'index.html'})
 @app.route('/<path:path>')
@@ -62,12 +122,14 @@ async def config_api():
             operator = data.get('operator_llm')
             planner = data.get('planner_llm')
             max_sessions = data.get('max_sessions')
+            pool_size = data.get('pool_size')
             
             # nameからLLMを取得
             operator_llm = LLM[operator]
             planner_llm = LLM[planner] if planner else None
             max_sessions = int(max_sessions)
-            session_store.configure(operator_llm, planner_llm, max_sessions)
+            pool_size = int(pool_size) if pool_size is not None else None
+            session_store.configure(operator_llm, planner_llm, max_sessions, pool_size)
         # 現在のLLM設定を返す
         current_connections,current_sessions,max_sessions = await session_store.get_status()
         return jsonify({
@@ -77,92 +139,134 @@ async def config_api():
             'current_conneections': current_connections,
             'current_sessions': current_sessions,
             'max_sessions': max_sessions,
+            'pool': session_store.get_pool_status(),
+            'ports': session_store.get_ports_status(),
+            'admission': session_store.get_waiting_status(),
+            'runtime': session_store.get_runtime_status(),
+            'resources': session_store.get_resource_status(),
+            'profile': session_store.get_profile_status(),
+            'adblock': session_store.get_adblock_status(),
+            'health': session_store.get_health_status(),
+            'llm_cache': session_store.get_cache_status(),
+            'hedge': session_store.get_hedge_status(),
+            'coalesce': session_store.get_coalesce_status(),
+            'usage': session_store.get_usage_status(),
+            'node': session_store.node_id,
+            'nodes': [ {'node': n.node_id, 'url': n.url, 'capacity': n.capacity, 'load': n.load} for n in await asyncio.to_thread(Registry.nodes) ],
         })
     except Exception as e:
         traceback.print_exc()
         return jsonify({'status': 'error','msg': str(e)}), 500
 
-def compare_dicts(d1, d2):
-    if d1.keys() != d2.keys():
-        return False
-    for key in d1:
-        if isinstance(d1[key], dict) and isinstance(d2[key], dict):
-            if not compare_dicts(d1[key], d2[key]):
-                return False
-        else:
-            if d1[key] != d2[key]:
-                return False
-    return True
-
-async def session_stream(server_addr,client_addr) ->AsyncIterable[str]:
+@app.route('/api/usage', methods=['GET'])
+async def usage_api():
+    """LLMの使用量(セッション・タスク・モデル・ステップ別)"""
+    try:
+        return jsonify({
+            'status': 'success',
+            'usage': session_store.get_usage_status(detail=True),
+        })
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'status': 'error','msg': str(e)}), 500
+
+# イベントが無いときに送るハートビートの間隔(秒)
+HEARTBEAT_SEC:float = 15.0
+
+def sse_event(data:dict, event:str|None=None) ->str:
+    if event:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def session_stream(server_addr,client_addr,resume:str|None=None) ->AsyncIterable[str]:
     ses = None
+    ticket = None
     try:
         await session_store.incr()
-        ses = await session_store.create(server_addr,client_addr)
-        if ses is None:
-            res = { 'status': 'success', 'msg': '接続数制限中' }
-            yield f"data: {json.dumps(res, ensure_ascii=False)}\n\n"
-            while ses is None:
-                await asyncio.sleep(1)
-                ses = await session_store.create(server_addr,client_addr)
+        # 行列に並んで順番を待つ
+        ticket = await session_store.enqueue(server_addr,client_addr,resume)
+        before_pos = 0
+        while ses is None:
+            pos = session_store.position(ticket)
+            if pos>0 and pos!=before_pos:
+                wait_sec = session_store.estimate_wait(pos)
+                res = { 'status': 'success', 'msg': f'接続数制限中 待ち順:{pos} 目安:約{int(wait_sec//60)+1}分', 'queue': pos, 'wait': int(wait_sec) }
+                yield sse_event(res)
+            elif pos>0:
+                yield ": ping\n\n"
+            before_pos = pos
+            ses = await ticket.wait(HEARTBEAT_SEC)
 
         res = ses.get_status()
         res['msg'] = '接続完了'
-        yield f"data: {json.dumps(res, ensure_ascii=False)}\n\n"
+        yield sse_event(res)
+        if resume is not None and ses.session_id==resume and await session_store.resume_task(ses):
+            # 再起動前に実行中だったタスクを続ける
+            yield sse_event({'status': 'success', 'msg': 'セッションを再開しました'})
 
-        before_res = {}
-        before_time = 0.0
         while ses is not None:
             try:
-                n_task,n_agent,n_step,n_act,header,msg,progress = await ses.get_msg(timeout=1)
-                res = ses.get_status()
-                now = time.time()
-                if msg is None:
-                    if (now-before_time)<10 and compare_dicts(before_res, res):
-                        continue
+                item = await ses.get_msg(timeout=HEARTBEAT_SEC)
+                if item is None:
+                    # 変化が無いときはコメント行だけ送る
+                    yield ": ping\n\n"
+                    continue
+                event,data = item
+                if event=='close':
+                    # セッションが解放された(クライアントは再接続しない)
+                    yield sse_event(data, event)
+                    break
+                if event=='status':
+                    # 状態の差分は通常のmessageイベントで送る
+                    yield sse_event(data)
                 else:
-                    if n_task>0:
-                        res['task'] = n_task
-                    if n_agent>0:
-                        res['agent'] = n_agent
-                    if n_step>0:
-                        res['step'] = n_step
-                    if n_act>0:
-                        res['act'] = n_act
-                    res['header'] = header
-                    res['msg'] = msg
-                    res['progress'] = progress
-                yield f"data: {json.dumps(res, ensure_ascii=False)}\n\n"
-                before_res = res
-                before_time = now
+                    yield sse_event(data, event)
             except Exception as ex:
                 traceback.print_exc()
                 break
     except Exception as ex:
         traceback.print_exc()
     finally:
-        if ses is not None:
-            await session_store.remove(ses.session_id)
+        if ticket is not None:
+            await session_store.leave(ticket)
         await session_store.decr()
 
 @app.route('/api/<path:api>', methods=['GET','POST'])
 async def service_api(api):
     try:
         client_addr = request.remote_addr
-        server_addr = request.host.split(':')[0]
+        # VNCの接続先(ノードのホスト名が設定されていればそれを使う)
+        server_addr = session_store.node_host or request.host.split(':')[0]
         session_id = request.headers.get("X-Session-ID")
+        forwarded:bool = request.headers.get(FORWARDED_HEADER) is not None
         ses:BwSession|None = await session_store.get(session_id)
         # sessionの場合
         if api == 'session':
             if ses is not None:
                 return jsonify({'status': 'error', 'msg': 'unauth'}), 401
             headers = { "Content-Type": "text/event-stream" }
-            ress = Response(session_stream(server_addr,client_addr), headers=headers, mimetype='text/event-stream')   
+            resume = request.args.get('resume')
+            # 中断されたセッションを持っているノードで再開する
+            node = None
+            if not forwarded and not session_store.is_dormant(resume):
+                node = await session_store.locate(resume)
+                if node is None:
+                    # 空きの多いノードがあればそちらでセッションを作る
+                    node = await session_store.place()
+            if node is not None:
+                params = {'resume': resume} if resume else None
+                ress = Response(proxy_stream(node, api, forward_headers(), params), headers=headers, mimetype='text/event-stream')
+            else:
+                ress = Response(session_stream(server_addr,client_addr,resume), headers=headers, mimetype='text/event-stream')
             ress.timeout = None # disable timeout
             return ress
   
         # session意外の場合
         if ses is None:
+            # 他のノードのセッションなら転送する
+            node = await session_store.locate(session_id) if not forwarded else None
+            if node is not None:
+                return await proxy_request(node, api)
             return jsonify({'status': 'error', 'msg': 'unauth'}), 401
 
         if api=='browser_start':
@@ -197,20 +301,19 @@ async def service_api(api):
             return jsonify(res)
 
         elif api=='store_file':
-            upfiles = await request.files
-            if 'file' not in upfiles:
+            mimetype,options = parse_options_header(request.headers.get('Content-Type',''))
+            boundary = options.get('boundary')
+            if mimetype!='multipart/form-data' or not boundary:
                 return jsonify({'status': 'error', 'msg': 'No file part'})
-            
-            file = upfiles['file']
-            if file.filename is None or file.filename == '':
-                return jsonify({'status': 'error', 'msg': 'No selected file'})
-            
             try:
-                # ファイルの内容を読み込む
-                content = file.read()
-                # ファイルを保存
-                await ses.store_file(file.filename, content)
-                return jsonify({'status': 'success', 'msg': ''})
+                # 受信しながらセッションの作業ディレクトリに書き込む
+                ses.upload_quota = UPLOAD_MAX_BYTES
+                names = await ses.store_upload(request.body, boundary)
+                if not names:
+                    return jsonify({'status': 'error', 'msg': 'No selected file'})
+                return jsonify({'status': 'success', 'msg': '', 'files': names})
+            except QuotaExceededException as e:
+                return jsonify({'status': 'error', 'msg': str(e)}), 413
             except Exception as e:
                 return jsonify({'status': 'error', 'msg': str(e)})
 
@@ -249,6 +352,8 @@ def main():
             pass
     # シグナルハンドラ
     def sig_handler(signum, frame) -> None:
+        # ストリームの後始末で作業ディレクトリを消さないように先に印を付ける
+        session_store.suspending = True
         sys.exit(1)
     signal.signal(signal.SIGTERM, sig_handler)
 
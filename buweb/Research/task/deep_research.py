@@ -32,11 +32,12 @@ from langchain_core.caches import BaseCache
 
 # from browser_use.controller.service import Controller
 from buweb.utils.utils import dump, safe_close
+from buweb.model.model import tool_calling_method
 
 alogger = getLogger(__name__)
 logger = dump(alogger)
 
-from typing import Callable
+from typing import Awaitable, Callable
 def dmy_write(msg):
     pass
 
@@ -44,6 +45,8 @@ async def deep_research(task:str, llm:BaseChatModel, agent_state=None,
                         browser:Browser|None=None,
                         browser_context:BrowserContext|None=None,
                         sensitive_data:dict|None=None,
+                        available_file_paths:list[str]|None=None,
+                        resume:dict|None=None, checkpoint:Callable[[dict],Awaitable[None]]|None=None,
                         writer:BuwWriter|None=None, inter:dict={},
                         **kwargs) ->tuple[str,str|None]:
     def log_info(msg):
@@ -196,32 +199,61 @@ Provide your output as a JSON formatted list. Each item in the list must adhere
 
     history_query = []
     history_infos = []
+    # 中断前の状態から再開する(途中だったイテレーションは残りのクエリから)
+    pending_plan:str|None = None
+    pending_tasks:list[str] = []
+    start_index:int = 0
+    if resume:
+        search_iteration = resume.get('iteration',0)
+        history_query = list(resume.get('history_query',[]))
+        history_infos = list(resume.get('history_infos',[]))
+        if resume.get('next_query',0) < len(resume.get('queries',[])):
+            pending_plan = resume.get('plan','')
+            pending_tasks = list(resume.get('queries',[]))
+            start_index = resume.get('next_query',0)
+        log_info(f"Ite:{search_iteration:02d} 中断したリサーチを再開します")
+
+    async def save_checkpoint(plan:str, queries:list[str], next_query:int) -> None:
+        if checkpoint is not None:
+            await checkpoint({'research': {
+                'iteration': search_iteration, 'plan': plan, 'queries': list(queries), 'next_query': next_query,
+                'history_query': list(history_query), 'history_infos': list(history_infos),
+            }})
+
     try:
-        while search_iteration < max_search_iterations:
-            search_iteration += 1
-            ititle = f"Ite:{search_iteration:02d}"
-            #log_info(f"{ititle} Start Search...")
-            history_query_ = json.dumps(history_query, indent=4)
-            history_infos_ = json.dumps(history_infos, indent=4)
-            query_prompt = f"This is search {search_iteration} of {max_search_iterations} maximum searches allowed.\n User Instruction:{task} \n Previous Queries:\n {history_query_} \n Previous Search Results:\n {history_infos_}\n"
-            search_messages.append(HumanMessage(content=query_prompt))
-            ai_query_msg = llm.invoke(search_messages[:1] + search_messages[1:][-1:])
-            search_messages.append(ai_query_msg)
-            if hasattr(ai_query_msg, "reasoning_content"):
-                logTrans(f"{ititle} Reasoning",ai_query_msg.reasoning_content) # type:ignore
-            ai_query_contents:str = ai_query_msg.content.replace("```json", "").replace("```", "")
-            ai_query_contenta = repair_json(ai_query_contents)
-            ai_query_content = json.loads(ai_query_contenta) # type: ignore
-            query_plan = ai_query_content["plan"]
-            logTrans(f"{ititle} Plan",query_plan)
-            query_tasks = ai_query_content["queries"]
-            if not query_tasks:
-                break
+        while search_iteration < max_search_iterations or pending_tasks:
+            if pending_tasks:
+                ititle = f"Ite:{search_iteration:02d}"
+                query_plan = pending_plan or ""
+                query_tasks = pending_tasks
+                pending_tasks = []
             else:
-                query_tasks = query_tasks[:max_query_num]
-                history_query.extend(query_tasks)
-                aa = '\n'.join( [ f"{i+1}. {query}" for i,query in enumerate(query_tasks) ] )
-                log_info(f"{ititle} Query tasks:\n{aa}")
+                search_iteration += 1
+                start_index = 0
+                ititle = f"Ite:{search_iteration:02d}"
+                #log_info(f"{ititle} Start Search...")
+                history_query_ = json.dumps(history_query, indent=4)
+                history_infos_ = json.dumps(history_infos, indent=4)
+                query_prompt = f"This is search {search_iteration} of {max_search_iterations} maximum searches allowed.\n User Instruction:{task} \n Previous Queries:\n {history_query_} \n Previous Search Results:\n {history_infos_}\n"
+                search_messages.append(HumanMessage(content=query_prompt))
+                ai_query_msg = await llm.ainvoke(search_messages[:1] + search_messages[1:][-1:])
+                search_messages.append(ai_query_msg)
+                if hasattr(ai_query_msg, "reasoning_content"):
+                    logTrans(f"{ititle} Reasoning",ai_query_msg.reasoning_content) # type:ignore
+                ai_query_contents:str = ai_query_msg.content.replace("```json", "").replace("```", "")
+                ai_query_contenta = repair_json(ai_query_contents)
+                ai_query_content = json.loads(ai_query_contenta) # type: ignore
+                query_plan = ai_query_content["plan"]
+                logTrans(f"{ititle} Plan",query_plan)
+                query_tasks = ai_query_content["queries"]
+                if not query_tasks:
+                    break
+                else:
+                    query_tasks = query_tasks[:max_query_num]
+                    history_query.extend(query_tasks)
+                    aa = '\n'.join( [ f"{i+1}. {query}" for i,query in enumerate(query_tasks) ] )
+                    log_info(f"{ititle} Query tasks:\n{aa}")
+                await save_checkpoint(query_plan, query_tasks, 0)
 
             # 2. Perform Web Search and Auto exec
             # Parallel BU agents
@@ -230,6 +262,7 @@ Provide your output as a JSON formatted list. Each item in the list must adhere
             agents = [CustomAgent(
                 task=task,
                 llm=llm,
+                tool_calling_method=tool_calling_method(llm), # type: ignore[arg-type]
                 add_infos=add_infos,
                 browser=browser,
                 browser_context=browser_context,
@@ -238,6 +271,7 @@ Provide your output as a JSON formatted list. Each item in the list must adhere
                 max_actions_per_step=5,
                 controller=controller,
                 generate_gif=history_gif,
+                available_file_paths=available_file_paths,
                 register_new_step_callback=writer.done_get_next_action if writer else None,
                 writer=writer,
             ) for task in query_tasks]
@@ -247,7 +281,7 @@ Provide your output as a JSON formatted list. Each item in the list must adhere
             os.makedirs(query_result_dir, exist_ok=True)
 
             query_results = []
-            for i in range(len(agents)):
+            for i in range(start_index, len(agents)):
                 if 'stop' in inter:
                     raise Exception("Stop Deep Research")
                 title = f"Query:{search_iteration:02d}-{i:03d}"
@@ -280,7 +314,7 @@ Provide your output as a JSON formatted list. Each item in the list must adhere
                         history_infos_ = json.dumps(history_infos, indent=4)
                         record_prompt = f"User Instruction:{task}. \nPrevious Recorded Information:\n {history_infos_}\n Current Search Iteration: {search_iteration}\n Current Search Plan:\n{query_plan}\n Current Search Query:\n {query_tasks[i]}\n Current Search Results: {query_result_}\n "
                         record_messages.append(HumanMessage(content=record_prompt))
-                        ai_record_msg = llm.invoke(record_messages[:1] + record_messages[-1:])
+                        ai_record_msg = await llm.ainvoke(record_messages[:1] + record_messages[-1:])
                         record_messages.append(ai_record_msg)
                         if hasattr(ai_record_msg, "reasoning_content"):
                             logTrans("Reason",ai_record_msg.reasoning_content) # type: ignore
@@ -291,19 +325,25 @@ Provide your output as a JSON formatted list. Each item in the list must adhere
                 finally:
                     if writer:
                         await writer.done_agent(agent.state.history)
+                # クエリが完了したら保存する(中断したら次のクエリから再開する)
+                await save_checkpoint(query_plan, query_tasks, i+1)
             # 3. Summarize Search Result
 
         log_info("\nFinish Searching, Start Generating Report...")
 
         # 5. Report Generation in Markdown (or JSON if you prefer)
-        return await generate_final_report(task, history_infos, save_dir, llm)
+        return await generate_final_report(task, history_infos, save_dir, llm, writer=writer)
 
     except Exception as e:
+        if inter.get('suspend'):
+            # サーバ停止による中断なのでレポートは作らない
+            log_info("Deep research suspended.")
+            return "", None
         traceback.print_exc()
         log_error(f"Deep research Error: {e}")
-        return await generate_final_report(task, history_infos, save_dir, llm, str(e))
+        return await generate_final_report(task, history_infos, save_dir, llm, str(e), writer=writer)
     finally:
-        await safe_close(browser)
+        # ブラウザは呼び出し側が管理する
         await safe_close(browser_context)
         log_info("Browser closed.")
 
@@ -362,12 +402,16 @@ async def generate_final_report(task, history_infos, save_dir, llm, error_msg=No
         report_prompt = f"User Instruction:{task} \n Search Information:\n {history_infos_}"
         report_messages = [SystemMessage(content=writer_system_prompt),
                            HumanMessage(content=report_prompt)]  # New context for report generation
-        ai_report_msg = llm.invoke(report_messages)
-        if hasattr(ai_report_msg, "reasoning_content"):
-            log_info("🤯 Start Report Deep Thinking: ")
-            log_info(ai_report_msg.reasoning_content)
-            log_info("🤯 End Report Deep Thinking")
-        report_content = ai_report_msg.content
+        if writer:
+            # 生成しながらクライアントに送る
+            report_content = await writer.stream_report(llm, report_messages, title="Research Report")
+        else:
+            ai_report_msg = await llm.ainvoke(report_messages)
+            if hasattr(ai_report_msg, "reasoning_content"):
+                log_info("🤯 Start Report Deep Thinking: ")
+                log_info(ai_report_msg.reasoning_content)
+                log_info("🤯 End Report Deep Thinking")
+            report_content = ai_report_msg.content
         report_content = re.sub(r"^```\s*markdown\s*|^\s*```|```\s*$", "", report_content, flags=re.MULTILINE)
         report_content = report_content.strip()
 
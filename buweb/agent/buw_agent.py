@@ -26,7 +26,7 @@ from browser_use.controller.registry.service import ActionModel
 from browser_use.dom.views import DOMElementNode, SelectorMap
 from playwright.async_api import Page
 import asyncio
-from typing import Callable, Optional, Dict,Literal, Type
+from typing import Awaitable, Callable, Optional, Dict,Literal, Type
 from pydantic import BaseModel
 from logging import Logger,getLogger,ERROR as LvError
 from buweb.model.translate import Translate
@@ -34,8 +34,16 @@ from buweb.model.translate import Translate
 logger:Logger = getLogger(__name__)
 
 class BuwWriter:
-    def __init__(self,n_task:int=0,writer:Callable[[int,int,int,int,str,str|dict,str|None],None]|None=None,trans:Translate|None=None):
+    # レポートを送る間隔と大きさ(小さな断片をまとめて送る)
+    REPORT_FLUSH_SEC:float = 0.2
+    REPORT_FLUSH_CHARS:int = 80
+
+    def __init__(self,n_task:int=0,writer:Callable[[int,int,int,int,str,str|dict,str|None],None]|None=None,trans:Translate|None=None,
+                 reporter:Callable[[int,int,str,str,bool],None]|None=None):
         self._writer:Callable[[int,int,int,int,str,str|dict,str|None],None]|None = writer
+        # レポートの断片を送る (タスク番号, レポート番号, タイトル, 断片, 完了)
+        self._reporter:Callable[[int,int,str,str,bool],None]|None = reporter
+        self._n_reports:int = 0
         self._trans:Translate|None = trans
         self._global_task:str = ""
         self._n_task:int = n_task
@@ -44,6 +52,12 @@ class BuwWriter:
         self._n_steps:int=0
         self._n_actions:int=0
 
+    def step_key(self) ->str:
+        """使用量をステップ別に集計するためのキー(エージェントの外では空)"""
+        if self._n_agents<=0:
+            return ""
+        return f"{self._n_agents}-{self._n_steps}"
+
     async def trans(self, text:str|None) ->str|None:
         if text and self._trans:
             return await self._trans.translate(text)
@@ -73,6 +87,46 @@ class BuwWriter:
         except Exception as e:
             print(f"##AgemtPrint {e}")
 
+    async def stream_report(self, llm:BaseChatModel, input, *, title:str="report") -> str:
+        """レポートを生成しながら少しずつ送り、全文を返す"""
+        self._n_reports += 1
+        n_report = self._n_reports
+        parts:list[str] = []
+        buf:list[str] = []
+        flushed = time.monotonic()
+        def flush(done:bool=False):
+            nonlocal flushed
+            if self._reporter is not None and (buf or done):
+                try:
+                    self._reporter(self._n_task, n_report, title, "".join(buf), done)
+                except Exception as e:
+                    print(f"##AgemtPrint {e}")
+            buf.clear()
+            flushed = time.monotonic()
+        try:
+            async for chunk in llm.astream(input):
+                text = chunk.content if isinstance(chunk.content,str) else ""
+                if not text:
+                    continue
+                parts.append(text)
+                buf.append(text)
+                if sum(len(t) for t in buf)>=self.REPORT_FLUSH_CHARS or time.monotonic()-flushed>=self.REPORT_FLUSH_SEC:
+                    flush()
+        except Exception:
+            if parts:
+                flush(done=True)
+                raise
+            # ストリーミングできなければ通常の呼び出し(再試行あり)で作る
+            result = await llm.ainvoke(input)
+            text = result.content if isinstance(result.content,str) else ""
+            parts.append(text)
+            buf.append(text)
+        report = "".join(parts)
+        flush(done=True)
+        if self._reporter is None and report:
+            self.print(msg=report)
+        return report
+
     async def start_global_task(self,global_task:str):
         self._n_agents = 0
         self._n_steps = 0
@@ -170,9 +224,10 @@ class BuwWriter:
 
 class BuwAgent(Agent):
 
-    async def run(self, max_steps: int = 100, wr:BuwWriter|None=None) -> AgentHistoryList:
+    async def run(self, max_steps: int = 100, wr:BuwWriter|None=None, on_step:Callable[["BuwAgent"],Awaitable[None]]|None=None) -> AgentHistoryList:
         logger.setLevel(LvError)
         self._writer:BuwWriter|None = wr
+        self._on_step:Callable[[BuwAgent],Awaitable[None]]|None = on_step
         if self._writer is not None:
             self.register_new_step_callback = self._writer.done_get_next_action
             self.register_done_callback = self._writer.done_agent
@@ -193,6 +248,16 @@ class BuwAgent(Agent):
             await self._writer.done_plannner(plan)
         return plan
 
+    async def step(self, step_info: Optional[AgentStepInfo] = None) -> None:
+        await super().step(step_info)
+        # ステップが終わるごとに進捗を保存する
+        on_step = getattr(self,'_on_step',None)
+        if on_step is not None:
+            try:
+                await on_step(self)
+            except Exception:
+                logger.exception("error in step callback")
+
     async def get_next_action(self, input_messages: list[BaseMessage]) -> AgentOutput:
         if self._writer:
             await self._writer.start_get_next_action(self.state.n_steps)
@@ -126,31 +126,27 @@ class BwController(Controller):
                 extracted_content=msg,
                 include_in_memory=True,
             )
-        # @self.registry.action(
-		# 	'Extract page content to retrieve specific information from the page, e.g. all company names, a specifc description, all information about, links with companies in structured format or simply links',
-		# )
-        # async def extract_content(goal: str, browser: BrowserContext, page_extraction_llm: BaseChatModel):
-        #     t0 = time.time()
-        #     page = await browser.get_current_page()
-        #     t1 = time.time()
-        #     import markdownify
-        #     t2 = time.time()
-        #     content = markdownify.markdownify(await page.content())
-        #     t3 = time.time()
-        #     prompt = 'Your task is to extract the content of the page. You will be given a page and a goal and you should extract all relevant information around this goal from the page. If the goal is vague, summarize the page. Respond in json format. Extraction goal: {goal}, Page: {page}'
-        #     template = PromptTemplate(input_variables=['goal', 'page'], template=prompt)
-        #     try:
-        #         output = page_extraction_llm.invoke(template.format(goal=goal, page=content))
-        #         t4 = time.time()
-        #         print(f"### TIME get:{t1-t0}, import:{t2-t1}, markdownify:{t3-t2}, extraction:{t4-t3}")
-        #         msg = f'📄  Extracted from page\n: {output.content}\n'
-        #         logger.info(msg)
-        #         return ActionResult(extracted_content=msg, include_in_memory=True)
-        #     except Exception as e:
-        #         logger.debug(f'Error extracting content: {e}')
-        #         msg = f'📄  Extracted from page\n: {content}\n'
-        #         logger.info(msg)
-        #         return ActionResult(extracted_content=msg)
+
+        # customize extract action (非同期で呼んでタスクのループを止めない)
+        @self.registry.action(
+			'Extract page content to retrieve specific information from the page, e.g. all company names, a specifc description, all information about, links with companies in structured format or simply links',
+		)
+        async def extract_content(goal: str, browser: BrowserContext, page_extraction_llm: BaseChatModel):
+            page = await browser.get_current_page()
+            import markdownify
+            content = markdownify.markdownify(await page.content())
+            prompt = 'Your task is to extract the content of the page. You will be given a page and a goal and you should extract all relevant information around this goal from the page. If the goal is vague, summarize the page. Respond in json format. Extraction goal: {goal}, Page: {page}'
+            template = PromptTemplate(input_variables=['goal', 'page'], template=prompt)
+            try:
+                output = await page_extraction_llm.ainvoke(template.format(goal=goal, page=content))
+                msg = f'📄  Extracted from page\n: {output.content}\n'
+                logger.info(msg)
+                return ActionResult(extracted_content=msg, include_in_memory=True)
+            except Exception as e:
+                logger.debug(f'Error extracting content: {e}')
+                msg = f'📄  Extracted from page\n: {content}\n'
+                logger.info(msg)
+                return ActionResult(extracted_content=msg)
 
         # @self.action('Ask user for information',param_model=UserInput)
         # def ask_human(params: UserInput, browser: BrowserContext):
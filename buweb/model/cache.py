@@ -0,0 +1,214 @@
+import os
+import time
+import hashlib
+import sqlite3
+import asyncio
+from collections import OrderedDict
+from threading import Lock, local
+from typing import Any, Optional, Sequence
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+RETURN_VAL_TYPE = Sequence[Generation]
+LLMCACHEFILE:str = 'llm_cache.db'
+
+class LLMCache(BaseCache):
+    """複数のスレッド・プロセスから同時に使うLLMの応答キャッシュ
+
+    SQLite(WAL)に保存し、接続はスレッドごとに持つ。よく使う応答はプロセス内のLRUにも
+    置くので、ヒットすればスレッドに渡さずに返す。合計サイズがmax_bytesを超えたら
+    古く使われたものから消し、ttlを過ぎたものは使わない。参照時刻の更新はまとめて書き込む。
+    """
+    # 参照時刻をまとめて書き込む間隔(秒)
+    FLUSH_SEC:float = 30.0
+    # この回数書き込むごとにサイズを確認する
+    EVICT_EVERY:int = 50
+
+    def __init__(self, path:str, *, max_bytes:int=512*1024*1024, ttl:float=7*24*3600.0, mem_entries:int=256):
+        self.path:str = os.path.abspath(path)
+        self.max_bytes:int = max_bytes
+        self.ttl:float = ttl
+        self.mem_entries:int = mem_entries
+        self._local = local()
+        self._lock:Lock = Lock()
+        self._mem:OrderedDict[str,tuple[float,str]] = OrderedDict()
+        self._accessed:dict[str,float] = {}
+        self._flushed:float = time.time()
+        self._writes:int = 0
+        # 統計
+        self.hits:int = 0
+        self.mem_hits:int = 0
+        self.misses:int = 0
+        self.evictions:int = 0
+        self._lookup_sec:float = 0.0
+        self._lookups:int = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに持つ
+        conn = getattr(self._local,'conn',None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(prompt:str, llm_string:str) -> str:
+        return hashlib.sha256(f"{llm_string}\0{prompt}".encode()).hexdigest()
+
+    def _mem_get(self, key:str) -> list[Generation]|None:
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is None:
+                return None
+            created,value = entry
+            if now-created>self.ttl:
+                del self._mem[key]
+                return None
+            self._mem.move_to_end(key)
+            self._accessed[key] = now
+            self.hits += 1
+            self.mem_hits += 1
+        # 呼び出し側が書き換えても良いように毎回デシリアライズする
+        return loads(value)
+
+    def _mem_put(self, key:str, created:float, value:str) -> None:
+        with self._lock:
+            self._mem[key] = (created, value)
+            self._mem.move_to_end(key)
+            while len(self._mem)>self.mem_entries:
+                self._mem.popitem(last=False)
+
+    def _count(self, t0:float, hit:bool) -> None:
+        with self._lock:
+            self._lookups += 1
+            self._lookup_sec += time.monotonic()-t0
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, prompt:str, llm_string:str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        value = self._mem_get(key)
+        if value is not None:
+            return value
+        return self._db_lookup(key)
+
+    def _db_lookup(self, key:str) -> list[Generation]|None:
+        t0 = time.monotonic()
+        value:list[Generation]|None = None
+        try:
+            row = self._conn().execute("SELECT value, created FROM llm_cache WHERE key=?", (key,)).fetchone()
+            if row is not None and time.time()-row[1]<=self.ttl:
+                value = loads(row[0])
+                self._mem_put(key, row[1], row[0])
+                with self._lock:
+                    self._accessed[key] = time.time()
+        except (sqlite3.Error, ValueError) as ex:
+            logger.warning(f"cache lookup failed {str(ex)}")
+        self._count(t0, value is not None)
+        self._maybe_flush()
+        return value
+
+    def update(self, prompt:str, llm_string:str, return_val:RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        try:
+            value = dumps(list(return_val))
+        except (TypeError, ValueError) as ex:
+            logger.warning(f"can not cache {str(ex)}")
+            return
+        self._mem_put(key, now, value)
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?,?,?,?,?)", (key, value, len(value), now, now))
+        except sqlite3.Error as ex:
+            logger.warning(f"cache update failed {str(ex)}")
+            return
+        with self._lock:
+            self._writes += 1
+            evict = self._writes%self.EVICT_EVERY==0
+        if evict:
+            self._evict()
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        """溜まった参照時刻を書き込む"""
+        with self._lock:
+            if time.time()-self._flushed<self.FLUSH_SEC or not self._accessed:
+                return
+            accessed, self._accessed = self._accessed, {}
+            self._flushed = time.time()
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany("UPDATE llm_cache SET accessed=? WHERE key=?", [ (t,k) for k,t in accessed.items() ])
+        except sqlite3.Error as ex:
+            logger.warning(f"cache flush failed {str(ex)}")
+
+    def _evict(self) -> None:
+        """期限切れを消し、サイズを超えていれば古く使われたものから9割まで消す"""
+        try:
+            conn = self._conn()
+            with conn:
+                n = conn.execute("DELETE FROM llm_cache WHERE created<?", (time.time()-self.ttl,)).rowcount
+                total, = conn.execute("SELECT COALESCE(SUM(size),0) FROM llm_cache").fetchone()
+                if total>self.max_bytes:
+                    target = total - int(self.max_bytes*0.9)
+                    keys:list[str] = []
+                    for k,size in conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed"):
+                        if target<=0:
+                            break
+                        keys.append(k)
+                        target -= size
+                    conn.executemany("DELETE FROM llm_cache WHERE key=?", [ (k,) for k in keys ])
+                    n += len(keys)
+            if n>0:
+                with self._lock:
+                    self.evictions += n
+                logger.info(f"cache evicted {n} entries")
+        except sqlite3.Error as ex:
+            logger.warning(f"cache eviction failed {str(ex)}")
+
+    async def alookup(self, prompt:str, llm_string:str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        value = self._mem_get(key)
+        if value is not None:
+            return value
+        return await asyncio.to_thread(self._db_lookup, key)
+
+    async def aupdate(self, prompt:str, llm_string:str, return_val:RETURN_VAL_TYPE) -> None:
+        await asyncio.to_thread(self.update, prompt, llm_string, return_val)
+
+    def clear(self, **kwargs:Any) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._accessed.clear()
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM llm_cache")
+
+    def get_status(self) -> dict:
+        with self._lock:
+            lookups = self.hits+self.misses
+            return {
+                'hits': self.hits,
+                'mem_hits': self.mem_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits/lookups,3) if lookups>0 else None,
+                'evictions': self.evictions,
+                'avg_lookup_ms': round(self._lookup_sec*1000/self._lookups,3) if self._lookups>0 else 0.0,
+                'mem_entries': len(self._mem),
+            }
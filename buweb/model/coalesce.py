@@ -0,0 +1,73 @@
+import hashlib
+import asyncio
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any
+from langchain_core.load import dumps
+from langchain_core.messages import BaseMessage
+from buweb.model.retry import model_name
+from buweb.model.usage import record_usage
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class _Abandoned(Exception):
+    """先に呼び出した側が取り消された(待っていた側は自分で呼び出し直す)"""
+
+# 実行中の呼び出し。イベントループをまたいで待てるようにconcurrent.futures.Futureを使う
+_inflight:dict[str,Future] = {}
+_lock:Lock = Lock()
+_leaders:int = 0
+_coalesced:int = 0
+
+def get_coalesce_status() -> dict:
+    with _lock:
+        return { 'calls': _leaders, 'coalesced': _coalesced, 'inflight': len(_inflight) }
+
+class SingleFlightMixin:
+    """同じモデル・パラメータ・メッセージの呼び出しが実行中なら、その結果を待って使う
+
+    キャッシュは応答が保存されてからしか効かないので、同時に来た同じ呼び出しを一つにまとめる。
+    レートリミッタと再試行より外側で待つので、まとめられた呼び出しは枠を使わない。
+    """
+
+    def _flight_key(self, input:Any, stop:list[str]|None, kwargs:dict) -> str:
+        messages = self._convert_input(input).to_messages() # type: ignore[attr-defined]
+        llm_string = self._get_llm_string(stop=stop, **kwargs) # type: ignore[attr-defined]
+        return hashlib.sha256(f"{llm_string}\0{dumps(messages)}".encode()).hexdigest()
+
+    async def ainvoke(self, input, config=None, *, stop=None, **kwargs:Any):
+        global _leaders, _coalesced
+        try:
+            key = self._flight_key(input, stop, kwargs)
+        except Exception:
+            return await super().ainvoke(input, config, stop=stop, **kwargs) # type: ignore[misc]
+        while True:
+            with _lock:
+                fut = _inflight.get(key)
+                if fut is None:
+                    fut = _inflight[key] = Future()
+                    _leaders += 1
+                    break
+                _coalesced += 1
+            try:
+                # 待っている側が取り消されても、共有しているFutureは取り消さない
+                result = await asyncio.shield(asyncio.wrap_future(fut))
+            except _Abandoned:
+                continue
+            # 使用量はキャッシュヒットと同じに数える
+            record_usage(model_name(self), cache_hit=True)
+            return result.model_copy(deep=True) if isinstance(result, BaseMessage) else result
+        try:
+            result = await super().ainvoke(input, config, stop=stop, **kwargs) # type: ignore[misc]
+        except Exception as ex:
+            fut.set_exception(ex)
+            raise
+        except BaseException:
+            # 取り消しなど
+            fut.set_exception(_Abandoned())
+            raise
+        finally:
+            with _lock:
+                _inflight.pop(key, None)
+        fut.set_result(result)
+        return result
@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+from typing import Any, AsyncIterator, Iterator, Sequence
+from pydantic import ConfigDict
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+# 台本(JSON)のパス。無ければDEFAULT_SCRIPTのルールで応答する
+FAKE_LLM_SCRIPT_ENV:str = 'FAKE_LLM_SCRIPT'
+
+DEFAULT_SCRIPT:dict = {
+    'seed': 0,
+    # 応答時間の分布 dist: fixed(sec) | uniform(min,max) | normal(mean,sd) | lognormal(median,sigma)
+    # tail: {p, mult} はpの確率でmult倍遅くする
+    'latency': {'dist': 'lognormal', 'median': 1.0, 'sigma': 0.5},
+    # 出力の速さ(0なら出力の時間はかけない)
+    'tokens_per_sec': 0.0,
+    # トークン数の見積もりに使う1トークンあたりの文字数
+    'chars_per_token': 4.0,
+    # 文章で答えるときの出力トークン数
+    'output_tokens': 200,
+    # エージェントがdoneするまでのステップ数と、それまでに使うアクション
+    'agent_steps': 3,
+    'agent_actions': ['scroll_down'],
+    # ステップごとのアクション(指定するとagent_steps,agent_actionsより優先。最後のものを繰り返す)
+    # 例: [ [{"go_to_url": {"url": "http://127.0.0.1:8080/"}}], [{"done": {"text": "ok"}}] ]
+    'agent_script': None,
+    # deep_researchの検索の回数と1回あたりのクエリ数
+    'research_iterations': 1,
+    'research_queries': 1,
+    # 最後のメッセージが正規表現matchに一致したらcontentを返す [{match, content}]
+    'responses': [],
+}
+
+_WORDS:tuple[str,...] = ( 'fake', 'response', 'browser', 'agent', 'result', 'page', 'search', 'report',
+                          'data', 'task', 'step', 'value', 'summary', 'content', 'link', 'list' )
+_SEARCH_RE = re.compile(r"This is search (\d+) of")
+
+def load_fake_script(path:str|None=None) -> dict:
+    """台本を読み込んでDEFAULT_SCRIPTに重ねる"""
+    script = dict(DEFAULT_SCRIPT)
+    path = path or os.getenv(FAKE_LLM_SCRIPT_ENV)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            script.update(json.load(f))
+    return script
+
+def _text(message:BaseMessage) -> str:
+    content = message.content
+    if isinstance(content,str):
+        return content
+    return " ".join( c if isinstance(c,str) else str(c.get('text','')) for c in content )
+
+def _resolve(schema:dict, defs:dict) -> dict:
+    while '$ref' in schema:
+        schema = defs.get(schema['$ref'].split('/')[-1], {})
+    return schema
+
+def sample_schema(schema:dict, defs:dict, rng:random.Random, name:str="") -> Any:
+    """JSON Schemaを満たす値を作る(必須の項目だけ埋める)"""
+    schema = _resolve(schema, defs)
+    for key in ('anyOf','oneOf'):
+        if key in schema:
+            options = [ s for s in schema[key] if _resolve(s,defs).get('type')!='null' ] or schema[key]
+            return sample_schema(options[0], defs, rng, name)
+    if 'allOf' in schema:
+        return sample_schema(schema['allOf'][0], defs, rng, name)
+    if 'default' in schema:
+        return schema['default']
+    if 'enum' in schema:
+        return schema['enum'][0]
+    t = schema.get('type')
+    if t=='string':
+        return f"fake {name} {rng.choice(_WORDS)}".strip()
+    if t=='integer':
+        return int(schema.get('minimum',0))
+    if t=='number':
+        return float(schema.get('minimum',0.0))
+    if t=='boolean':
+        return True
+    if t=='array':
+        n = int(schema.get('minItems', schema.get('min_items',0)) or 0)
+        return [ sample_schema(schema.get('items',{}), defs, rng, name) for _ in range(n) ]
+    if t=='object' or 'properties' in schema:
+        props = schema.get('properties',{})
+        return { k:sample_schema(props[k], defs, rng, k) for k in schema.get('required',[]) if k in props }
+    return None
+
+class FakeChatModel(BaseChatModel):
+    """ネットワークもAPIキーも使わないベンチマーク用のチャットモデル
+
+    入力から決まる乱数で応答を作るので、同じ入力には同じ応答・応答時間・トークン数を返す。
+    ツール(with_structured_outputのAgentOutputなど)を渡されたらツール呼び出しで答え、
+    エージェントは会話中の応答の数をステップ数とみなして台本どおりに進めてdoneする。
+    deep_researchの検索計画と記録はそれぞれが読めるJSONで答える。
+    """
+    model_config = ConfigDict(protected_namespaces=())
+
+    model: str = "fake"
+    script: dict = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    @property
+    def _identifying_params(self) -> dict[str,Any]:
+        digest = hashlib.sha256(json.dumps(self.script, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return { 'model': self.model, 'script': digest }
+
+    def _conf(self, key:str) -> Any:
+        return self.script.get(key, DEFAULT_SCRIPT[key])
+
+    def bind_tools(self, tools:Sequence[Any], *, tool_choice:Any=None, **kwargs:Any) -> Runnable:
+        return self.bind(tools=[ convert_to_openai_tool(t) for t in tools ], **kwargs)
+
+    #---------------------------------
+    # 応答
+    #---------------------------------
+    def _rng(self, messages:list[BaseMessage], tools:list[dict]|None) -> random.Random:
+        key = json.dumps([ [m.type, _text(m)] for m in messages ], ensure_ascii=False)
+        key += json.dumps(tools or [], sort_keys=True, default=str)
+        seed = hashlib.sha256(f"{self._conf('seed')}\0{key}".encode()).digest()
+        return random.Random(int.from_bytes(seed[:8],'big'))
+
+    def _tokens(self, text:str) -> int:
+        return max(1, math.ceil(len(text)/float(self._conf('chars_per_token'))))
+
+    def _filler(self, rng:random.Random) -> str:
+        n_chars = int(self._conf('output_tokens')*float(self._conf('chars_per_token')))
+        words:list[str] = []
+        size = 0
+        while size<n_chars:
+            w = rng.choice(_WORDS)
+            words.append(w)
+            size += len(w)+1
+        return " ".join(words)
+
+    def _agent_actions(self, step:int, action_schema:dict, defs:dict, rng:random.Random) -> list[dict]:
+        script = self._conf('agent_script')
+        if script:
+            return script[min(step, len(script)-1)]
+        props = _resolve(action_schema, defs).get('properties',{})
+        # アクションの一覧が分からないスキーマでは台本の名前をそのまま使う
+        if step>=int(self._conf('agent_steps')) and ('done' in props or not props):
+            name = 'done'
+        else:
+            names = [ n for n in self._conf('agent_actions') if n in props or not props ] or [ n for n in props if n!='done' ] or ['done']
+            name = names[step%len(names)]
+        params = sample_schema(props[name], defs, rng, name) if name in props else {}
+        if name=='done' and isinstance(params,dict) and 'text' in params:
+            params['text'] = f"fake result at step {step}: {self._filler(rng)[:200]}"
+        return [ {name: params} ]
+
+    def _tool_call(self, messages:list[BaseMessage], tool:dict, rng:random.Random) -> dict:
+        function = tool.get('function',tool)
+        schema:dict = function.get('parameters',{})
+        defs:dict = schema.get('$defs', schema.get('definitions',{}))
+        args = sample_schema(schema, defs, rng)
+        props = schema.get('properties',{})
+        if isinstance(args,dict) and 'action' in props and 'current_state' in props:
+            # エージェントの出力。これまでの応答の数をステップ数とする
+            step = sum( 1 for m in messages if isinstance(m,AIMessage) )
+            items = _resolve(props['action'], defs).get('items',{})
+            args['action'] = self._agent_actions(step, items, defs, rng)
+        return { 'name': function.get('name','tool'), 'args': args, 'id': f"call_{rng.getrandbits(32):08x}" }
+
+    def _content(self, messages:list[BaseMessage], rng:random.Random) -> str:
+        system = " ".join( _text(m) for m in messages if isinstance(m,SystemMessage) )
+        last = _text(messages[-1]) if messages else ""
+        for rule in self._conf('responses'):
+            if re.search(rule['match'], last):
+                return rule['content']
+        if 'information recorder' in system:
+            return json.dumps([{ 'url': 'unknown', 'title': 'fake', 'summary_content': self._filler(rng)[:500], 'thinking': 'fake' }])
+        if m := _SEARCH_RE.search(last):
+            n = int(m.group(1))
+            queries = [ f"fake query {n}-{i+1}" for i in range(int(self._conf('research_queries'))) ] if n<=int(self._conf('research_iterations')) else []
+            return json.dumps({ 'plan': f"fake plan {n}", 'queries': queries })
+        return self._filler(rng)
+
+    def _respond(self, messages:list[BaseMessage], tools:list[dict]|None) -> tuple[AIMessage,float]:
+        """応答と、それを返すまでの時間(秒)"""
+        rng = self._rng(messages, tools)
+        content = ""
+        tool_calls:list[dict] = []
+        if tools:
+            tool_calls.append(self._tool_call(messages, tools[0], rng))
+            output = json.dumps(tool_calls[0]['args'], ensure_ascii=False)
+        else:
+            content = output = self._content(messages, rng)
+        n_in = sum( self._tokens(_text(m)) for m in messages )
+        n_out = self._tokens(output)
+        message = AIMessage(content=content, tool_calls=tool_calls,
+                            usage_metadata={ 'input_tokens': n_in, 'output_tokens': n_out, 'total_tokens': n_in+n_out },
+                            response_metadata={ 'model_name': self.model, 'finish_reason': 'stop' })
+        return message, self._latency(rng, n_out)
+
+    def _latency(self, rng:random.Random, n_out:int) -> float:
+        conf:dict = self._conf('latency') or {}
+        dist = conf.get('dist','fixed')
+        if dist=='uniform':
+            sec = rng.uniform(conf.get('min',0.0), conf.get('max',1.0))
+        elif dist=='normal':
+            sec = rng.gauss(conf.get('mean',1.0), conf.get('sd',0.0))
+        elif dist=='lognormal':
+            sec = conf.get('median',1.0)*math.exp(rng.gauss(0.0, conf.get('sigma',0.5)))
+        else:
+            sec = conf.get('sec',0.0)
+        tail = conf.get('tail')
+        if tail and rng.random()<tail.get('p',0.0):
+            sec *= tail.get('mult',1.0)
+        tps = float(self._conf('tokens_per_sec'))
+        if tps>0:
+            sec += n_out/tps
+        return max(0.0, sec)
+
+    #---------------------------------
+    # BaseChatModel
+    #---------------------------------
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs:Any) -> ChatResult:
+        message, sec = self._respond(messages, kwargs.get('tools'))
+        time.sleep(sec)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs:Any) -> ChatResult:
+        message, sec = self._respond(messages, kwargs.get('tools'))
+        await asyncio.sleep(sec)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, message:AIMessage) -> list[str]:
+        return re.findall(r"\S*\s*", _text(message))[:-1] or [""]
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs:Any) -> Iterator[ChatGenerationChunk]:
+        message, sec = self._respond(messages, kwargs.get('tools'))
+        chunks = self._chunks(message)
+        for i,text in enumerate(chunks):
+            time.sleep(sec/len(chunks))
+            usage = message.usage_metadata if i==len(chunks)-1 else None
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text, usage_metadata=usage))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs:Any) -> AsyncIterator[ChatGenerationChunk]:
+        message, sec = self._respond(messages, kwargs.get('tools'))
+        chunks = self._chunks(message)
+        for i,text in enumerate(chunks):
+            await asyncio.sleep(sec/len(chunks))
+            # 使用量は最後の断片に付ける(OpenAIのstream_usageと同じ)
+            usage = message.usage_metadata if i==len(chunks)-1 else None
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text, usage_metadata=usage))
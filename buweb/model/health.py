@@ -0,0 +1,144 @@
+import time
+import asyncio
+from threading import Lock
+from typing import Any, Awaitable, Callable, Iterable
+from buweb.model.retry import is_rate_limited, model_name
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class ModelHealth:
+    """モデルごとの呼び出し結果の集計"""
+    # 連続してこの回数失敗したら異常とみなす
+    FAIL_THRESHOLD:int = 3
+    # 応答時間の指数移動平均の係数
+    EMA_ALPHA:float = 0.2
+
+    def __init__(self, name:str):
+        self.name:str = name
+        self.calls:int = 0
+        self.failures:int = 0
+        self.throttled:int = 0
+        self.consecutive_failures:int = 0
+        self.latency:float|None = None
+        self.last_call:float = 0.0
+        self.last_ok:float = 0.0
+        self.last_error:str|None = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_failures<self.FAIL_THRESHOLD
+
+    def to_dict(self) -> dict:
+        return {
+            'healthy': self.healthy,
+            'calls': self.calls,
+            'success_rate': round((self.calls-self.failures)/self.calls,3) if self.calls>0 else None,
+            'throttled': self.throttled,
+            'latency': round(self.latency,3) if self.latency is not None else None,
+            'last_ok': self.last_ok,
+            'last_error': self.last_error,
+        }
+
+class HealthMonitor:
+    """実際の呼び出しと時々のプローブでモデルの状態を把握する
+
+    タスクの開始時に毎回LLMを呼んで確認する代わりに、ここの状態を参照する。
+    """
+    # 呼び出しが無いモデルを確認する間隔(秒)
+    PROBE_IDLE_SEC:float = 3*3600.0
+    # 異常なモデルを確認する間隔(秒)。失敗が続くと伸ばす
+    PROBE_RETRY_SEC:float = 60.0
+    PROBE_RETRY_MAX_SEC:float = 1800.0
+    PROBE_TIMEOUT_SEC:float = 30.0
+
+    def __init__(self):
+        self._lock:Lock = Lock()
+        self._models:dict[str,ModelHealth] = {}
+
+    def record(self, name:str, latency:float, ex:BaseException|None=None) -> None:
+        with self._lock:
+            health = self._models.get(name)
+            if health is None:
+                health = self._models[name] = ModelHealth(name)
+            health.calls += 1
+            health.last_call = time.time()
+            if ex is None:
+                health.consecutive_failures = 0
+                health.last_ok = health.last_call
+                a = ModelHealth.EMA_ALPHA
+                health.latency = latency if health.latency is None else (1-a)*health.latency + a*latency
+            elif is_rate_limited(ex):
+                # 混んでいるだけでプロバイダは動いている
+                health.throttled += 1
+            else:
+                health.failures += 1
+                health.consecutive_failures += 1
+                health.last_error = f"{type(ex).__name__}: {str(ex)[:200]}"
+                if health.consecutive_failures==ModelHealth.FAIL_THRESHOLD:
+                    logger.warning(f"{name} is unhealthy: {health.last_error}")
+
+    def is_healthy(self, name:str) -> bool:
+        """異常が続いていなければTrue(まだ呼び出していないモデルもTrue)"""
+        with self._lock:
+            health = self._models.get(name)
+            return health is None or health.healthy
+
+    def _probe_due(self, name:str, now:float) -> bool:
+        with self._lock:
+            health = self._models.get(name)
+            if health is None:
+                return True
+            if health.healthy:
+                return now-health.last_call>self.PROBE_IDLE_SEC
+            n = health.consecutive_failures-ModelHealth.FAIL_THRESHOLD
+            return now-health.last_call>min(self.PROBE_RETRY_MAX_SEC, self.PROBE_RETRY_SEC*(2**n))
+
+    async def run(self, targets:Callable[[],Iterable[str]], probe:Callable[[str],Awaitable[Any]]) -> None:
+        """targets()のモデルのうち、状態が分からないものや異常なものをprobeで確認し続ける"""
+        logger.info("start health monitor")
+        try:
+            while True:
+                for name in set(targets()):
+                    if not self._probe_due(name, time.time()):
+                        continue
+                    t0 = time.monotonic()
+                    try:
+                        await asyncio.wait_for(probe(name), timeout=self.PROBE_TIMEOUT_SEC)
+                    except asyncio.TimeoutError as ex:
+                        self.record(name, time.monotonic()-t0, ex)
+                    except Exception:
+                        # 結果はHealthMixinが記録している
+                        pass
+                await asyncio.sleep(self.PROBE_RETRY_SEC)
+        except asyncio.CancelledError:
+            logger.info("stop health monitor")
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return { name:health.to_dict() for name,health in self._models.items() }
+
+# プロセス内で共有する
+health_monitor:HealthMonitor = HealthMonitor()
+
+class HealthMixin:
+    """キャッシュに当たらずにプロバイダを呼んだ結果をhealth_monitorに記録する"""
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        t0 = time.monotonic()
+        try:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+        except Exception as ex:
+            health_monitor.record(model_name(self), time.monotonic()-t0, ex)
+            raise
+        health_monitor.record(model_name(self), time.monotonic()-t0)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        t0 = time.monotonic()
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+        except Exception as ex:
+            health_monitor.record(model_name(self), time.monotonic()-t0, ex)
+            raise
+        health_monitor.record(model_name(self), time.monotonic()-t0)
+        return result
@@ -0,0 +1,211 @@
+import time
+import asyncio
+from collections import deque
+from threading import Lock
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+from pydantic import ConfigDict
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.outputs import ChatResult
+from langchain_openai import ChatOpenAI
+from langchain_google_genai import ChatGoogleGenerativeAI
+from buweb.model.retry import model_name
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+T = TypeVar('T')
+
+class LatencyWindow:
+    """直近の応答時間からヘッジを始める閾値(p95)を求める"""
+    SIZE:int = 200
+    # これだけ集まるまではDEFAULT_SECを使う
+    MIN_SAMPLES:int = 20
+    DEFAULT_SEC:float = 20.0
+    MIN_SEC:float = 2.0
+
+    def __init__(self):
+        self._samples:deque[float] = deque(maxlen=self.SIZE)
+
+    def add(self, sec:float) -> None:
+        self._samples.append(sec)
+
+    def p95(self) -> float|None:
+        if len(self._samples)<self.MIN_SAMPLES:
+            return None
+        values = sorted(self._samples)
+        return values[min(len(values)-1, int(len(values)*0.95))]
+
+    def threshold(self) -> float:
+        p95 = self.p95()
+        return max(self.MIN_SEC, p95) if p95 is not None else self.DEFAULT_SEC
+
+class HedgeStats:
+    """主モデルと予備モデルの組ごとの集計"""
+    def __init__(self, primary:str, backup:str):
+        self.primary:str = primary
+        self.backup:str = backup
+        self.latency:LatencyWindow = LatencyWindow()
+        self.calls:int = 0
+        self.hedged:int = 0
+        self.failovers:int = 0
+        self.primary_wins:int = 0
+        self.backup_wins:int = 0
+        # 結果を使わずに取り消した呼び出し
+        self.wasted:int = 0
+
+    def to_dict(self) -> dict:
+        p95 = self.latency.p95()
+        return {
+            'primary': self.primary,
+            'backup': self.backup,
+            'calls': self.calls,
+            'hedged': self.hedged,
+            'failovers': self.failovers,
+            'primary_wins': self.primary_wins,
+            'backup_wins': self.backup_wins,
+            'backup_win_rate': round(self.backup_wins/self.hedged,3) if self.hedged>0 else None,
+            'wasted': self.wasted,
+            'p95': round(p95,3) if p95 is not None else None,
+        }
+
+_stats:dict[tuple[str,str],HedgeStats] = {}
+_stats_lock:Lock = Lock()
+
+def get_stats(primary:str, backup:str) -> HedgeStats:
+    with _stats_lock:
+        stats = _stats.get((primary,backup))
+        if stats is None:
+            stats = _stats[(primary,backup)] = HedgeStats(primary, backup)
+        return stats
+
+def get_hedge_status() -> list[dict]:
+    with _stats_lock:
+        return [ stats.to_dict() for stats in _stats.values() ]
+
+async def _cancel(task:asyncio.Future) -> None:
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+async def hedged_call(primary:Callable[[],Awaitable[T]], backup:Callable[[],Awaitable[T]], stats:HedgeStats) -> T:
+    """主モデルを呼び、閾値を過ぎても返らないか失敗したら予備モデルも呼んで先に返った方を使う"""
+    with _stats_lock:
+        stats.calls += 1
+        threshold = stats.latency.threshold()
+    t0 = time.monotonic()
+    first:asyncio.Future[T] = asyncio.ensure_future(primary())
+    second:asyncio.Future[T]|None = None
+    try:
+        await asyncio.wait( [first], timeout=threshold )
+        if first.done() and first.exception() is None:
+            with _stats_lock:
+                stats.latency.add(time.monotonic()-t0)
+                stats.primary_wins += 1
+            return first.result()
+        with _stats_lock:
+            stats.hedged += 1
+            if first.done():
+                stats.failovers += 1
+        logger.info(f"hedge {stats.primary} -> {stats.backup} after {time.monotonic()-t0:.1f}sec")
+        second = asyncio.ensure_future(backup())
+        pending:set[asyncio.Future[T]] = { second } if first.done() else { first, second }
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is not None:
+                    continue
+                with _stats_lock:
+                    if fut is first:
+                        stats.latency.add(time.monotonic()-t0)
+                        stats.primary_wins += 1
+                    else:
+                        # 主モデルはここまでかかった(実際はもっと遅い)として記録する
+                        stats.latency.add(time.monotonic()-t0)
+                        stats.backup_wins += 1
+                    stats.wasted += len(pending)
+                for other in pending:
+                    await _cancel(other)
+                return fut.result()
+        # 両方失敗した
+        raise first.exception() or second.exception() # type: ignore[misc]
+    finally:
+        for fut in (first, second):
+            if fut is not None and not fut.done():
+                await _cancel(fut)
+
+class HedgedRunnable(Runnable):
+    """with_structured_outputなどで作ったRunnableの組をヘッジして呼ぶ"""
+    def __init__(self, primary:Runnable, backup:Runnable, stats:HedgeStats):
+        self.primary:Runnable = primary
+        self.backup:Runnable = backup
+        self.stats:HedgeStats = stats
+
+    def invoke(self, input:Any, config:Optional[RunnableConfig]=None, **kwargs:Any) -> Any:
+        try:
+            return self.primary.invoke(input, config, **kwargs)
+        except Exception as ex:
+            logger.info(f"failover {self.stats.primary} -> {self.stats.backup} {type(ex).__name__}")
+            return self.backup.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input:Any, config:Optional[RunnableConfig]=None, **kwargs:Any) -> Any:
+        return await hedged_call( lambda: self.primary.ainvoke(input, config, **kwargs),
+                                  lambda: self.backup.ainvoke(input, config, **kwargs), self.stats )
+
+def structured_output_kwargs(chat:BaseChatModel, kwargs:dict) -> dict:
+    """モデルごとに構造化出力の方法を選ぶ
+
+    browser_useはOpenAIならfunction_calling、Geminiなら指定なし(methodを渡すとエラーになる)にするので、
+    プロバイダが違うモデルを組み合わせても同じになるようにする。
+    """
+    kw = dict(kwargs)
+    method = kw.pop('method', None)
+    if isinstance(chat, ChatOpenAI):
+        kw['method'] = method or 'function_calling'
+    elif method is not None and not isinstance(chat, ChatGoogleGenerativeAI):
+        kw['method'] = method
+    return kw
+
+class HedgedChatModel(BaseChatModel):
+    """遅い・失敗した呼び出しを別のプロバイダの同等のモデルでヘッジするチャットモデル
+
+    閾値は主モデルの直近の応答時間のp95。非同期の呼び出しだけヘッジし、同期の呼び出しは
+    失敗したときに予備モデルに切り替える。
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True, protected_namespaces=())
+
+    primary: BaseChatModel
+    backup: BaseChatModel
+    model_name: str = ""
+
+    def __init__(self, primary:BaseChatModel, backup:BaseChatModel, **kwargs:Any):
+        super().__init__(primary=primary, backup=backup, model_name=model_name(primary), **kwargs) # type: ignore[call-arg]
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged"
+
+    @property
+    def stats(self) -> HedgeStats:
+        return get_stats(model_name(self.primary), model_name(self.backup))
+
+    def invoke(self, input, config=None, *, stop=None, **kwargs:Any):
+        return HedgedRunnable(self.primary, self.backup, self.stats).invoke(input, config, stop=stop, **kwargs)
+
+    async def ainvoke(self, input, config=None, *, stop=None, **kwargs:Any):
+        return await HedgedRunnable(self.primary, self.backup, self.stats).ainvoke(input, config, stop=stop, **kwargs)
+
+    def bind_tools(self, tools, **kwargs:Any) -> Runnable:
+        return HedgedRunnable(self.primary.bind_tools(tools, **kwargs), self.backup.bind_tools(tools, **kwargs), self.stats)
+
+    def with_structured_output(self, schema, **kwargs:Any) -> Runnable: # type: ignore[override]
+        primary = self.primary.with_structured_output(schema, **structured_output_kwargs(self.primary, kwargs))
+        backup = self.backup.with_structured_output(schema, **structured_output_kwargs(self.backup, kwargs))
+        return HedgedRunnable(primary, backup, self.stats)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs:Any) -> ChatResult:
+        return self.primary._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs:Any) -> ChatResult:
+        return await self.primary._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
@@ -1,8 +1,12 @@
 import os
 os.environ["ANONYMIZED_TELEMETRY"] = "false"
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
+import sqlite3
+from collections import deque
+from threading import Lock, local
+from weakref import WeakKeyDictionary
 import abc
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -18,8 +22,12 @@ from langchain_core.caches import InMemoryCache
 from langchain_community.cache import SQLiteCache
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.rate_limiters import BaseRateLimiter, InMemoryRateLimiter
-from google.api_core.exceptions import ResourceExhausted as GoogleResourceExhausted
-from openai import RateLimitError as OpenaiRateLimitError
+from buweb.model.retry import RetryMixin, in_event_loop
+from buweb.model.health import HealthMixin
+from buweb.model.hedge import HedgedChatModel
+from buweb.model.coalesce import SingleFlightMixin
+from buweb.model.usage import UsageMixin
+from buweb.model.fake import FakeChatModel, load_fake_script
 
 import browser_use.controller.service
 from browser_use import ActionModel, Agent, SystemPrompt, Controller,Browser, BrowserConfig
@@ -40,101 +48,147 @@ logger:Logger = getLogger(__name__)
 
 os.environ["ANONYMIZED_TELEMETRY"] = "false"
 
+class RateLimitExceeded(Exception):
+    """イベントループ上の同期呼び出しで、待たなければ送れないとき"""
+    pass
+
 class CustomRateLimiter(BaseRateLimiter):
-    def __init__(self, requests_per_minute:int, requests_per_day:int, record_file_path:str|None ):
-        self.requests_per_minute = requests_per_minute
-        self.requests_per_day = requests_per_day
-        self.requests_in_day:int = 0
-        self.requests_in_minute:list[float] = []
-        dt = datetime.now().strftime("%Y-%m-%d")
-        self.current_date = dt
-        self.record_file_path = record_file_path
-        if record_file_path and os.path.exists(record_file_path):
-            with open(record_file_path, "r") as fr:
-                aaa = json.load(fr)
-                b = aaa.get(f'requests_in_{dt}',0.0)
-                if isinstance(b,int|float):
-                    self.requests_in_day = int(b)
-                c = aaa.get('requests_in_minute',[])
-                if isinstance(c,list):
-                    self.requests_in_minute = c
-    def _save(self,dt):
-        if self.record_file_path:
-            with open(self.record_file_path, "w") as fr:
-                json.dump( {f'requests_in_{dt}': self.requests_in_day, 'requests_in_minute': self.requests_in_minute},fr)
-
-    def _can_acquire(self) ->bool:
-        dt = datetime.now().strftime("%Y-%m-%d")
-        if dt != self.current_date:
-            self.requests_in_day = 0
-            self.current_date = dt
-        if self.requests_in_day>=self.requests_per_day:
-            print(f"RateLimit: requests per day {self.requests_in_day}/{self.requests_per_day}")
-            return False
+    """1分あたり・1日あたりのリクエスト数を制限するスライディングウィンドウ
+
+    record_file_pathを指定するとSQLiteに記録して、同じファイルを使うプロセス間で上限を共有する。
+    空きが無いときは次に空く時刻まで眠る。ただしイベントループのスレッドからの同期呼び出しは
+    ループを止めないように眠らずにRateLimitExceededを投げる。
+    """
+    WINDOW_SEC:float = 60.0
+
+    def __init__(self, requests_per_minute:int, requests_per_day:int, record_file_path:str|None, *, name:str='default' ):
+        self.requests_per_minute:int = requests_per_minute
+        self.requests_per_day:int = requests_per_day
+        self.record_file_path:str|None = record_file_path
+        self.name:str = name
+        self._lock:Lock = Lock()
+        self._local = local()
+        # プロセス内の記録(record_file_pathが無いとき)
+        self._minute:deque[float] = deque()
+        self._day:str = ''
+        self._day_count:int = 0
+        self._waiting:bool = False
+        if record_file_path:
+            try:
+                with self._conn() as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS rate_minute (name TEXT, ts REAL)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS rate_minute_idx ON rate_minute (name, ts)")
+                    conn.execute("CREATE TABLE IF NOT EXISTS rate_day (name TEXT, day TEXT, count INTEGER, PRIMARY KEY (name, day))")
+            except sqlite3.Error as ex:
+                logger.warning(f"RateLimit: can not use {record_file_path} {str(ex)}")
+                self.record_file_path = None
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに持つ
+        conn = getattr(self._local,'conn',None)
+        if conn is None:
+            assert self.record_file_path is not None
+            conn = sqlite3.connect(self.record_file_path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _next_day(now:float) -> float:
+        tomorrow = datetime.fromtimestamp(now).date() + timedelta(days=1)
+        return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+    def _try_acquire(self) -> float:
+        """取得できれば0、できなければ次に空くまでの秒数を返す"""
         now = time.time()
-        while len(self.requests_in_minute)>0 and now-self.requests_in_minute[0]>60.0:
-            print(f"RateLimit: RPM {len(self.requests_in_minute)}/{self.requests_per_minute}")
-            self.requests_in_minute.pop(0)
-        if len(self.requests_in_minute)>=self.requests_per_minute:
-            return False
-        self.requests_in_day += 1
-        self.requests_in_minute.append(now)
-        self._save(dt)
-        return True
+        day = datetime.fromtimestamp(now).strftime("%Y-%m-%d")
+        with self._lock:
+            if self.record_file_path:
+                try:
+                    return self._try_acquire_db(now, day)
+                except sqlite3.Error as ex:
+                    logger.warning(f"RateLimit: {str(ex)}")
+            return self._try_acquire_mem(now, day)
+
+    def _try_acquire_mem(self, now:float, day:str) -> float:
+        if day!=self._day:
+            self._day = day
+            self._day_count = 0
+        if self._day_count>=self.requests_per_day:
+            return self._next_day(now)-now
+        limit = now-self.WINDOW_SEC
+        while len(self._minute)>0 and self._minute[0]<=limit:
+            self._minute.popleft()
+        over = len(self._minute)-self.requests_per_minute
+        if over>=0:
+            return self._minute[over]+self.WINDOW_SEC-now
+        self._minute.append(now)
+        self._day_count += 1
+        return 0.0
+
+    def _try_acquire_db(self, now:float, day:str) -> float:
+        conn = self._conn()
+        # 他のプロセスと排他して数えて記録する
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM rate_minute WHERE name=? AND ts<=?", (self.name, now-self.WINDOW_SEC))
+            row = conn.execute("SELECT count FROM rate_day WHERE name=? AND day=?", (self.name, day)).fetchone()
+            if row is not None and row[0]>=self.requests_per_day:
+                return self._next_day(now)-now
+            count, = conn.execute("SELECT COUNT(*) FROM rate_minute WHERE name=?", (self.name,)).fetchone()
+            over = count-self.requests_per_minute
+            if over>=0:
+                ts, = conn.execute("SELECT ts FROM rate_minute WHERE name=? ORDER BY ts LIMIT 1 OFFSET ?", (self.name, over)).fetchone()
+                return ts+self.WINDOW_SEC-now
+            conn.execute("INSERT INTO rate_minute VALUES (?,?)", (self.name, now))
+            conn.execute("INSERT INTO rate_day VALUES (?,?,1) ON CONFLICT(name,day) DO UPDATE SET count=count+1", (self.name, day))
+            conn.execute("DELETE FROM rate_day WHERE name=? AND day<>?", (self.name, day))
+            return 0.0
+        except BaseException:
+            # 途中まで反映された更新を残さない
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.execute("COMMIT")
+
+    def _log_wait(self, wait:float) -> None:
+        if not self._waiting:
+            self._waiting = True
+            logger.info(f"RateLimit: {self.name} wait {wait:.1f}sec (RPM {self.requests_per_minute} RPD {self.requests_per_day})")
 
     def acquire(self, *, blocking: bool = True) -> bool:
-        if blocking:
-            while not self._can_acquire():
-                time.sleep(1.0)
-            return True
-        else:
-            return self._can_acquire()
+        while (wait := self._try_acquire())>0.0:
+            if not blocking:
+                return False
+            if in_event_loop():
+                raise RateLimitExceeded(f"RateLimit: {self.name} retry in {wait:.1f}s")
+            self._log_wait(wait)
+            time.sleep(wait)
+        self._waiting = False
+        return True
 
     async def aacquire(self, *, blocking: bool = True) -> bool:
-        if blocking:
-            while not self._can_acquire():
-                await asyncio.sleep(1.0)
-            return True
-        else:
-            return self._can_acquire()
-
-class CustomChatGoogleGenerativeAI(ChatGoogleGenerativeAI):
-
-    def invoke(self,input, config=None, *, stop=None, **kwargs ):
-        i=0
-        msg:str='abc123'
-        while True:
-            i+=1
-            try:
-                return super().invoke(input, config, stop=stop, **kwargs)
-            except GoogleResourceExhausted as ex1:
-                exmsg = f"{ex1}"
-                if exmsg != msg:
-                    print(exmsg)
-                    msg=exmsg
-                else:
-                    print( '*' if i%2==0 else '+',end='')
-                if i>=30:
-                    raise ex1
-                time.sleep(10.0)
-
-    async def ainvoke(self,input, config=None, *, stop=None, **kwargs ):
-        i=0
-        msg:str='abc123'
-        while True:
-            i+=1
-            try:
-                return await super().ainvoke(input, config, stop=stop, **kwargs)
-            except GoogleResourceExhausted as ex1:
-                exmsg = f"{ex1}"
-                if exmsg != msg:
-                    print(exmsg)
-                    msg=exmsg
-                else:
-                    print( '*' if i%2==0 else '+',end='')
-                if i>=30:
-                    raise ex1
-                await asyncio.sleep(10.0)
+        # SQLiteのロック待ちでループを止めないようにスレッドで数える
+        while (wait := await asyncio.to_thread(self._try_acquire))>0.0:
+            if not blocking:
+                return False
+            self._log_wait(wait)
+            await asyncio.sleep(wait)
+        self._waiting = False
+        return True
+
+class CustomChatGoogleGenerativeAI(SingleFlightMixin, RetryMixin, UsageMixin, HealthMixin, ChatGoogleGenerativeAI):
+    pass
+
+class CustomChatOpenAI(SingleFlightMixin, RetryMixin, UsageMixin, HealthMixin, ChatOpenAI):
+    pass
+
+class CustomChatOllama(SingleFlightMixin, RetryMixin, UsageMixin, HealthMixin, ChatOllama):
+    pass
+
+class CustomFakeChatModel(SingleFlightMixin, RetryMixin, UsageMixin, HealthMixin, FakeChatModel):
+    pass
 
 t128k:int = 128000
 t8k:int = 8192
@@ -147,6 +201,8 @@ class LLMProvider(Enum):
     openai = 0
     google = 1
     ollama = 9
+    # ネットワークを使わないベンチマーク用
+    fake = 99
 
 class LLM(Enum):
     Gpt4o = ( "gpt-4o", LLMProvider.openai, t64k )
@@ -169,6 +225,8 @@ class LLM(Enum):
     DeepSeekR1_tool_call_7B = ( "MFDoom/deepseek-r1-tool-calling:7b", LLMProvider.ollama, t64k )
     DeepSeekR1_tool_call_1B = ( "MFDoom/deepseek-r1-tool-calling:1.5b", LLMProvider.ollama, t64k )
 
+    Fake = ( "fake", LLMProvider.fake, t128k )
+
     def __init__(self, value: str, grp:LLMProvider, sz:int):
         self.__value__ = value
         self._full_name:str = value
@@ -181,6 +239,15 @@ class LLM(Enum):
             return LLM.Gpt4oMini
         if llm==LLM.Gemini20Flash or llm==LLM.Gemini20Pro or llm==LLM.Gemini20FlashThink:
             return LLM.Gemini20Flash
+        if llm._grp==LLMProvider.fake:
+            return llm
+        return LLM.Gemini20Flash
+
+    @staticmethod
+    def get_report_model(llm:"LLM") -> "LLM":
+        """タスクの結果からレポートを書くモデル"""
+        if llm._grp==LLMProvider.fake:
+            return llm
         return LLM.Gemini20Flash
 
     @staticmethod
@@ -192,14 +259,101 @@ class LLM(Enum):
                 return llm
         return None
 
+# プロバイダの上限 (RPM, RPD)。無いモデルは制限しない。BUWEB_RATE_LIMITSで変更できる
+RATE_LIMITS:dict[LLM,tuple[int,int]] = {
+    LLM.Gemini20Flash: (10, 1500),
+    LLM.Gemini20FlashThink: (10, 1500),
+    LLM.Gemini20Pro: (2, 50),
+}
+
+def parse_rate_limits(text:str|None) -> dict[LLM,tuple[int,int]]:
+    """RATE_LIMITSに"モデル=RPM/RPD,..."の指定を重ねる("モデル="なら制限しない)"""
+    limits = dict(RATE_LIMITS)
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name,_,value = item.partition('=')
+        llm = LLM.get_llm(name.strip())
+        if llm is None:
+            logger.warning(f"RateLimit: unknown model {name.strip()}")
+            continue
+        if not value.strip():
+            limits.pop(llm,None)
+            continue
+        try:
+            rpm,_,rpd = value.partition('/')
+            limits[llm] = ( int(rpm), int(rpd) )
+        except ValueError:
+            logger.warning(f"RateLimit: invalid limit {item.strip()}")
+    return limits
+# 全セッション(ワーカープロセスを含む)で共有する記録ファイル
+RATELIMITFILE:str = 'ratelimit.db'
+_rate_limit_db:str|None = None
+_rate_limiters:dict[LLM,CustomRateLimiter] = {}
+_rate_limiters_lock:Lock = Lock()
+
+def set_rate_limit_db(path:str|None) -> None:
+    """レート制限の記録ファイルを設定する(プロセスごとに起動時に呼ぶ)"""
+    global _rate_limit_db
+    with _rate_limiters_lock:
+        _rate_limit_db = path
+        _rate_limiters.clear()
+
+def get_rate_limiter(llm:LLM) -> CustomRateLimiter|None:
+    """モデルごとに共有するレートリミッタ"""
+    limits = parse_rate_limits(os.getenv('BUWEB_RATE_LIMITS')).get(llm)
+    if limits is None:
+        return None
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(llm)
+        if limiter is None:
+            rpm,rpd = limits
+            limiter = _rate_limiters[llm] = CustomRateLimiter(rpm, rpd, _rate_limit_db, name=llm._full_name)
+        return limiter
+
+# 作成したモデル。HTTPクライアントはイベントループに結び付くのでループごとに持つ
+_models:"WeakKeyDictionary[asyncio.AbstractEventLoop,dict[tuple,tuple[BaseCache|None,BaseChatModel]]]" = WeakKeyDictionary()
+_models_noloop:dict[tuple,tuple[BaseCache|None,BaseChatModel]] = {}
+_models_lock:Lock = Lock()
+
+def _model_pool() -> dict[tuple,tuple[BaseCache|None,BaseChatModel]]:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _models_noloop
+    pool = _models.get(loop)
+    if pool is None:
+        pool = _models[loop] = {}
+    return pool
+
 def create_model( model:str|LLM,temperature:float=0.0,cache:BaseCache|None=None) -> BaseChatModel:
+    """チャットモデルを返す
+
+    同じモデル・temperature・キャッシュなら、同じイベントループの中で作成済みのものを
+    使い回す(タスクやセッションをまたいでHTTPの接続を再利用する)。
+    """
     llm = LLM.get_llm(model)
+    if llm is None:
+        raise ValueError(f"Invalid model name: {model}")
+    # キャッシュは値にも持たせておくのでidが他のオブジェクトに再利用されることはない
+    key = (llm, temperature, id(cache))
+    with _models_lock:
+        pool = _model_pool()
+        entry = pool.get(key)
+    if entry is None:
+        chat = _new_model(llm, temperature, cache)
+        with _models_lock:
+            entry = pool.setdefault(key, (cache, chat))
+    return entry[1]
+
+def _new_model( llm:LLM, temperature:float, cache:BaseCache|None) -> BaseChatModel:
     if llm:
+        rate_limiter = get_rate_limiter(llm)
         if llm._grp==LLMProvider.openai:
             openai_api_key = os.getenv('OPENAI_API_KEY')
             if not openai_api_key:
                 raise ValueError('OPENAI_API_KEY is not set')
-            return ChatOpenAI(model=llm._full_name, temperature=temperature, cache=cache)
+            return CustomChatOpenAI(model=llm._full_name, temperature=temperature, cache=cache, rate_limiter=rate_limiter, max_retries=0, stream_usage=True)
         elif llm._grp==LLMProvider.google:
             kw = None
             if os.getenv('GEMINI_API_KEY') is not None:
@@ -209,12 +363,50 @@ def create_model( model:str|LLM,temperature:float=0.0,cache:BaseCache|None=None)
             if kw is None:
                 raise ValueError('GEMINI_API_KEY or GOOGLE_API_KEY is not set')
             if llm==LLM.Gemini20FlashThink:
-                return CustomChatGoogleGenerativeAI(model=llm._full_name, cache=cache, api_key=kw)
+                return CustomChatGoogleGenerativeAI(model=llm._full_name, cache=cache, api_key=kw, rate_limiter=rate_limiter, max_retries=1)
             else:
-                return CustomChatGoogleGenerativeAI(model=llm._full_name,temperature=temperature, cache=cache, api_key=kw)
+                return CustomChatGoogleGenerativeAI(model=llm._full_name,temperature=temperature, cache=cache, api_key=kw, rate_limiter=rate_limiter, max_retries=1)
         elif llm._grp==LLMProvider.ollama:
             ollama_url = os.getenv('OLLAMA_HOST')
             if not ollama_url:
                 raise ValueError('OLLAMA_HOST is not set')
-            return ChatOllama(model=llm._full_name, num_ctx=llm._sz, cache=cache)
-    raise ValueError(f"Invalid model name: {model}")
\ No newline at end of file
+            return CustomChatOllama(model=llm._full_name, num_ctx=llm._sz, cache=cache, rate_limiter=rate_limiter)
+        elif llm._grp==LLMProvider.fake:
+            return CustomFakeChatModel(model=llm._full_name, script=load_fake_script(), cache=cache, rate_limiter=rate_limiter)
+    raise ValueError(f"Invalid model name: {llm}")
+
+# ヘッジに使う別のプロバイダの同等のモデル
+HEDGE_MODELS:dict[LLM,LLM] = {
+    LLM.Gemini20Flash: LLM.Gpt4oMini,
+    LLM.Gpt4oMini: LLM.Gemini20Flash,
+    LLM.Gpt4o: LLM.Gemini20Pro,
+    LLM.Gemini20Pro: LLM.Gpt4o,
+}
+
+def create_hedged_model( model:str|LLM,temperature:float=0.0,cache:BaseCache|None=None) -> BaseChatModel:
+    """遅いときや失敗したときに同等のモデルへヘッジするモデル(予備が使えなければ通常のモデル)"""
+    primary = create_model(model, temperature, cache)
+    llm = LLM.get_llm(model)
+    backup_llm = HEDGE_MODELS.get(llm) if llm is not None else None
+    if backup_llm is None:
+        return primary
+    try:
+        backup = create_model(backup_llm, temperature, cache)
+    except ValueError:
+        # APIキーが無いなど
+        return primary
+    return HedgedChatModel(primary, backup)
+
+def tool_calling_method(chat:BaseChatModel) -> str:
+    """エージェントに渡すtool_calling_method
+
+    browser_useはクラス名が'ChatOpenAI'のときだけfunction_callingにするので、サブクラスでも
+    同じになるように指定する。ヘッジするモデルはHedgedChatModelがプロバイダごとに選ぶ。
+    """
+    if isinstance(chat, ChatOpenAI):
+        return 'function_calling'
+    return 'auto'
+
+async def probe_model(name:str|LLM) -> None:
+    """キャッシュを通さずに短い呼び出しをする(結果はhealth_monitorに記録される)"""
+    await create_model(name).ainvoke("ping. Reply with 'ok'.")
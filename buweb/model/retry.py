@@ -0,0 +1,172 @@
+import re
+import time
+import random
+import asyncio
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, ClassVar, TypeVar
+import httpx
+import openai
+from ollama import ResponseError as OllamaResponseError
+from google.api_core import exceptions as google_exceptions
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+T = TypeVar('T')
+
+# 再試行で待つときに呼ばれる (モデル名, 待機秒数, 例外)。タスクごとに設定する
+RetryListener = Callable[[str,float,BaseException],None]
+retry_listener:ContextVar[RetryListener|None] = ContextVar('retry_listener', default=None)
+
+_GOOGLE_RETRY = ( google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+                  google_exceptions.InternalServerError, google_exceptions.DeadlineExceeded )
+_OPENAI_RETRY = ( openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError )
+_RETRY_STATUS:set[int] = { 408, 429, 500, 502, 503, 504 }
+# Geminiのエラーメッセージに含まれる待ち時間
+_RETRY_DELAY_RE = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+_RETRY_IN_RE = re.compile(r"retry in ([0-9.]+)\s*s", re.I)
+
+def is_retryable(ex:BaseException) -> bool:
+    """時間をおけば成功する可能性があるエラーか"""
+    if isinstance(ex, _GOOGLE_RETRY+_OPENAI_RETRY):
+        return True
+    if isinstance(ex, OllamaResponseError):
+        return ex.status_code in _RETRY_STATUS
+    if isinstance(ex, httpx.HTTPStatusError):
+        return ex.response.status_code in _RETRY_STATUS
+    return isinstance(ex, httpx.TransportError)
+
+def is_rate_limited(ex:BaseException) -> bool:
+    """レート制限によるエラーか(プロバイダ自体は動いている)"""
+    if isinstance(ex, (google_exceptions.ResourceExhausted, openai.RateLimitError)):
+        return True
+    if isinstance(ex, OllamaResponseError):
+        return ex.status_code==429
+    if isinstance(ex, httpx.HTTPStatusError):
+        return ex.response.status_code==429
+    return False
+
+def model_name(chat:Any) -> str:
+    """チャットモデルのモデル名"""
+    name = str(getattr(chat,'model_name',None) or getattr(chat,'model',None) or type(chat).__name__)
+    return name.removeprefix('models/')
+
+def _header_delay(headers) -> float|None:
+    if headers is None:
+        return None
+    try:
+        if ms := headers.get('retry-after-ms'):
+            return float(ms)/1000.0
+        if value := headers.get('retry-after'):
+            try:
+                return float(value)
+            except ValueError:
+                return parsedate_to_datetime(value).timestamp()-time.time()
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def retry_after(ex:BaseException) -> float|None:
+    """サーバが指定した待ち時間(秒)"""
+    if isinstance(ex, openai.APIStatusError) or isinstance(ex, httpx.HTTPStatusError):
+        return _header_delay(ex.response.headers)
+    if isinstance(ex, google_exceptions.GoogleAPICallError):
+        for detail in getattr(ex,'details',None) or []:
+            delay = getattr(detail,'retry_delay',None)
+            if delay is not None:
+                if hasattr(delay,'total_seconds'):
+                    return delay.total_seconds()
+                return getattr(delay,'seconds',0) + getattr(delay,'nanos',0)/1e9
+    text = str(ex)
+    m = _RETRY_DELAY_RE.search(text) or _RETRY_IN_RE.search(text)
+    return float(m.group(1)) if m else None
+
+class RetryPolicy:
+    """ジッター付き指数バックオフ。サーバの指定があればそれに従う"""
+    def __init__(self, *, base_delay:float=2.0, max_delay:float=60.0, deadline:float=300.0, max_attempts:int=30):
+        self.base_delay:float = base_delay
+        self.max_delay:float = max_delay
+        self.deadline:float = deadline
+        self.max_attempts:int = max_attempts
+
+    def delay(self, attempt:int, ex:BaseException) -> float:
+        hint = retry_after(ex)
+        if hint is not None:
+            # 同時に待っている呼び出しが一斉に再送しないように少しずらす
+            return max(0.0,hint) + random.uniform(0.0, self.base_delay)
+        cap = min(self.max_delay, self.base_delay * (2**(attempt-1)))
+        return cap/2 + random.uniform(0.0, cap/2)
+
+def _next_wait(policy:RetryPolicy, name:str, attempt:int, ex:Exception, deadline:float) -> float|None:
+    """待機秒数(再試行しないならNone)"""
+    if not is_retryable(ex) or attempt>=policy.max_attempts:
+        return None
+    wait = policy.delay(attempt, ex)
+    if time.monotonic()+wait>deadline:
+        logger.warning(f"{name}: give up retrying {type(ex).__name__} after {attempt} attempts")
+        return None
+    logger.info(f"{name}: {type(ex).__name__} retry in {wait:.1f}sec ({attempt}/{policy.max_attempts})")
+    listener = retry_listener.get()
+    if listener is not None:
+        try:
+            listener(name, wait, ex)
+        except Exception:
+            logger.exception("retry listener failed")
+    return wait
+
+async def aretry(call:Callable[[],Awaitable[T]], *, name:str, policy:RetryPolicy) -> T:
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except Exception as ex:
+            attempt += 1
+            wait = _next_wait(policy, name, attempt, ex, deadline)
+            if wait is None:
+                raise
+        await asyncio.sleep(wait)
+
+def in_event_loop() -> bool:
+    """イベントループのスレッドで呼ばれているか"""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+def retry(call:Callable[[],T], *, name:str, policy:RetryPolicy) -> T:
+    """同期の呼び出しを再試行する
+
+    イベントループのスレッドから呼ばれた場合はループ(同じループの他のセッション)を止めないように
+    待たずにそのまま例外を返す。ループ上ではainvokeを使うこと。
+    """
+    if in_event_loop():
+        return call()
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as ex:
+            attempt += 1
+            wait = _next_wait(policy, name, attempt, ex, deadline)
+            if wait is None:
+                raise
+        time.sleep(wait)
+
+class RetryMixin:
+    """チャットモデルのinvoke/ainvokeを一時的なエラー(レート制限など)で再試行する
+
+    再試行ごとにレートリミッタとキャッシュを通り直すようにinvokeの単位で包む。
+    with_structured_outputなどのバインドも最終的にここを呼ぶ。
+    """
+    retry_policy:ClassVar[RetryPolicy] = RetryPolicy()
+
+    def invoke(self, input, config=None, *, stop=None, **kwargs:Any):
+        return retry( lambda: super(RetryMixin,self).invoke(input, config, stop=stop, **kwargs), # type: ignore[misc]
+                      name=model_name(self), policy=self.retry_policy )
+
+    async def ainvoke(self, input, config=None, *, stop=None, **kwargs:Any):
+        return await aretry( lambda: super(RetryMixin,self).ainvoke(input, config, stop=stop, **kwargs), # type: ignore[misc]
+                             name=model_name(self), policy=self.retry_policy )
@@ -0,0 +1,209 @@
+import time
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, Callable, Iterable
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+from buweb.model.retry import model_name
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+_FIELDS:tuple[str,...] = ('calls','cache_hits','input_tokens','output_tokens','latency')
+
+class UsageStats:
+    """呼び出し回数・キャッシュヒット・トークン数・応答時間の集計"""
+    def __init__(self):
+        self.calls:int = 0
+        self.cache_hits:int = 0
+        self.input_tokens:int = 0
+        self.output_tokens:int = 0
+        # プロバイダを呼んだ時間の合計(秒)
+        self.latency:float = 0.0
+
+    def add(self, input_tokens:int, output_tokens:int, latency:float, cache_hit:bool) -> None:
+        self.calls += 1
+        if cache_hit:
+            self.cache_hits += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.latency += latency
+
+    def to_dict(self) -> dict:
+        return _with_avg({ k:getattr(self,k) for k in _FIELDS })
+
+def _with_avg(d:dict) -> dict:
+    d['latency'] = round(d['latency'],3)
+    n = d['calls']-d['cache_hits']
+    d['avg_latency'] = round(d['latency']/n,3) if n>0 else None
+    return d
+
+class UsageScope:
+    """タスク1回分の使用量。モデル別とステップ別にも集計する
+
+    listenerには集計の全体を渡す。呼び出しが続くときはEMIT_SEC秒に1回にまとめる。
+    """
+    EMIT_SEC:float = 1.0
+
+    def __init__(self, *, step:Callable[[],str]|None=None, listener:Callable[[dict],None]|None=None):
+        self._step:Callable[[],str]|None = step
+        self._listener:Callable[[dict],None]|None = listener
+        self._lock:Lock = Lock()
+        self.total:UsageStats = UsageStats()
+        self.models:dict[str,UsageStats] = {}
+        self.steps:dict[str,UsageStats] = {}
+        self._emitted:float = 0.0
+        self._dirty:bool = False
+
+    def record(self, model:str, input_tokens:int, output_tokens:int, latency:float, cache_hit:bool) -> None:
+        step = self._step() if self._step is not None else None
+        with self._lock:
+            self.total.add(input_tokens, output_tokens, latency, cache_hit)
+            self.models.setdefault(model, UsageStats()).add(input_tokens, output_tokens, latency, cache_hit)
+            if step:
+                self.steps.setdefault(step, UsageStats()).add(input_tokens, output_tokens, latency, cache_hit)
+            self._dirty = True
+            emit = time.monotonic()-self._emitted>=self.EMIT_SEC
+        if emit:
+            self.flush()
+
+    def flush(self) -> None:
+        """まだ送っていない集計をlistenerに渡す"""
+        with self._lock:
+            if not self._dirty or self._listener is None:
+                return
+            self._dirty = False
+            self._emitted = time.monotonic()
+        try:
+            self._listener(self.to_dict())
+        except Exception:
+            logger.exception("usage listener failed")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'total': self.total.to_dict(),
+                'models': { name:stats.to_dict() for name,stats in self.models.items() },
+                'steps': { step:stats.to_dict() for step,stats in self.steps.items() },
+            }
+
+# 実行中のタスクの集計先。タスクごとに設定する
+usage_scope:ContextVar[UsageScope|None] = ContextVar('usage_scope', default=None)
+
+def record_usage(model:str, *, input_tokens:int=0, output_tokens:int=0, latency:float=0.0, cache_hit:bool=False) -> None:
+    scope = usage_scope.get()
+    if scope is not None:
+        scope.record(model, input_tokens, output_tokens, latency, cache_hit)
+
+def merge_usage(items:Iterable[dict]) -> dict:
+    """to_dict()やmerge_usage()の結果を合計する(ステップ別は合計しない)"""
+    total:dict = { k:0 for k in _FIELDS }
+    models:dict[str,dict] = {}
+    for item in items:
+        for k in _FIELDS:
+            total[k] += item['total'].get(k,0)
+        for name,stats in item.get('models',{}).items():
+            m = models.setdefault(name, { k:0 for k in _FIELDS })
+            for k in _FIELDS:
+                m[k] += stats.get(k,0)
+    return {
+        'total': _with_avg(total),
+        'models': { name:_with_avg(m) for name,m in models.items() },
+    }
+
+def message_tokens(message:BaseMessage|None) -> tuple[int,int]:
+    """メッセージのusage_metadataから(入力,出力)トークン数"""
+    usage = getattr(message,'usage_metadata',None)
+    if not usage:
+        return 0,0
+    return int(usage.get('input_tokens') or 0), int(usage.get('output_tokens') or 0)
+
+def result_tokens(result:ChatResult) -> tuple[int,int]:
+    """応答の(入力,出力)トークン数。usage_metadataが無ければllm_outputのtoken_usageを使う"""
+    n_in = n_out = 0
+    for gen in result.generations:
+        i,o = message_tokens(gen.message)
+        n_in += i
+        n_out += o
+    if n_in==0 and n_out==0 and result.llm_output:
+        usage = result.llm_output.get('token_usage') or result.llm_output.get('usage_metadata') or {}
+        n_in = int(usage.get('prompt_tokens') or usage.get('input_tokens') or 0)
+        n_out = int(usage.get('completion_tokens') or usage.get('output_tokens') or 0)
+    return n_in, n_out
+
+class _Call:
+    """キャッシュを通した呼び出し1回分。プロバイダを呼んだらprovider=True"""
+    __slots__ = ('provider',)
+    def __init__(self):
+        self.provider:bool = False
+
+_current_call:ContextVar[_Call|None] = ContextVar('usage_call', default=None)
+
+def _mark_provider() -> None:
+    call = _current_call.get()
+    if call is not None:
+        call.provider = True
+
+class UsageMixin:
+    """キャッシュ・プロバイダのどちらから返った呼び出しもusage_scopeに記録する
+
+    キャッシュを引く_agenerate_with_cacheで包み、その中で_agenerate/_astreamが
+    呼ばれなければキャッシュヒットとして数える。トークン数はプロバイダが返した値を使う。
+    """
+
+    def _record_result(self, result:ChatResult, call:_Call, latency:float) -> None:
+        if call.provider:
+            n_in,n_out = result_tokens(result)
+            record_usage(model_name(self), input_tokens=n_in, output_tokens=n_out, latency=latency)
+        else:
+            record_usage(model_name(self), cache_hit=True)
+
+    def _generate_with_cache(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        call = _Call()
+        token = _current_call.set(call)
+        t0 = time.monotonic()
+        try:
+            result = super()._generate_with_cache(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+        finally:
+            _current_call.reset(token)
+        self._record_result(result, call, time.monotonic()-t0)
+        return result
+
+    async def _agenerate_with_cache(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        call = _Call()
+        token = _current_call.set(call)
+        t0 = time.monotonic()
+        try:
+            result = await super()._agenerate_with_cache(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+        finally:
+            _current_call.reset(token)
+        self._record_result(result, call, time.monotonic()-t0)
+        return result
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        _mark_provider()
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        _mark_provider()
+        return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs:Any):
+        stream = super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs) # type: ignore[misc]
+        if _current_call.get() is not None:
+            # _agenerate_with_cacheの中なのでそちらで記録する
+            _mark_provider()
+            async for chunk in stream:
+                yield chunk
+            return
+        # astreamから直接呼ばれた
+        t0 = time.monotonic()
+        n_in = n_out = 0
+        try:
+            async for chunk in stream:
+                i,o = message_tokens(chunk.message)
+                n_in += i
+                n_out += o
+                yield chunk
+        finally:
+            # 途中で止めた場合もそこまでを記録する
+            record_usage(model_name(self), input_tokens=n_in, output_tokens=n_out, latency=time.monotonic()-t0)
@@ -6,9 +6,9 @@ echo "$ScrDir/$ScrName $*"
 
 display_num="10"
 workdir="$HOME/tmp"
-hosts=""
 cdpport=""
 wsport=""
+headless=""
 
 pid_vnc=""
 pid_ws=""
@@ -46,14 +46,6 @@ while [[ $# -gt 0 ]]; do
       workdir=$2
       shift 2
       ;;
-    --hosts)
-      if [ -z "$2" ]; then
-          echo "ERROR: invalid option hosts $2" >&2
-          exit 5
-      fi
-      hosts=$2
-      shift 2
-      ;;
     --cdpport)
       if [ -z "$2" ]; then
           echo "ERROR: invalid option cdpport $2" >&2
@@ -62,6 +54,10 @@ while [[ $# -gt 0 ]]; do
       cdpport=$2
       shift 2
       ;;
+    --headless)
+      headless="1"
+      shift 1
+      ;;
     --wsport)
       if [ -z "$2" ]; then
           echo "ERROR: invalid option wsport $2" >&2
@@ -112,6 +108,10 @@ CHROME_OPT="$CHROME_OPT --disable-geolocation"
 CHROME_OPT="$CHROME_OPT --disable-gpu --disable-webgl --disable-vulkan --disable-accelerated-layers --enable-unsafe-swiftshader"
 CHROME_OPT="$CHROME_OPT --disable-features=Translate"
 #CHROME_OPT="$CHROME_OPT --enable-strict-powerful-feature-restrictions"
+if [ -n "$headless" ]; then
+    CHROME_OPT="$CHROME_OPT --headless=new"
+    display_num=""
+fi
 if [ -n "$cdpport" ]; then
     CHROME_OPT="$CHROME_OPT --remote-debugging-port=${cdpport}"
 fi
@@ -128,9 +128,6 @@ if [ -n "$workdir" ]; then
     mkdir -p "$workdir"
     BWRAP_OPT="$BWRAP_OPT --bind $workdir $HOME --chdir $HOME"
 fi
-if [ -n "$hosts" ]; then
-    BWRAP_OPT="$BWRAP_OPT --ro-bind $hosts /etc/hosts"
-fi
 if [ -d "$PLAYWRIGHT_DIR" ]; then
     BWRAP_OPT="$BWRAP_OPT --ro-bind $PLAYWRIGHT_DIR $PLAYWRIGHT_DIR"
 fi
@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import zlib
+import struct
+import asyncio
+from importlib.resources import files
+import aiohttp
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+HOSTS_URL:str = "https://raw.githubusercontent.com/StevenBlack/hosts/master/hosts"
+# バイナリ形式: MAGIC + ドメイン数(uint32) + zlib圧縮した改行区切りのドメイン(ソート済み)
+_MAGIC:bytes = b"BWADB1\n"
+_IGNORE:set[str] = { 'localhost', 'localhost.localdomain', 'local', 'broadcasthost', '0.0.0.0', 'ip6-localhost', 'ip6-loopback' }
+
+def parse_hosts(text:str) -> set[str]:
+    """hosts形式(またはドメインだけの行)からブロックするドメインを取り出す"""
+    domains:set[str] = set()
+    for line in text.splitlines():
+        line = line.split('#',1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        for name in (parts[1:] if len(parts)>1 else parts):
+            name = name.strip().lower().rstrip('.')
+            if name and name not in _IGNORE and not name.startswith('ip6-') and '.' in name:
+                domains.add(name)
+    return compact(domains)
+
+def compact(domains:set[str]) -> set[str]:
+    """親ドメインが含まれているサブドメインを除く"""
+    result:set[str] = set()
+    for name in sorted(domains, key=lambda d: d.count('.')):
+        labels = name.split('.')
+        if not any( '.'.join(labels[i:]) in result for i in range(1,len(labels)-1) ):
+            result.add(name)
+    return result
+
+def write_blocklist(path:str, domains:set[str]) -> None:
+    data = zlib.compress('\n'.join(sorted(domains)).encode(), 9)
+    tmp = f"{path}.tmp"
+    with open(tmp,'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<I', len(domains)))
+        f.write(data)
+    os.replace(tmp, path)
+
+def read_blocklist(path:str) -> frozenset[str]:
+    with open(path,'rb') as f:
+        data = f.read()
+    if not data.startswith(_MAGIC):
+        raise ValueError(f"invalid blocklist {path}")
+    count, = struct.unpack_from('<I', data, len(_MAGIC))
+    body = zlib.decompress(data[len(_MAGIC)+4:]).decode()
+    domains = frozenset(body.split('\n')) if body else frozenset()
+    if len(domains)!=count:
+        raise ValueError(f"broken blocklist {path}")
+    return domains
+
+class DomainBlocker:
+    """コンパイル済みのリストでホスト名(とその親ドメイン)を判定する
+
+    ファイルが更新されたら読み直すので、Chromeを再起動せずにルールを入れ替えられる。
+    """
+    CHECK_SEC:float = 30.0
+
+    def __init__(self, path:str):
+        self.path:str = path
+        self._domains:frozenset[str] = frozenset()
+        self._mtime:float = 0.0
+        self._checked:float = 0.0
+        self._reload()
+
+    def _reload(self) -> bool:
+        self._checked = time.time()
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime!=self._mtime:
+                self._domains = read_blocklist(self.path)
+                self._mtime = mtime
+                return True
+        except (OSError, ValueError) as ex:
+            logger.warning(f"can not load blocklist {str(ex)}")
+        return False
+
+    def check(self) -> bool:
+        """CHECK_SECごとにファイルを確認して、読み直したらTrueを返す"""
+        if (time.time()-self._checked)>self.CHECK_SEC:
+            return self._reload()
+        return False
+
+    def __len__(self) -> int:
+        return len(self._domains)
+
+    @property
+    def domains(self) -> frozenset[str]:
+        return self._domains
+
+    def is_blocked(self, host:str) -> bool:
+        self.check()
+        labels = host.lower().rstrip('.').split('.')
+        domains = self._domains
+        for i in range(len(labels)-1):
+            if '.'.join(labels[i:]) in domains:
+                return True
+        return False
+
+def blocked_url_patterns(domains:frozenset[str]|set[str]) -> list[str]:
+    """Network.setBlockedURLsのパターン(ドメインとそのサブドメイン)"""
+    patterns:list[str] = []
+    for name in sorted(domains):
+        patterns.append(f"*://{name}/*")
+        patterns.append(f"*.{name}/*")
+    return patterns
+
+class CdpAdBlocker:
+    """ChromeのCDPに常駐して全てのターゲットにNetwork.setBlockedURLsを設定する
+
+    ブラウザに自動アタッチしてページ・iframe・ワーカーが開くたびに(実行を始める前に)設定する。
+    判定はChromeの中で行うのでリクエストがPythonを通らず、HTTPキャッシュもそのまま使える。
+    タスクの有無に関わらずChromeが動いている間は有効で、リストが更新されたら設定し直す。
+    """
+    RECONNECT_SEC:float = 2.0
+    # ブロックするURLを設定するターゲット
+    TARGET_TYPES:set[str] = { 'page', 'iframe', 'worker', 'shared_worker', 'service_worker' }
+
+    def __init__(self, blocker:DomainBlocker, cdp_port:int):
+        self._blocker:DomainBlocker = blocker
+        self.cdp_port:int = cdp_port
+        self._task:asyncio.Task|None = None
+        self._ws:aiohttp.ClientWebSocketResponse|None = None
+        self._seq:int = 0
+        self._sessions:set[str] = set()
+        self._params:str = ''
+        self._params_domains:frozenset[str]|None = None
+        self.blocked:int = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self.blocked>0:
+            logger.info(f"cdp:{self.cdp_port} blocked {self.blocked} requests")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._connect()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.debug(f"cdp:{self.cdp_port} adblock reconnect {str(ex)}")
+            finally:
+                self._ws = None
+                self._sessions.clear()
+            await asyncio.sleep(self.RECONNECT_SEC)
+
+    async def _connect(self) -> None:
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=5)
+        async with aiohttp.ClientSession(timeout=timeout) as http:
+            async with http.get(f"http://127.0.0.1:{self.cdp_port}/json/version") as response:
+                info = await response.json(content_type=None)
+            async with http.ws_connect(info['webSocketDebuggerUrl'], max_msg_size=0, heartbeat=30.0) as ws:
+                self._ws = ws
+                await self._update_params()
+                # 既存のターゲットにもアタッチし、新しいターゲットは実行前に止めてもらう
+                await self._send('Target.setAutoAttach', '{"autoAttach":true,"waitForDebuggerOnStart":true,"flatten":true}')
+                check = asyncio.create_task(self._watch_list())
+                try:
+                    async for msg in ws:
+                        if msg.type==aiohttp.WSMsgType.TEXT:
+                            await self._on_message(json.loads(msg.data))
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+                finally:
+                    check.cancel()
+
+    async def _update_params(self) -> None:
+        # 大きいのでリストが変わったときだけスレッドでJSONにしておく
+        domains = self._blocker.domains
+        if domains is not self._params_domains:
+            self._params = await asyncio.to_thread(lambda: json.dumps({'urls': blocked_url_patterns(domains)}))
+            self._params_domains = domains
+
+    async def _watch_list(self) -> None:
+        """リストが更新されたらアタッチ中のターゲットに設定し直す"""
+        while True:
+            await asyncio.sleep(DomainBlocker.CHECK_SEC)
+            if await asyncio.to_thread(self._blocker.check):
+                await self._update_params()
+                for session_id in list(self._sessions):
+                    await self._send('Network.setBlockedURLs', self._params, session_id)
+
+    async def _send(self, method:str, params:str='{}', session_id:str|None=None) -> None:
+        if self._ws is None:
+            return
+        self._seq += 1
+        sid = f',"sessionId":{json.dumps(session_id)}' if session_id else ''
+        await self._ws.send_str(f'{{"id":{self._seq},"method":"{method}","params":{params}{sid}}}')
+
+    async def _on_message(self, msg:dict) -> None:
+        method = msg.get('method')
+        params = msg.get('params') or {}
+        if method=='Target.attachedToTarget':
+            session_id = params['sessionId']
+            if params.get('targetInfo',{}).get('type') in self.TARGET_TYPES:
+                self._sessions.add(session_id)
+                # Network.enableしないとブロックされない。コマンドは順に処理されるので再開前に効く
+                await self._send('Network.enable', '{"maxTotalBufferSize":0,"maxResourceBufferSize":0}', session_id)
+                await self._send('Network.setBlockedURLs', self._params, session_id)
+                # 別プロセスのiframeやワーカーにもアタッチする
+                await self._send('Target.setAutoAttach', '{"autoAttach":true,"waitForDebuggerOnStart":true,"flatten":true}', session_id)
+            if params.get('waitingForDebugger'):
+                await self._send('Runtime.runIfWaitingForDebugger', '{}', session_id)
+        elif method=='Target.detachedFromTarget':
+            self._sessions.discard(params.get('sessionId'))
+        elif method=='Network.loadingFailed':
+            if params.get('blockedReason')=='inspector':
+                self.blocked += 1
+
+_blockers:dict[str,DomainBlocker] = {}
+
+def get_blocker(path:str|None) -> DomainBlocker|None:
+    """プロセス内で共有するDomainBlocker"""
+    if not path or not os.path.exists(path):
+        return None
+    blocker = _blockers.get(path)
+    if blocker is None:
+        blocker = _blockers[path] = DomainBlocker(path)
+    return blocker
+
+class BlockListUpdater:
+    """ブロックリストをダウンロードしてコンパイルする
+
+    条件付きリクエスト(ETag/If-Modified-Since)で変更が無ければダウンロードしない。
+    ファイルが無ければ同梱のリストから作る。
+    """
+    REFRESH_SEC:float = 3600.0
+    RETRY_SEC:float = 300.0
+
+    def __init__(self, path:str, url:str=HOSTS_URL):
+        self.path:str = path
+        self.url:str = url
+        self._meta_path:str = f"{path}.json"
+        self._meta:dict = {}
+        try:
+            with open(self._meta_path) as f:
+                self._meta = json.load(f)
+        except (OSError, ValueError):
+            self._meta = {}
+        self._next:float = self._meta.get('checked',0.0) + self.REFRESH_SEC
+        if not os.path.exists(self.path):
+            self._install_seed()
+
+    def _install_seed(self) -> None:
+        try:
+            text = files('buweb.data').joinpath('adblock_seed.txt').read_text()
+            write_blocklist(self.path, parse_hosts(text))
+            self._meta = {}
+        except Exception:
+            logger.exception("can not install adblock seed")
+
+    def _save_meta(self) -> None:
+        tmp = f"{self._meta_path}.tmp"
+        with open(tmp,'w') as f:
+            json.dump(self._meta, f)
+        os.replace(tmp, self._meta_path)
+
+    async def refresh(self) -> float:
+        """期限が来ていれば更新して、次に確認する時刻を返す"""
+        now = time.time()
+        if now<self._next:
+            return self._next
+        self._next = now + self.RETRY_SEC
+        headers:dict[str,str] = {}
+        if os.path.exists(self.path):
+            if self._meta.get('etag'):
+                headers['If-None-Match'] = self._meta['etag']
+            if self._meta.get('last_modified'):
+                headers['If-Modified-Since'] = self._meta['last_modified']
+        try:
+            timeout = aiohttp.ClientTimeout(total=30)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(self.url, headers=headers) as response:
+                    if response.status==304:
+                        logger.info("adblock list not modified")
+                    elif response.status==200:
+                        text = await response.text(errors='ignore')
+                        domains = await asyncio.to_thread(parse_hosts, text)
+                        await asyncio.to_thread(write_blocklist, self.path, domains)
+                        self._meta['etag'] = response.headers.get('ETag')
+                        self._meta['last_modified'] = response.headers.get('Last-Modified')
+                        logger.info(f"adblock list updated {len(domains)} domains")
+                    else:
+                        logger.warning(f"adblock list download failed: HTTP {response.status}")
+                        return self._next
+            self._meta['checked'] = now
+            await asyncio.to_thread(self._save_meta)
+            self._next = now + self.REFRESH_SEC
+        except Exception as ex:
+            logger.warning(f"adblock list download failed: {str(ex)}")
+        return self._next
+
+    def get_status(self) -> dict:
+        blocker = get_blocker(self.path)
+        return {
+            'domains': len(blocker) if blocker is not None else 0,
+            'checked': self._meta.get('checked',0.0),
+            'etag': self._meta.get('etag'),
+        }
@@ -0,0 +1,63 @@
+import asyncio
+from asyncio import AbstractEventLoop, Future
+from collections import deque
+from threading import Lock
+from typing import Generic, TypeVar
+
+T = TypeVar('T')
+
+def _wakeup(fut:Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+class MsgChannel(Generic[T]):
+    """任意のスレッドから書き込み、イベントループ上でポーリングせずに待ち受けるチャネル"""
+
+    def __init__(self, maxlen:int|None=None):
+        self._lock:Lock = Lock()
+        self._items:deque[T] = deque(maxlen=maxlen)
+        self._waiters:list[tuple[AbstractEventLoop,Future]] = []
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item:T) -> None:
+        """メッセージを追加して待っているループを起こす(スレッドセーフ)"""
+        with self._lock:
+            self._items.append(item)
+            waiters = self._waiters
+            self._waiters = []
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for loop,fut in waiters:
+            if current is loop:
+                _wakeup(fut)
+            else:
+                try:
+                    loop.call_soon_threadsafe(_wakeup, fut)
+                except RuntimeError:
+                    # ループが既に閉じている
+                    pass
+
+    def get_nowait(self) -> T|None:
+        with self._lock:
+            return self._items.popleft() if self._items else None
+
+    async def get(self, timeout:float|None=None) -> T|None:
+        """メッセージを取り出す。timeout秒以内に届かなければNoneを返す"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._items:
+                return self._items.popleft()
+            fut:Future = loop.create_future()
+            self._waiters.append((loop,fut))
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._waiters = [ w for w in self._waiters if w[1] is not fut ]
+        return self.get_nowait()
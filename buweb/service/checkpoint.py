@@ -0,0 +1,81 @@
+import os
+import json
+import time
+from threading import Lock
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+CHECKPOINT_FILE:str = 'checkpoint.json'
+# タスクごとに入れ替える項目
+_TASK_KEYS:tuple[str,...] = ('mode','prompt','llm','plan_llm','running','operator','research','storage_state')
+
+class Checkpoint:
+    """セッションの作業状態を作業ディレクトリに保存する
+
+    タスクの指示、エージェントの進捗、deep researchの収集結果、Chromeのstorage state
+    を持ち、サーバ再起動後にセッションを復元してタスクを途中から再開するのに使う。
+    updateはどのスレッドからでも呼べる(ファイルに書くのでループ上では呼ばないこと)。
+    """
+    def __init__(self, workdir:str):
+        self.path:str = os.path.join(workdir, CHECKPOINT_FILE)
+        self._lock:Lock = Lock()
+        self.data:dict = {}
+
+    def load(self) -> bool:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        with self._lock:
+            self.data = data
+        return True
+
+    def update(self, data:dict) -> None:
+        """項目を更新して保存する"""
+        with self._lock:
+            self.data.update(data)
+            self._write()
+
+    def start_task(self, data:dict) -> None:
+        """新しいタスクの状態で置き換える"""
+        with self._lock:
+            for key in _TASK_KEYS:
+                self.data.pop(key,None)
+            self.data.update(data)
+            self.data['running'] = True
+            self._write()
+
+    def _write(self) -> None:
+        self.data['updated'] = time.time()
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp,'w') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except (OSError, TypeError, ValueError) as ex:
+            logger.warning(f"can not write checkpoint {self.path} {str(ex)}")
+
+    @property
+    def resumable(self) -> bool:
+        """中断されたタスクが残っているか"""
+        return bool(self.data.get('running')) and bool(self.data.get('prompt'))
+
+def scan_checkpoints(sessions_dir:str, max_age_sec:float) -> dict[str,str]:
+    """再開できるセッションを探す(セッションID -> 作業ディレクトリ)"""
+    result:dict[str,str] = {}
+    try:
+        names = os.listdir(sessions_dir)
+    except OSError:
+        return result
+    now = time.time()
+    for name in names:
+        if not name.startswith('session_'):
+            continue
+        path = os.path.join(sessions_dir, name, CHECKPOINT_FILE)
+        try:
+            if (now-os.path.getmtime(path))<=max_age_sec:
+                result[name[len('session_'):]] = os.path.join(sessions_dir, name)
+        except OSError:
+            continue
+    return result
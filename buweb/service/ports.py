@@ -0,0 +1,171 @@
+import os, re
+import socket
+from collections import deque
+from dataclasses import dataclass
+from threading import Lock
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class NoAvailablePortException(Exception):
+    pass
+
+@dataclass(frozen=True)
+class PortLease:
+    """セッションに貸し出すディスプレイ番号とポートの組"""
+    display_num:int
+    vnc_port:int
+    ws_port:int
+    cdp_port:int
+
+def is_port_available(port: int) -> bool:
+    """指定されたポートが使用可能かチェック"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('localhost', port))
+            return True
+    except (socket.error, OSError):
+        return False
+
+def is_display_available(num:int) -> bool:
+    """Xのロックファイルとソケットが残っていないかチェック"""
+    return not os.path.exists(f"/tmp/.X{num}-lock") and not os.path.exists(f"/tmp/.X11-unix/X{num}")
+
+class PortAllocator:
+    """ディスプレイ番号とポートを払い出す
+
+    空き番号はdequeで管理するので払い出しと返却はO(1)。
+    払い出し中の番号は他のセッションに渡らないので同時起動でも衝突しない。
+    """
+    VNC_BASE:int = 5900
+
+    def __init__(self, *, displays:range=range(10,100), ws_ports:range=range(5030,5100), cdp_ports:range=range(9222,9322)):
+        self._lock:Lock = Lock()
+        self._free_displays:deque[int] = deque(displays)
+        self._free_ws:deque[int] = deque(ws_ports)
+        self._free_cdp:deque[int] = deque(cdp_ports)
+        self._leases:dict[str,PortLease] = {}
+        # 前回起動時から残っているプロセスが使っている番号 pid -> (display,ws,cdp)
+        self._recovered:dict[int,tuple[int|None,int|None,int|None]] = {}
+
+    def _take(self, free:deque[int], check) -> int:
+        # 外部プロセスが使っている番号は後ろに回す
+        for _ in range(len(free)):
+            num = free.popleft()
+            if check(num):
+                return num
+            free.append(num)
+        raise NoAvailablePortException()
+
+    def lease(self, owner:str) -> PortLease:
+        """ownerにディスプレイ番号とポートを割り当てる(割り当て済みなら同じものを返す)"""
+        with self._lock:
+            lease = self._leases.get(owner)
+            if lease is not None:
+                return lease
+            display_num:int|None = None
+            ws_port:int|None = None
+            try:
+                display_num = self._take(self._free_displays, lambda n: is_display_available(n) and is_port_available(self.VNC_BASE+n))
+                ws_port = self._take(self._free_ws, is_port_available)
+                cdp_port = self._take(self._free_cdp, is_port_available)
+            except NoAvailablePortException:
+                if display_num is not None:
+                    self._free_displays.appendleft(display_num)
+                if ws_port is not None:
+                    self._free_ws.appendleft(ws_port)
+                raise
+            lease = PortLease(display_num, self.VNC_BASE+display_num, ws_port, cdp_port)
+            self._leases[owner] = lease
+            logger.info(f"[{owner}] lease display:{lease.display_num} vnc:{lease.vnc_port} ws:{lease.ws_port} cdp:{lease.cdp_port}")
+            return lease
+
+    def get(self, owner:str) -> PortLease|None:
+        with self._lock:
+            return self._leases.get(owner)
+
+    def release(self, owner:str) -> None:
+        """ownerに割り当てた番号を返却する"""
+        with self._lock:
+            lease = self._leases.pop(owner,None)
+            if lease is not None:
+                self._free_displays.append(lease.display_num)
+                self._free_ws.append(lease.ws_port)
+                self._free_cdp.append(lease.cdp_port)
+                logger.info(f"[{owner}] release display:{lease.display_num} vnc:{lease.vnc_port} ws:{lease.ws_port} cdp:{lease.cdp_port}")
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                'leases': len(self._leases),
+                'recovered': len(self._recovered),
+                'free_displays': len(self._free_displays),
+                'free_ws': len(self._free_ws),
+                'free_cdp': len(self._free_cdp),
+            }
+
+    def recover(self) -> None:
+        """起動時に残っているXvnc/websockify/chromeのプロセスから使用中の番号を回収する"""
+        for pid,cmdline in _scan_procs():
+            display_num:int|None = None
+            ws_port:int|None = None
+            cdp_port:int|None = None
+            if cmdline[0].endswith('Xvnc') and len(cmdline)>1:
+                m = re.fullmatch(r':(\d+)', cmdline[1])
+                display_num = int(m.group(1)) if m else None
+            elif any( arg.endswith('websockify') for arg in cmdline[:2] ):
+                for arg in cmdline:
+                    m = re.fullmatch(r'0\.0\.0\.0:(\d+)', arg)
+                    if m:
+                        ws_port = int(m.group(1))
+                        break
+            else:
+                for arg in cmdline:
+                    m = re.fullmatch(r'--remote-debugging-port=(\d+)', arg)
+                    if m:
+                        cdp_port = int(m.group(1))
+                        break
+            if display_num is None and ws_port is None and cdp_port is None:
+                continue
+            with self._lock:
+                if display_num in self._free_displays:
+                    self._free_displays.remove(display_num)
+                if ws_port in self._free_ws:
+                    self._free_ws.remove(ws_port)
+                if cdp_port in self._free_cdp:
+                    self._free_cdp.remove(cdp_port)
+                self._recovered[pid] = (display_num,ws_port,cdp_port)
+            logger.info(f"recover pid:{pid} display:{display_num} ws:{ws_port} cdp:{cdp_port}")
+
+    def reap(self) -> None:
+        """回収したプロセスが終了していたら番号を空きに戻す"""
+        with self._lock:
+            dead = [ pid for pid in self._recovered if not os.path.exists(f"/proc/{pid}") ]
+            if not dead:
+                return
+            released = [ self._recovered.pop(pid) for pid in dead ]
+            # 同じ番号を使っているプロセスが残っていれば戻さない
+            alive = set( num for nums in self._recovered.values() for num in nums if num is not None )
+            for display_num,ws_port,cdp_port in released:
+                if display_num is not None and display_num not in alive and display_num not in self._free_displays:
+                    self._free_displays.append(display_num)
+                if ws_port is not None and ws_port not in alive and ws_port not in self._free_ws:
+                    self._free_ws.append(ws_port)
+                if cdp_port is not None and cdp_port not in alive and cdp_port not in self._free_cdp:
+                    self._free_cdp.append(cdp_port)
+
+def _scan_procs():
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return
+    mypid = os.getpid()
+    for name in names:
+        if not name.isdigit() or int(name)==mypid:
+            continue
+        try:
+            with open(f"/proc/{name}/cmdline","rb") as f:
+                args = [ a.decode(errors='ignore') for a in f.read().split(b'\0') if a ]
+        except OSError:
+            continue
+        if args:
+            yield int(name), args
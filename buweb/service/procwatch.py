@@ -0,0 +1,125 @@
+import os
+import signal
+import subprocess
+import asyncio
+from asyncio import AbstractEventLoop
+from threading import Thread
+from typing import Callable
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class ProcWatcher:
+    """子プロセスの終了をpidfdで監視してコールバックする
+
+    pidfdが使えない環境では待ち受け用のスレッドでwaitする。
+    コールバックはbindしたイベントループ上で呼ばれる。
+    """
+    def __init__(self):
+        self._loop:AbstractEventLoop|None = None
+
+    def bind(self, loop:AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def watch(self, proc:subprocess.Popen, callback:Callable[[subprocess.Popen],None]) -> None:
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            self._watch_thread(proc, callback)
+            return
+        try:
+            fd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            self._watch_thread(proc, callback)
+            return
+        loop.call_soon_threadsafe(self._add_reader, loop, fd, proc, callback)
+
+    def _add_reader(self, loop:AbstractEventLoop, fd:int, proc:subprocess.Popen, callback:Callable[[subprocess.Popen],None]) -> None:
+        try:
+            loop.add_reader(fd, self._on_exit, loop, fd, proc, callback)
+        except Exception:
+            os.close(fd)
+            self._watch_thread(proc, callback)
+
+    def _on_exit(self, loop:AbstractEventLoop, fd:int, proc:subprocess.Popen, callback:Callable[[subprocess.Popen],None]) -> None:
+        loop.remove_reader(fd)
+        os.close(fd)
+        proc.poll()  # 回収する
+        self._call(callback, proc)
+
+    def _watch_thread(self, proc:subprocess.Popen, callback:Callable[[subprocess.Popen],None]) -> None:
+        def wait():
+            try:
+                proc.wait()
+            except Exception:
+                pass
+            loop = self._loop
+            if loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(self._call, callback, proc)
+            else:
+                self._call(callback, proc)
+        Thread(target=wait, name=f"procwatch-{proc.pid}", daemon=True).start()
+
+    def _call(self, callback:Callable[[subprocess.Popen],None], proc:subprocess.Popen) -> None:
+        try:
+            callback(proc)
+        except Exception:
+            logger.exception(f"error in exit callback pid:{proc.pid}")
+
+async def wait_proc(proc:subprocess.Popen, timeout:float|None) -> bool:
+    """ループを止めずにプロセスの終了を待つ。timeout秒以内に終了すればTrue"""
+    if proc.poll() is not None:
+        return True
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        def wait():
+            try:
+                proc.wait(timeout)
+                return True
+            except subprocess.TimeoutExpired:
+                return False
+        return await asyncio.to_thread(wait)
+    fut:asyncio.Future = loop.create_future()
+    def on_exit():
+        if not fut.done():
+            fut.set_result(None)
+    try:
+        loop.add_reader(fd, on_exit)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return proc.poll() is not None
+        finally:
+            loop.remove_reader(fd)
+    finally:
+        os.close(fd)
+    proc.poll()  # 回収する
+    return True
+
+def signal_group(pgid:int, sig:int) -> bool:
+    """プロセスグループにシグナルを送る。グループが無ければFalse"""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+async def stop_group(proc:subprocess.Popen, *, timeout:float=0.5) -> None:
+    """start_new_sessionで起動したプロセスのグループ全体にSIGTERMを送り、
+    timeout秒以内に終わらなければSIGKILLする"""
+    pgid = proc.pid
+    if not signal_group(pgid, signal.SIGTERM):
+        proc.poll()
+        return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    await wait_proc(proc, timeout)
+    # リーダー以外(Xvnc,websockify,chromeの子プロセス)の終了を待つ
+    while signal_group(pgid, 0) and loop.time()<deadline:
+        await asyncio.sleep(0.02)
+    if signal_group(pgid, 0):
+        logger.warning(f"process group {pgid} did not stop, kill")
+        signal_group(pgid, signal.SIGKILL)
+        await wait_proc(proc, 1.0)
@@ -0,0 +1,193 @@
+import os
+import time
+import shutil
+import subprocess
+import asyncio
+from importlib.resources import files
+from buweb.service.ports import PortAllocator, NoAvailablePortException, is_port_available
+from buweb.service.procwatch import stop_group
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+# 起動中にだけ意味を持つファイル(テンプレートには残さない)
+_VOLATILE:set[str] = { 'SingletonLock', 'SingletonSocket', 'SingletonCookie', 'Crashpad', 'Crash Reports', 'Sessions', 'Current Session', 'Current Tabs', 'Last Session', 'Last Tabs' }
+# ユーザーデータディレクトリ(.config/<browser>)の中でプロファイルごとに書き換えるディレクトリ
+_PROFILE_DIRS:set[str] = { 'Default', 'System Profile', 'Guest Profile' }
+
+def is_shared(rel:str) -> bool:
+    """テンプレートからの相対パスのファイルをセッション間でハードリンクで共有するか
+
+    コンポーネント(.config/<browser>/の下のプロファイル以外)とフォントキャッシュは
+    バージョンごとのディレクトリに置き換えで更新され、ファイルを直接書き換えない。
+    """
+    parts = rel.split(os.sep)
+    if len(parts)>=3 and parts[0]=='.cache' and parts[1]=='fontconfig':
+        return True
+    # .config/<browser>/<dir>/... (直下のLocal Stateなどのファイルは除く)
+    if len(parts)>=4 and parts[0]=='.config':
+        return parts[2] not in _PROFILE_DIRS and not parts[2].startswith('Profile ')
+    return False
+
+class ProfileTemplate:
+    """初期化済みのChromeプロファイルのテンプレート
+
+    一度だけheadlessのChromeを起動して初回起動処理(Local State、コンポーネント、
+    フォントキャッシュ等)を済ませたホームディレクトリを作っておき、
+    セッションの作業ディレクトリ(bwrapで$HOMEになる)へreflinkでコピーする。
+    reflinkが使えないファイルシステムでは、コンポーネントとフォントキャッシュを
+    ハードリンクで共有し、残り(プロファイル)だけをコピーする。
+    """
+    # この時間を過ぎたテンプレートは作り直す(コンポーネントの更新のため)
+    MAX_AGE_SEC:float = 7*24*3600.0
+    # CDPが有効になってから初期化を待つ時間
+    WARMUP_SEC:float = 8.0
+    # 作成に失敗したら、この間隔から倍々に延ばして(RETRY_MAX_SECまで)作り直す
+    RETRY_MIN_SEC:float = 60.0
+    RETRY_MAX_SEC:float = 6*3600.0
+
+    def __init__(self, base_dir:str, ports:PortAllocator):
+        self.base_dir:str = os.path.abspath(base_dir)
+        self.home:str = os.path.join(self.base_dir,'home')
+        self._stamp:str = os.path.join(self.base_dir,'ready')
+        self._ports:PortAllocator = ports
+        self._lock:asyncio.Lock = asyncio.Lock()
+        self._clones:int = 0
+        self._clone_sec:float = 0.0
+        # reflinkが使えるか(Noneは未確認)
+        self._reflink:bool|None = None
+        # 連続して失敗した回数と次に作り直してよい時刻
+        self._failures:int = 0
+        self._retry_at:float = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return os.path.exists(self._stamp) and os.path.isdir(self.home)
+
+    def is_stale(self) -> bool:
+        return not self.ready or (time.time()-os.path.getmtime(self._stamp))>self.MAX_AGE_SEC
+
+    def needs_build(self) -> bool:
+        """作り直すべきか(失敗した後は間隔をあける)"""
+        return self.is_stale() and time.time()>=self._retry_at
+
+    async def prepare(self) -> None:
+        """テンプレートが無いか古ければ作る"""
+        async with self._lock:
+            if not self.needs_build():
+                return
+            try:
+                ok = await self._build()
+            except Exception:
+                logger.exception("can not build profile template")
+                ok = False
+            if ok:
+                self._failures = 0
+                self._retry_at = 0.0
+            else:
+                delay = min(self.RETRY_MIN_SEC*(2**self._failures), self.RETRY_MAX_SEC)
+                self._failures += 1
+                self._retry_at = time.time()+delay
+                logger.warning(f"retry profile template after {delay:.0f}sec")
+
+    async def _build(self) -> bool:
+        work = self.base_dir + '.tmp'
+        await asyncio.to_thread(shutil.rmtree, work, True)
+        os.makedirs(work)
+        owner = 'profile-template'
+        try:
+            cdp_port = self._ports.lease(owner).cdp_port
+        except NoAvailablePortException:
+            logger.warning("no port for profile template")
+            return False
+        proc:subprocess.Popen|None = None
+        try:
+            script_path = str(files('buweb.scripts').joinpath('start_browser.sh'))
+            proc = subprocess.Popen( [ script_path, "--headless", "--workdir", work, "--cdpport", str(cdp_port) ],
+                                     cwd=work, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True )
+            exit_sec = time.time() + 30.0
+            # ChromeがCDPのポートをlistenするまで待つ
+            while is_port_available(cdp_port):
+                if proc.poll() is not None or time.time()>exit_sec:
+                    logger.warning("can not start chrome for profile template")
+                    return False
+                await asyncio.sleep(0.2)
+            await asyncio.sleep(self.WARMUP_SEC)
+        finally:
+            if proc is not None:
+                # SIGTERMで終了させてプロファイルを書き出させる
+                await stop_group(proc, timeout=5.0)
+            self._ports.release(owner)
+        await asyncio.to_thread(self._install, work)
+        logger.info(f"profile template ready {self.home}")
+        return True
+
+    def _install(self, work:str) -> None:
+        for root,dirs,names in os.walk(work):
+            for name in list(dirs):
+                if name in _VOLATILE:
+                    shutil.rmtree(os.path.join(root,name), ignore_errors=True)
+                    dirs.remove(name)
+            for name in names:
+                path = os.path.join(root,name)
+                if name in _VOLATILE:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif is_shared(os.path.relpath(path,work)) and not os.path.islink(path):
+                    # ハードリンクしたセッションから書き換えられないようにする
+                    os.chmod(path, os.stat(path).st_mode & ~0o222)
+        old = self.base_dir + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.base_dir):
+            os.rename(self.base_dir, old)
+        os.makedirs(self.base_dir)
+        os.rename(work, self.home)
+        with open(self._stamp,'w') as f:
+            f.write(str(time.time()))
+        shutil.rmtree(old, ignore_errors=True)
+
+    async def clone_into(self, workdir:str) -> bool:
+        """テンプレートを作業ディレクトリにコピーする(対応していればreflink、無ければハードリンク)"""
+        if not self.ready:
+            return False
+        t0 = time.time()
+        if self._reflink is not False:
+            try:
+                proc = await asyncio.create_subprocess_exec( 'cp', '-a', '--reflink=always', self.home+'/.', workdir,
+                                                             stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE )
+                _,err = await proc.communicate()
+                if proc.returncode!=0:
+                    raise OSError(err.decode(errors='ignore').strip())
+                self._reflink = True
+            except OSError as ex:
+                logger.info(f"reflink is not available, use hardlinks {str(ex)}")
+                self._reflink = False
+        if not self._reflink:
+            try:
+                await asyncio.to_thread(shutil.copytree, self.home, workdir, symlinks=True, dirs_exist_ok=True, copy_function=self._link_or_copy)
+            except Exception:
+                logger.exception(f"can not clone profile into {workdir}")
+                return False
+        self._clones += 1
+        self._clone_sec += time.time()-t0
+        return True
+
+    def _link_or_copy(self, src:str, dst:str) -> None:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if is_shared(os.path.relpath(src,self.home)):
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    def get_status(self) -> dict:
+        return {
+            'ready': self.ready,
+            'clones': self._clones,
+            'reflink': self._reflink,
+            'avg_clone_sec': round(self._clone_sec/self._clones,3) if self._clones>0 else 0.0,
+        }
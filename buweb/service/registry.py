@@ -0,0 +1,150 @@
+import os
+import abc
+import time
+import sqlite3
+from dataclasses import dataclass
+from threading import Lock, local
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+@dataclass
+class NodeInfo:
+    """セッションを受け付けるアプリのインスタンス"""
+    node_id:str
+    url:str  # 転送先のベースURL (例 http://10.0.0.2:5000)
+    host:str  # クライアントがVNC(websockify)に接続するホスト名
+    capacity:int
+    load:int
+    updated:float = 0.0
+
+    def free(self) -> int:
+        return self.capacity - self.load
+
+class SessionRegistry(abc.ABC):
+    """ノードとセッションの対応を共有するレジストリ"""
+    # この秒数heartbeatが無いノードは停止したとみなす
+    NODE_TTL:float = 30.0
+
+    @abc.abstractmethod
+    def register_node(self, node:NodeInfo) -> None:
+        """ノードの登録と容量・負荷の更新(heartbeat)"""
+
+    @abc.abstractmethod
+    def unregister_node(self, node_id:str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def nodes(self) -> list[NodeInfo]:
+        """生きているノードの一覧"""
+
+    @abc.abstractmethod
+    def put_session(self, session_id:str, node_id:str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def remove_session(self, session_id:str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def get_node_id(self, session_id:str) -> str|None:
+        ...
+
+    def get_node(self, session_id:str) -> NodeInfo|None:
+        """セッションを持っているノード"""
+        node_id = self.get_node_id(session_id)
+        if node_id is None:
+            return None
+        for node in self.nodes():
+            if node.node_id == node_id:
+                return node
+        return None
+
+    def least_loaded(self) -> NodeInfo|None:
+        """空きが最も多いノード(空きが無ければNone)"""
+        best:NodeInfo|None = None
+        for node in self.nodes():
+            if node.free()<=0:
+                continue
+            if best is None or node.free()/max(1,node.capacity) > best.free()/max(1,best.capacity):
+                best = node
+        return best
+
+class LocalRegistry(SessionRegistry):
+    """単一インスタンス用(プロセス内の辞書)"""
+    def __init__(self):
+        self._lock:Lock = Lock()
+        self._nodes:dict[str,NodeInfo] = {}
+        self._sessions:dict[str,str] = {}
+
+    def register_node(self, node:NodeInfo) -> None:
+        with self._lock:
+            node.updated = time.time()
+            self._nodes[node.node_id] = node
+
+    def unregister_node(self, node_id:str) -> None:
+        with self._lock:
+            self._nodes.pop(node_id,None)
+
+    def nodes(self) -> list[NodeInfo]:
+        limit = time.time() - self.NODE_TTL
+        with self._lock:
+            return [ n for n in self._nodes.values() if n.updated>=limit ]
+
+    def put_session(self, session_id:str, node_id:str) -> None:
+        with self._lock:
+            self._sessions[session_id] = node_id
+
+    def remove_session(self, session_id:str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id,None)
+
+    def get_node_id(self, session_id:str) -> str|None:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+class SQLiteRegistry(SessionRegistry):
+    """複数インスタンスで共有するSQLiteファイルのレジストリ"""
+    def __init__(self, path:str):
+        self._path:str = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._local = local()
+        with self._conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, url TEXT, host TEXT, capacity INTEGER, load INTEGER, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, node_id TEXT)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに持つ
+        conn = getattr(self._local,'conn',None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def register_node(self, node:NodeInfo) -> None:
+        node.updated = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO nodes VALUES (?,?,?,?,?,?)",
+                         (node.node_id, node.url, node.host, node.capacity, node.load, node.updated))
+
+    def unregister_node(self, node_id:str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM nodes WHERE node_id=?", (node_id,))
+            conn.execute("DELETE FROM sessions WHERE node_id=?", (node_id,))
+
+    def nodes(self) -> list[NodeInfo]:
+        limit = time.time() - self.NODE_TTL
+        rows = self._conn().execute("SELECT node_id,url,host,capacity,load,updated FROM nodes WHERE updated>=?", (limit,)).fetchall()
+        return [ NodeInfo(*row) for row in rows ]
+
+    def put_session(self, session_id:str, node_id:str) -> None:
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?,?)", (session_id, node_id))
+
+    def remove_session(self, session_id:str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id=?", (session_id,))
+
+    def get_node_id(self, session_id:str) -> str|None:
+        row = self._conn().execute("SELECT node_id FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,130 @@
+import os
+import time
+from dataclasses import dataclass, field
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+_CLK_TCK:int = os.sysconf('SC_CLK_TCK') if hasattr(os,'sysconf') else 100
+_PAGE_SIZE:int = os.sysconf('SC_PAGE_SIZE') if hasattr(os,'sysconf') else 4096
+
+@dataclass
+class ProcUsage:
+    """プロセスグループの使用量"""
+    rss:int = 0  # バイト(取得できればPSS)
+    cpu_sec:float = 0.0  # 累積CPU時間
+    procs:int = 0
+
+@dataclass
+class HostUsage:
+    mem_total:int = 0
+    mem_available:int = 0
+    cpu:float = 0.0  # 直近の使用率(0.0-1.0)
+    updated:float = 0.0
+
+@dataclass
+class SessionUsage:
+    rss:int = 0
+    cpu:float = 0.0  # 直近の使用率(1コア=1.0)
+    procs:int = 0
+    updated:float = 0.0
+    _cpu_sec:float = field(default=0.0, repr=False)
+
+def read_meminfo() -> tuple[int,int]:
+    """(MemTotal, MemAvailable) バイト"""
+    total = avail = 0
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    total = int(line.split()[1])*1024
+                elif line.startswith('MemAvailable:'):
+                    avail = int(line.split()[1])*1024
+    except OSError:
+        pass
+    return total, avail
+
+def read_cpu_times() -> tuple[float,float]:
+    """(busy, total) 起動からの累積tick"""
+    try:
+        with open('/proc/stat') as f:
+            values = [ float(v) for v in f.readline().split()[1:] ]
+    except (OSError, ValueError):
+        return 0.0, 0.0
+    total = sum(values)
+    idle = sum(values[3:5])  # idle + iowait
+    return total-idle, total
+
+def _read_rss(pid:str) -> int:
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1])*_PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def sample_groups(pgids:set[int]) -> dict[int,ProcUsage]:
+    """/procを1回走査して、指定したプロセスグループごとにメモリとCPU時間を合計する"""
+    result:dict[int,ProcUsage] = { pgid:ProcUsage() for pgid in pgids }
+    if not pgids:
+        return result
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return result
+    for pid in names:
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+            # commに空白や括弧が入ることがあるので最後の')'以降を使う
+            fields = stat[stat.rindex(')')+2:].split()
+            pgrp = int(fields[2])
+            usage = result.get(pgrp)
+            if usage is None or fields[0]=='Z':
+                continue
+            usage.cpu_sec += (int(fields[11])+int(fields[12])) / _CLK_TCK
+        except (OSError, ValueError, IndexError):
+            continue
+        usage.rss += _read_rss(pid)
+        usage.procs += 1
+    return result
+
+class ResourceMonitor:
+    """ホストとセッションごとのプロセスツリーの使用量を定期的に測る"""
+    def __init__(self):
+        self.host:HostUsage = HostUsage()
+        self.sessions:dict[str,SessionUsage] = {}
+        self._cpu_prev:tuple[float,float] = read_cpu_times()
+
+    def sample(self, groups:dict[str,list[int]]) -> None:
+        """groups: セッションID -> プロセスグループIDのリスト (スレッドで呼ぶ)"""
+        now = time.time()
+        total, avail = read_meminfo()
+        busy, ticks = read_cpu_times()
+        prev_busy, prev_ticks = self._cpu_prev
+        self._cpu_prev = (busy, ticks)
+        cpu = (busy-prev_busy)/(ticks-prev_ticks) if ticks>prev_ticks else 0.0
+        self.host = HostUsage( total, avail, round(cpu,3), now )
+
+        usages = sample_groups( set( pgid for pgids in groups.values() for pgid in pgids ) )
+        sessions:dict[str,SessionUsage] = {}
+        for sid,pgids in groups.items():
+            rss = sum( usages[p].rss for p in pgids )
+            cpu_sec = sum( usages[p].cpu_sec for p in pgids )
+            procs = sum( usages[p].procs for p in pgids )
+            before = self.sessions.get(sid)
+            cpu = 0.0
+            if before is not None and now>before.updated and cpu_sec>=before._cpu_sec:
+                cpu = (cpu_sec-before._cpu_sec)/(now-before.updated)
+            sessions[sid] = SessionUsage( rss, round(cpu,3), procs, now, cpu_sec )
+        self.sessions = sessions
+
+    def get(self, session_id:str) -> SessionUsage|None:
+        return self.sessions.get(session_id)
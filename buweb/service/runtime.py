@@ -0,0 +1,98 @@
+import os
+import asyncio
+from asyncio import AbstractEventLoop
+from concurrent.futures import Future
+from threading import Thread, Lock
+from typing import Any, Coroutine, TypeVar
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+T = TypeVar('T')
+
+class TaskRuntime:
+    """常駐するイベントループでタスクのコルーチンを実行する
+
+    ループはスレッドごとに1つ起動したまま使い回すので、タスク毎にループや
+    Playwright、HTTPクライアントを作り直さずに済む。
+    同じkeyのコルーチンは同じループで実行される(ループに紐づくオブジェクトを共有できる)。
+    """
+    def __init__(self, n_loops:int|None=None):
+        self._n_loops:int = max(1, n_loops if n_loops else (os.cpu_count() or 1))
+        self._lock:Lock = Lock()
+        self._loops:list[AbstractEventLoop] = []
+        self._threads:list[Thread] = []
+        self._load:list[int] = []
+        self._affinity:dict[str,int] = {}
+        for i in range(self._n_loops):
+            loop = asyncio.new_event_loop()
+            th = Thread(target=self._run_loop, args=(loop,), name=f"task-loop-{i}", daemon=True)
+            self._loops.append(loop)
+            self._threads.append(th)
+            self._load.append(0)
+            th.start()
+
+    def _run_loop(self, loop:AbstractEventLoop) -> None:
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            try:
+                pending = asyncio.all_tasks(loop)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            except Exception:
+                logger.exception("error in shutdown loop")
+            loop.close()
+
+    def _select(self, key:str|None) -> int:
+        with self._lock:
+            if key is not None and key in self._affinity:
+                return self._affinity[key]
+            idx = min(range(self._n_loops), key=lambda i: self._load[i])
+            if key is not None:
+                self._affinity[key] = idx
+            return idx
+
+    def loop_for(self, key:str|None=None) -> AbstractEventLoop:
+        return self._loops[self._select(key)]
+
+    def release(self, key:str) -> None:
+        """keyとループの対応を解除する"""
+        with self._lock:
+            self._affinity.pop(key,None)
+
+    def submit(self, coro:Coroutine[Any,Any,T], *, key:str|None=None) -> Future[T]:
+        """コルーチンをループに投入する(どのスレッドからでも呼べる)"""
+        idx = self._select(key)
+        with self._lock:
+            self._load[idx] += 1
+        future:Future[T] = asyncio.run_coroutine_threadsafe(coro, self._loops[idx])
+        def done(_):
+            with self._lock:
+                self._load[idx] -= 1
+        future.add_done_callback(done)
+        return future
+
+    async def run(self, coro:Coroutine[Any,Any,T], *, key:str|None=None) -> T:
+        """コルーチンをkeyのループで実行して結果を待つ"""
+        loop = self.loop_for(key)
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro, key=key))
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                'loops': self._n_loops,
+                'running': list(self._load),
+            }
+
+    def shutdown(self, timeout:float|None=10.0) -> None:
+        for loop in self._loops:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(loop.stop)
+        for th in self._threads:
+            th.join(timeout)
@@ -2,120 +2,91 @@ import sys, os, shutil, subprocess, traceback, tempfile
 from datetime import datetime, timedelta
 import time
 import json
-from queue import Queue, Empty
+import heapq
+from collections import deque
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import Future
+from typing import AsyncIterable
 import asyncio
 from asyncio import Task
-import aiohttp
 import random,string
 from importlib.resources import files
 from langchain_core.caches import BaseCache
 from langchain_core.caches import InMemoryCache
 from langchain_community.cache import SQLiteCache
-from buweb.model.model import LLM
+from browser_use import Browser
+from buweb.model.model import LLM, RATELIMITFILE, set_rate_limit_db, probe_model
+from buweb.model.health import health_monitor
+from buweb.model.cache import LLMCache, LLMCACHEFILE
+from buweb.model.hedge import get_hedge_status
+from buweb.model.coalesce import get_coalesce_status
+from buweb.model.usage import UsageScope, usage_scope, merge_usage
 from buweb.model.translate import Translate
 from buweb.agent.buw_agent import BuwWriter
+from buweb.utils.utils import safe_close
 from buweb.task.operator import BwTask
 from buweb.task.research import BwResearchTask
+from buweb.service.worker import ProcessTaskPool, build_task
+from buweb.service.registry import SessionRegistry, LocalRegistry, NodeInfo
+from buweb.service.channel import MsgChannel
+from buweb.service.procwatch import ProcWatcher, stop_group
+from buweb.service.runtime import TaskRuntime
+from buweb.service.resources import ResourceMonitor
+from buweb.service.profile import ProfileTemplate
+from buweb.service.adblock import BlockListUpdater, CdpAdBlocker, get_blocker
+from buweb.service.checkpoint import Checkpoint, scan_checkpoints
+from buweb.service.upload import UploadWriter, QuotaExceededException, sanitize_filename, receive_multipart
+from buweb.service.ports import PortAllocator, PortLease, NoAvailablePortException, is_port_available
 from logging import Logger,getLogger
 logger:Logger = getLogger(__name__)
 
 class CanNotStartException(Exception):
     pass
 
-HOSTSFILE:str = 'hosts.adblock'
-
-def is_port_available(port: int) -> bool:
-    """指定されたポートが使用可能かチェック"""
-    import socket
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('localhost', port))
-            return True
-    except (socket.error, OSError):
-        return False
-
-def find_available_display() -> tuple[int,int]:
-    """利用可能なディスプレイ番号を見つける"""
-    for num in range(10, 100):
-        port = 5900 + num  # VNCサーバー用ポート
-        if is_port_available(port):
-            return num, port
-    raise CanNotStartException("利用可能なディスプレイ番号が見つかりません")
-
-def find_ws_port() -> int:
-    for num in range(30, 100):
-        port = 5000 + num   # websockify用ポート
-        if is_port_available(port):
-            return port
-    raise CanNotStartException("利用可能なwebsockポートが見つかりません")
-
-def find_cdn_port() -> int:
-    """利用可能なディスプレイ番号を見つける"""
-    for num in range(0, 100):
-        port = 9222 + num   # websockify用ポート
-        if is_port_available(port):
-            return port
-    raise CanNotStartException("利用可能なCDNポートが見つかりません")
+ADBLOCKFILE:str = 'adblock.bin'
 
 def is_proc( proc:subprocess.Popen|None ):
     if proc is not None and proc.poll() is None:
         return True
     return False
     
-async def stop_proc( proc:subprocess.Popen|None ):
+async def stop_proc( proc:subprocess.Popen|None, *, timeout:float=0.5 ):
+    """プロセスグループごと停止する(ループはブロックしない)"""
     if proc is not None:
         try:
-            proc.terminate()
-        except:
-            pass
-        try:
-            while True:
-                try:
-                    proc.wait(timeout=0.01)
-                    return
-                except subprocess.TimeoutExpired:
-                    await asyncio.sleep(1)
-        except:
-            pass
-
-async def download_hosts_file_async(save_path: str):
-    url = "https://raw.githubusercontent.com/StevenBlack/hosts/master/hosts"
-    timeout = aiohttp.ClientTimeout(total=10)  # 正しい ClientTimeout の設定
-
-    try:
-        content:bytes|None = None
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=timeout) as response:
-                if response.status != 200:
-                    print(f"`hosts` ファイルのダウンロードに失敗しました: HTTP {response.status}")
-                    return
-                # ファイルを非同期で保存
-                content = await response.read()
-        if content is not None:
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file.write(content)
-                if os.path.exists(save_path):
-                    os.replace(temp_file.name, save_path)  # 上書き
-                    print(f"`hosts` ファイルを上書きしました: {save_path}")
-                else:
-                    shutil.move(temp_file.name, save_path)  # 新規移動
-                    print(f"`hosts` ファイルを移動しました: {save_path}")
-
-    except Exception as e:
-        print(f"`hosts` ファイルのダウンロード中にエラーが発生しました: {e}")
+            await stop_group(proc, timeout=timeout)
+        except Exception:
+            logger.exception(f"can not stop pid:{proc.pid}")
 
 class BwSession:
-    def __init__(self,session_id:str, server_addr:str, client_addr:str|None, *, dir:str, hostsfile:str, Pool:ThreadPoolExecutor, lock:asyncio.Lock):
+    def __init__(self,session_id:str, server_addr:str, client_addr:str|None, *, dir:str, adblock:str|None, runtime:TaskRuntime, workers:ProcessTaskPool|None, lock:asyncio.Lock, ports:PortAllocator, watcher:ProcWatcher, profile:ProfileTemplate|None=None):
         self.session_id:str = session_id
         self.server_addr:str = server_addr
         self.client_addr:str|None = client_addr
         self.last_access:datetime = datetime.now()
+        self.started:datetime = datetime.now()
         self.WorkDir:str = dir
-        self.hostsfile:str = hostsfile
-        self.Pool:ThreadPoolExecutor = Pool
+        # コンパイル済みの広告ブロックリスト(Chromeの起動中はCDPでブロックする)
+        self.adblock:str|None = adblock
+        self._adblocker:CdpAdBlocker|None = None
+        self._runtime:TaskRuntime = runtime
+        # 指定された場合はタスクをワーカープロセスで実行する
+        self._workers:ProcessTaskPool|None = workers
+        self._worker_task_id:str|None = None
+        # 起動やプロセス管理を行うループ
+        self._main_loop:asyncio.AbstractEventLoop|None = asyncio.get_running_loop()
         self._lock:asyncio.Lock = lock
+        self._ports:PortAllocator = ports
+        self._watcher:ProcWatcher = watcher
+        # 初期化済みプロファイルのテンプレート
+        self._profile:ProfileTemplate|None = profile
+        self._profile_cloned:bool = False
+        # アップロードされたファイル (ファイル名 -> サイズ)
+        self.uploads:dict[str,int] = {}
+        self.upload_quota:int = 100*1024*1024
+        # 再起動後に再開するための状態
+        self.checkpoint:Checkpoint = Checkpoint(dir)
+        self._suspending:bool = False
         self.geometry = "1024x900"
         self.vnc_proc:subprocess.Popen|None = None
         self.chrome_process:subprocess.Popen|None = None
@@ -130,8 +101,18 @@ class BwSession:
         self._n_tasks:int = 0
         self._task_expand:bool = False
         self.task:BwTask|BwResearchTask|None = None
-        self.message_queue: Queue[tuple[int,int,int,int,str,str,str|None]] = Queue()
+        # SSEへ送るイベント (イベント名, データ)
+        self.message_queue: MsgChannel[tuple[str,dict]] = MsgChannel()
         self.current_future: Future|None = None
+        # タスク間で使い回すブラウザ(タスク用ループに属する)
+        self._browser:Browser|None = None
+        # ブラウザが接続しているChromeのpid(Chromeが再起動したら使わない)
+        self._browser_pid:int = 0
+        # タスクごとのLLMの使用量
+        self._usage:dict[int,dict] = {}
+        # 最後に通知した状態
+        self._status:dict = {}
+        self._status_lock:Lock = Lock()
 
     def touch(self):
         self.last_access:datetime = datetime.now()
@@ -145,20 +126,83 @@ class BwSession:
             msgstr = json.dumps(msg,ensure_ascii=False)
         else:
             msgstr = str(msg)
-        self.message_queue.put( (n_task,n_agent,n_step,n_act,header,msgstr,progress) )
+        data:dict = {}
+        if n_task>0:
+            data['task'] = n_task
+        if n_agent>0:
+            data['agent'] = n_agent
+        if n_step>0:
+            data['step'] = n_step
+        if n_act>0:
+            data['act'] = n_act
+        data['header'] = header
+        data['msg'] = msgstr
+        data['progress'] = progress
+        self.message_queue.put( ('log',data) )
 
-    async def get_msg(self,*,timeout:float=1.0) ->tuple[int,int,int,int,str|None,str|None,str|None]:
-        break_time = time.time() + max(0, timeout)
-        while True:
-            try:
-                self.touch()
-                return self.message_queue.get_nowait()
-            except Empty as ex:
-                now = time.time()
-                if now<break_time:
-                    await asyncio.sleep(0.2)
-                    continue
-                return (0,0,0,0,None,None,None)
+    def _write_report(self,n_task:int,n_report:int,title:str,text:str,done:bool):
+        """生成中のレポートの断片をreportイベントで送る"""
+        self.touch()
+        self.message_queue.put( ('report',{'task': n_task, 'report': n_report, 'title': title, 'text': text, 'done': done}) )
+
+    def _write_usage(self,n_task:int,usage:dict):
+        """タスクの使用量を記録してusageイベントで送る"""
+        self._usage[n_task] = usage
+        self.message_queue.put( ('usage',{'task': n_task, 'usage': usage, 'session': merge_usage(self._usage.values())}) )
+
+    def get_usage(self) ->dict:
+        """セッションの使用量(合計・モデル別・タスク別)"""
+        res = merge_usage(self._usage.values())
+        res['tasks'] = dict(self._usage)
+        return res
+
+    async def get_msg(self,*,timeout:float=1.0) ->tuple[str,dict]|None:
+        """次のイベントを待つ。timeout秒以内になければNone"""
+        self.touch()
+        item = await self.message_queue.get(timeout=max(0, timeout))
+        self.touch()
+        return item
+
+    def _update_status(self) -> None:
+        """vnc/ws/br/taskの状態が変わっていたら差分をstatusイベントで通知する"""
+        with self._status_lock:
+            current = {
+                'vnc': self.is_vnc_running(),
+                'ws': self.is_websockify_running(),
+                'br': self.is_chrome_running(),
+                'task': self.is_task(),
+            }
+            delta = { k:v for k,v in current.items() if self._status.get(k)!=v }
+            if not delta:
+                return
+            self._status = current
+        self.message_queue.put( ('status',delta) )
+
+    def close_stream(self, msg:str) -> None:
+        """SSEの接続を終了させる"""
+        self.message_queue.put( ('close',{'status':'error','msg':msg}) )
+
+    def pgids(self) -> list[int]:
+        """起動中のXvncとChromeのプロセスグループ"""
+        return [ proc.pid for proc in (self.vnc_proc, self.chrome_process) if is_proc(proc) ]
+
+    def _on_proc_exit(self, proc:subprocess.Popen) -> None:
+        logger.info(f"[{self.session_id}] process exited pid:{proc.pid} code:{proc.returncode}")
+        if proc is self.chrome_process and self._main_loop is not None and not self._main_loop.is_closed():
+            # 落ちたChromeへの再接続をやめる
+            self._main_loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._stop_adblock()))
+        self._update_status()
+
+    def _start_adblock(self, cdp_port:int) -> None:
+        blocker = get_blocker(self.adblock)
+        if blocker is not None:
+            self._adblocker = CdpAdBlocker(blocker, cdp_port)
+            self._adblocker.start()
+
+    async def _stop_adblock(self) -> None:
+        adblocker, self._adblocker = self._adblocker, None
+        if adblocker is not None:
+            await adblocker.stop()
 
     def is_vnc_running(self) -> int:
         return self.display_num if self.display_num>0 and is_proc(self.vnc_proc) else 0
@@ -166,6 +210,9 @@ class BwSession:
     def is_websockify_running(self) -> int:
         return self.ws_port if self.ws_port>0 and is_proc(self.vnc_proc) else 0
 
+    def _chrome_pid(self) -> int:
+        return self.chrome_process.pid if is_proc(self.chrome_process) else 0 # type: ignore[union-attr]
+
     def is_chrome_running(self) -> int:
         return self.cdp_port if self.cdp_port>0 and is_proc(self.chrome_process) else 0
 
@@ -173,7 +220,7 @@ class BwSession:
         return self.is_vnc_running()>0 and self.is_chrome_running()>0
 
     def is_task(self) ->int:
-        if self.current_future and self.current_future.running():
+        if self.current_future and not self.current_future.done():
             return 1
         else:
             return 0
@@ -191,6 +238,12 @@ class BwSession:
         }
         return res
 
+    def _lease_ports(self) -> PortLease:
+        try:
+            return self._ports.lease(self.session_id)
+        except NoAvailablePortException:
+            raise CanNotStartException("利用可能なディスプレイ番号またはポートが見つかりません")
+
     async def wait_port(self,proc:subprocess.Popen, port:int, timeout_sec:float):
         exit_sec:float = time.time() + timeout_sec
         while not is_port_available(port) and is_proc(proc):
@@ -209,15 +262,12 @@ class BwSession:
         self.vnc_port = 0
         self.ws_port = 0
 
-        await stop_proc(self.vnc_proc)
-
         vnc_proc:subprocess.Popen|None = None
         try:
-            # 新しいVNCサーバーを起動（5900番台のポートを使用）
-            display_num,vnc_port = find_available_display()
-            # websockifyを起動（websockifyは5900番台、VNCは6900番台を使用）
-            ws_port = find_ws_port()
-            
+            # ディスプレイ番号とポートを割り当てる
+            lease:PortLease = self._lease_ports()
+            display_num,vnc_port,ws_port = lease.display_num, lease.vnc_port, lease.ws_port
+
             script_path = str(files('buweb.scripts').joinpath('start_vnc.sh'))
             if not os.access(script_path, os.X_OK):
                 print(f"Error: {script_path} is not executable.")
@@ -227,7 +277,7 @@ class BwSession:
                         "--geometry", str(self.geometry),
                         "--rfbport", str(vnc_port),
                         "--wsport", str(ws_port)
-                    ], cwd=self.WorkDir, stderr=subprocess.DEVNULL)
+                    ], cwd=self.WorkDir, stderr=subprocess.DEVNULL, start_new_session=True)
             # VNCサーバーの起動を待つ
             await self.wait_port( vnc_proc, vnc_port, 10.0)
             # websockifyの起動を待つ
@@ -240,6 +290,8 @@ class BwSession:
             self.display_num = display_num
             self.vnc_port = vnc_port
             self.ws_port = ws_port
+            self._watcher.watch(vnc_proc, self._on_proc_exit)
+            self._update_status()
             await asyncio.sleep(0.5)
 
         except Exception as ex:
@@ -254,7 +306,9 @@ class BwSession:
         self.cdp_port = 0
         chrome_process:subprocess.Popen|None = None
         try:
-            cdp_port = find_cdn_port()
+            cdp_port = self._lease_ports().cdp_port
+            if self._profile is not None and not self._profile_cloned:
+                self._profile_cloned = await self._profile.clone_into(self.WorkDir)
             prof = f"{self.WorkDir}/.config/google-chrome/Default"
             os.makedirs(prof,exist_ok=True)
             script_path = str(files('buweb.scripts').joinpath('start_browser.sh'))
@@ -265,14 +319,16 @@ class BwSession:
                 "--workdir", str(self.WorkDir),
                 "--cdpport", str(cdp_port),
             ]
-            if os.path.exists(self.hostsfile):
-                bcmd.extend( ["--hosts",self.hostsfile])
-            chrome_process = subprocess.Popen( bcmd, cwd=self.WorkDir, stdout=subprocess.DEVNULL )
+            chrome_process = subprocess.Popen( bcmd, cwd=self.WorkDir, stdout=subprocess.DEVNULL, start_new_session=True )
             await self.wait_port(chrome_process,cdp_port,30.0)
             if chrome_process.poll() is not None:
                 raise CanNotStartException("google-chromeが起動できませんでした")
             self.chrome_process = chrome_process
             self.cdp_port = cdp_port
+            await self._stop_adblock()
+            self._start_adblock(cdp_port)
+            self._watcher.watch(chrome_process, self._on_proc_exit)
+            self._update_status()
         except Exception as ex:
             await stop_proc(chrome_process)
             raise ex
@@ -289,40 +345,60 @@ class BwSession:
             logger.exception(f"[{self.session_id}] {str(ex)}")
         return self.get_status()
 
-    async def start_task(self, mode:int, task_info: str, llm:LLM, planner_llm:LLM|None, llm_cache:BaseCache|None, trans:Translate, sensitive_data:dict[str,str]|None) -> None:
-        """タスクを開始"""
+    async def start_task(self, mode:int, task_info: str, llm:LLM, planner_llm:LLM|None, llm_cache:BaseCache|None, trans:Translate, sensitive_data:dict[str,str]|None, resume:dict|None=None) -> None:
+        """タスクを開始(resumeはチェックポイントから再開する場合)"""
         self.touch()
-        if self.task is not None or self.current_future is not None:
+        if self.task is not None or (self.current_future is not None and not self.current_future.done()):
             raise RuntimeError("タスクが既に実行中です")
         else:
-            self.current_future = self.Pool.submit(self._start_task, mode, task_info, llm, planner_llm, llm_cache, trans, sensitive_data )
+            # セッションごとに同じループで実行する
+            self.current_future = self._runtime.submit( self._run_task(mode, task_info, llm, planner_llm, llm_cache, trans, sensitive_data, resume), key=self.session_id )
+            self._update_status()
 
-    def _start_task(self, mode:int, prompt: str, llm:LLM, planner_llm:LLM|None,  llm_cache:BaseCache|None, trans:Translate, sensitive_data:dict[str,str]|None ) ->None:
-        #loop = asyncio.get_event_loop()
-        #loop.run_until_complete(self._run_task(mode, prompt, llm, planner_llm, llm_cache, sensitive_data))
-        asyncio.run(self._run_task(mode, prompt, llm, planner_llm, llm_cache, trans, sensitive_data))
+    async def _on_main_loop(self, coro):
+        """プロセス管理のコルーチンをメインループで実行する"""
+        loop = self._main_loop
+        if loop is None or loop.is_closed() or loop is asyncio.get_running_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
 
-    async def _run_task(self, mode:int, prompt: str, llm:LLM, planner_llm:LLM|None,  llm_cache:BaseCache|None, trans:Translate, sensitive_data:dict[str,str]|None) ->None:
+    async def _prepare_browser(self) -> None:
+        async with self._lock:
+            await self.setup_vnc_server()
+            await self.launch_chrome()
+
+    async def _run_task(self, mode:int, prompt: str, llm:LLM, planner_llm:LLM|None,  llm_cache:BaseCache|None, trans:Translate, sensitive_data:dict[str,str]|None, resume:dict|None) ->None:
         self._n_tasks+=1
-        buw:BuwWriter = BuwWriter( n_task=self._n_tasks, writer=self._write_msg4, trans=trans )
+        buw:BuwWriter = BuwWriter( n_task=self._n_tasks, writer=self._write_msg4, trans=trans, reporter=self._write_report )
+        scope:UsageScope|None = None
         try:
             self.touch()
+            if resume is None:
+                # 機密データはチェックポイントに保存しない
+                await asyncio.to_thread(self.checkpoint.start_task, {
+                    'mode': mode, 'prompt': prompt, 'llm': llm.name, 'plan_llm': planner_llm.name if planner_llm else None, 'n_tasks': self._n_tasks,
+                })
             await buw.start_global_task(prompt)
-            async with self._lock:
-                await self.setup_vnc_server()
-                await self.launch_chrome()
-            if mode==1:
-                self.task = BwResearchTask( dir=self.WorkDir,
-                                llm_cache=llm_cache, llm=llm, plan_llm=planner_llm,
-                                cdp_port=self.cdp_port,
-                                sensitive_data=sensitive_data,
-                                writer=buw)
-            else:
-                self.task = BwTask( dir=self.WorkDir,
-                                llm_cache=llm_cache, llm=llm, plan_llm=planner_llm,
-                                cdp_port=self.cdp_port,
-                                sensitive_data=sensitive_data,
-                                writer=buw)
+            await self._on_main_loop(self._prepare_browser())
+            # Chromeが再起動していたら前のブラウザは使わない(同じポートで再起動することがある)
+            if self._browser is not None and self._browser_pid != self._chrome_pid():
+                await safe_close(self._browser)
+                self._browser = None
+            if self._workers is not None:
+                await self._run_task_in_worker(mode, prompt, llm, planner_llm, sensitive_data, resume)
+                return
+            n_task = self._n_tasks
+            scope = UsageScope(step=buw.step_key, listener=lambda usage: self._write_usage(n_task, usage))
+            usage_scope.set(scope)
+            self.task = build_task( mode, dir=self.WorkDir,
+                            llm_cache=llm_cache, llm=llm, plan_llm=planner_llm,
+                            cdp_port=self.cdp_port, browser=self._browser,
+                            sensitive_data=sensitive_data,
+                            available_file_paths=self.available_file_paths(),
+                            resume=resume, checkpoint=self.checkpoint.update,
+                            writer=buw)
+            self._browser = self.task._browser
+            self._browser_pid = self._chrome_pid()
             await self.task.start(prompt)
             await self.task.stop()
         except CanNotStartException as ex:
@@ -332,136 +408,515 @@ class BwSession:
             logger.exception(f"[{self.session_id}] {str(ex)}")
             await buw.done_global_task(str(ex))
         finally:
+            if self.task is not None:
+                await self.task.close()
+            if scope is not None:
+                scope.flush()
+            if not self._suspending:
+                await asyncio.to_thread(self.checkpoint.update, {'running': False})
             self.current_future = None
             self.task = None
+            self._update_status()
             await buw.done_global_task()
 
-    async def cancel_task(self) -> dict:
-        """タスクをキャンセル"""
+    async def _run_task_in_worker(self, mode:int, prompt: str, llm:LLM, planner_llm:LLM|None, sensitive_data:dict[str,str]|None, resume:dict|None) ->None:
+        """ワーカープロセスでタスクを実行して終了を待つ"""
+        assert self._workers is not None
+        task_id = f"{self.session_id}-{self._n_tasks}"
+        args = {
+            'mode': mode, 'prompt': prompt, 'n_task': self._n_tasks,
+            'dir': self.WorkDir, 'cdp_port': self.cdp_port,
+            'llm': llm.name, 'plan_llm': planner_llm.name if planner_llm else None,
+            'sensitive_data': sensitive_data,
+            'available_file_paths': self.available_file_paths(),
+            'resume': resume,
+        }
+        self._worker_task_id = task_id
+        try:
+            await asyncio.wrap_future(self._workers.submit(task_id, args, self._write_msg4, self.checkpoint.update, self._write_report, self._write_usage))
+        finally:
+            self._worker_task_id = None
+
+    async def _close_browser(self) -> None:
+        browser = self._browser
+        self._browser = None
+        self._browser_pid = 0
+        if browser is not None:
+            await safe_close(browser)
+
+    async def cancel_task(self, suspend:bool=False) -> dict:
+        """タスクをキャンセル(suspend=Trueは再開のための中断)"""
         try:
             future:Future|None = self.current_future
-            if future is not None:
-                while future.running():
-                    if self.task is not None:
-                        await self.task.stop()
-                    await asyncio.sleep(0.5)
+            if future is not None and not future.done():
+                task = self.task
+                if task is not None:
+                    await self._runtime.run(task.stop(suspend), key=self.session_id)
+                if self._workers is not None and self._worker_task_id is not None:
+                    self._workers.cancel(self._worker_task_id, suspend)
+                try:
+                    await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=5.0)
+                except asyncio.TimeoutError:
                     future.cancel()
         except:
             pass
         return self.get_status()
 
-    async def stop_browser(self) ->dict:
-        async with self._lock:
-            try:
-                logger.info(f"[{self.session_id}] stop_cancel_task")
-                # タスクをキャンセル
-                await self.cancel_task()
-                
-                logger.info(f"[{self.session_id}] stop_browser")
-                await stop_proc( self.chrome_process )
+    async def stop_browser(self, suspend:bool=False) ->dict:
+        try:
+            logger.info(f"[{self.session_id}] stop_cancel_task")
+            # タスクをキャンセル
+            await self.cancel_task(suspend)
+            await self._runtime.run(self._close_browser(), key=self.session_id)
+
+            # プロセスを切り離してからロックの外で停止を待つ
+            async with self._lock:
+                chrome_process, vnc_proc = self.chrome_process, self.vnc_proc
                 self.chrome_process = None
                 self.cdp_port = 0
-                logger.info(f"[{self.session_id}] stop_vnc")
-                await stop_proc( self.vnc_proc )
-                logger.info(f"[{self.session_id}] stop_kill")
                 self.vnc_proc = None
-                # 残存プロセスを強制終了
-                if self.display_num>0:
-                    cmd = f"pkill -f 'Xvnc.*:{self.display_num}'"
-                    subprocess.run(["/bin/bash", "-c", cmd], check=False)
-                if self.vnc_port>0 and self.ws_port>0:
-                    cmd = f"pkill -f 'websockify.*:{self.ws_port}|:{self.vnc_port}'"
-                    subprocess.run(["/bin/bash", "-c", cmd], check=False)
-                    cmd = f"pkill -f 'websockify.*:{self.vnc_port}|:{self.ws_port}'"
-                    subprocess.run(["/bin/bash", "-c", cmd], check=False)
                 self.display_num = 0
                 self.vnc_port = 0
                 self.ws_port = 0
-            except Exception as e:
-                logger.exception(f"[{self.session_id}] VNCサーバー停止中にエラーが発生: {str(e)}")
+            logger.info(f"[{self.session_id}] stop_browser")
+            await self._stop_adblock()
+            # Xvnc,websockify,chromeはそれぞれのプロセスグループごと停止する
+            await asyncio.gather( stop_proc(chrome_process), stop_proc(vnc_proc) )
+        except Exception as e:
+            logger.exception(f"[{self.session_id}] VNCサーバー停止中にエラーが発生: {str(e)}")
+        finally:
+            # 停止中に起動し直していなければポートを返す
+            if self.vnc_proc is None and self.chrome_process is None:
+                self._ports.release(self.session_id)
+            self._update_status()
         return self.get_status()
 
+    def upload_dir(self) -> str:
+        return os.path.join(self.WorkDir, 'uploads')
+
+    def available_file_paths(self) -> list[str]:
+        """エージェントに渡すアップロード済みファイルのパス"""
+        return [ os.path.join(self.upload_dir(), name) for name in self.uploads ]
+
+    async def open_upload(self, filename:str|None, pending:dict[str,int]|None=None) -> UploadWriter:
+        """アップロード先を開く(残りの容量を超えるとQuotaExceededException)
+
+        pendingは同じリクエストで書き終えたがまだuploadsに入れていないファイルのサイズ。
+        """
+        name = sanitize_filename(filename)
+        if name is None:
+            raise ValueError(f"ファイル名が不正です")
+        sizes = { **self.uploads, **(pending or {}) }
+        used = sum(sizes.values()) - sizes.get(name,0)
+        if used>=self.upload_quota:
+            raise QuotaExceededException(f"アップロードできる容量を超えました")
+        os.makedirs(self.upload_dir(), exist_ok=True)
+        writer = UploadWriter(os.path.join(self.upload_dir(), name), self.upload_quota-used)
+        await writer.open()
+        return writer
+
+    async def store_upload(self, body:AsyncIterable[bytes], boundary:str) -> list[str]:
+        """multipartのリクエストボディを受信しながら保存する"""
+        self.touch()
+        sizes:dict[str,int] = {}
+        try:
+            return await receive_multipart(body, boundary, self.open_upload, sizes=sizes)
+        finally:
+            # 後のパートで失敗しても書き終えたファイルは容量に数えてエージェントに渡す
+            for name,size in sizes.items():
+                self.uploads[name] = size
+                logger.info(f"[{self.session_id}] stored {name} {size}bytes")
+            if sizes:
+                await asyncio.to_thread(self.checkpoint.update, {'uploads': dict(self.uploads)})
+
     async def store_file(self, file_path:str, data:bytes) -> None:
         """ファイルを保存"""
-        store_path = os.path.join(self.WorkDir, file_path)
-        with open(store_path, "wb") as f:
-            f.write(data)
+        writer = await self.open_upload(file_path)
+        try:
+            await writer.write(data)
+            await writer.close()
+        except:
+            await writer.abort()
+            raise
+        self.uploads[os.path.basename(writer.path)] = writer.size
+        await asyncio.to_thread(self.checkpoint.update, {'uploads': dict(self.uploads)})
+
+    def restore(self) -> bool:
+        """作業ディレクトリのチェックポイントから状態を戻す"""
+        if not self.checkpoint.load():
+            return False
+        self._n_tasks = self.checkpoint.data.get('n_tasks',0)
+        self.uploads = { name:size for name,size in self.checkpoint.data.get('uploads',{}).items() if os.path.exists(os.path.join(self.upload_dir(),name)) }
+        return True
+
+    async def suspend(self) -> None:
+        """再開できるように作業ディレクトリを残して停止する"""
+        self._suspending = True
+        await self.stop_browser(suspend=True)
+        self._runtime.release(self.session_id)
+        logger.info(f"[{self.session_id}] suspended")
 
     async def cleanup(self) -> None:
         """リソースをクリーンアップ"""
         await self.stop_browser()
-        if self.task:
-            await self.task.stop()
+        self._runtime.release(self.session_id)
         try:
             shutil.rmtree(self.WorkDir)
         except Exception as e:
             logger.exception(f"[{self.session_id}] 停止中にエラーが発生: {str(e)}")
 
+class AdmissionTicket:
+    """接続数制限中にセッションを待つクライアントの順番札"""
+    def __init__(self, server_addr:str, client_addr:str|None, resume:str|None=None):
+        loop = asyncio.get_running_loop()
+        self.server_addr:str = server_addr
+        self.client_addr:str|None = client_addr
+        # 再開したいセッションID
+        self.resume:str|None = resume
+        self.session:asyncio.Future[BwSession] = loop.create_future()
+        self._changed:asyncio.Future[None] = loop.create_future()
+
+    def notify(self) -> None:
+        """順番が変わったことを知らせる"""
+        if not self._changed.done():
+            self._changed.set_result(None)
+
+    async def wait(self, timeout:float|None=None) -> BwSession|None:
+        """セッションが割り当てられるか、順番が変わるか、timeout秒経過するまで待つ"""
+        if not self.session.done():
+            await asyncio.wait( [self.session, self._changed], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if self._changed.done():
+            self._changed = asyncio.get_running_loop().create_future()
+        return self.session.result() if self.session.done() else None
+
 # セッションデータを保存する辞書
 class SessionStore:
-    def __init__(self, *, max_sessions:int=3, dir:str="tmp/sessions", Pool:ThreadPoolExecutor|None=None):
+    # ウォームプールの上限
+    POOL_MAX_SIZE:int = 5
+    # スイーパーが起きる最大の間隔(秒)
+    SWEEP_MAX_SEC:float = SessionRegistry.NODE_TTL/3
+    # 使用量を測る間隔(秒)
+    SAMPLE_SEC:float = 5.0
+
+    def __init__(self, *, max_sessions:int=3, pool_size:int=1, dir:str="tmp/sessions", runtime:TaskRuntime|None=None, n_workers:int=0,
+                 registry:SessionRegistry|None=None, node_url:str|None=None, node_host:str|None=None,
+                 mem_reserve_mb:int=1024, session_mem_mb:int=800, cpu_limit:float=0.9):
         self._lock = asyncio.Lock()
         self._connect:int = 0
         self._max_sessions:int = max_sessions
         self.sessions: dict[str, BwSession] = {}
         self.SessionsDir:str = os.path.abspath(dir)
         os.makedirs(self.SessionsDir,exist_ok=True)
-        self.hostsfile:str = os.path.join(self.SessionsDir,'hosts.adblock')
-        self.Pool:ThreadPoolExecutor = Pool if isinstance(Pool,ThreadPoolExecutor) else ThreadPoolExecutor()
+        # LLMのレート制限はワーカープロセスとも共有する
+        set_rate_limit_db(os.path.join(self.SessionsDir,RATELIMITFILE))
+        self._adblock:BlockListUpdater = BlockListUpdater(os.path.join(self.SessionsDir,ADBLOCKFILE))
+        self._runtime:TaskRuntime = runtime if isinstance(runtime,TaskRuntime) else TaskRuntime()
+        # n_workers>0ならタスクをワーカープロセスで実行する(start()で起動する)
+        self._n_workers:int = n_workers
+        self._workers:ProcessTaskPool|None = None
         self._lock2:asyncio.Lock = asyncio.Lock()
-        self.cleanup_interval:timedelta = timedelta(minutes=30)
+        self._ports:PortAllocator = PortAllocator()
+        self._ports.recover()
+        self._watcher:ProcWatcher = ProcWatcher()
+        self._profile:ProfileTemplate = ProfileTemplate(os.path.join(self.SessionsDir,'profile_template'), self._ports)
+        self._profile_task:Task|None = None
+        self._health_task:Task|None = None
         self.session_timeout:timedelta = timedelta(hours=2)
-        self._last_cleanup:datetime = datetime.now()
+        # 期限のヒープ (期限のtimestamp, session_id)。touchでは更新せず取り出す時に再投入する
+        self._expiry:list[tuple[float,str]] = []
         self._sweeper_task:Task|None = None
-        self._llm_cache_path:str = os.path.join(self.SessionsDir,'langchain_cache.db')
-        self._llm_cache:BaseCache = SQLiteCache(self._llm_cache_path)
+        self._sweeper_wakeup:asyncio.Event = asyncio.Event()
+        # 使用量に基づく受け入れ制御
+        self._monitor:ResourceMonitor = ResourceMonitor()
+        self._last_sample:float = 0.0
+        self.mem_reserve:int = mem_reserve_mb*1024*1024  # ホストに残しておくメモリ
+        self.cpu_limit:float = cpu_limit  # これを超えるCPU使用率なら受け入れない
+        self._est_session_mem:float = float(session_mem_mb*1024*1024)  # 1セッションのメモリの見積もり
+        self._evicted:int = 0
+        # ウォームプール(Xvnc+Chromeを起動済みの未割当セッション)
+        self._pool_size:int = max(0,min(pool_size,self.POOL_MAX_SIZE))
+        self.pool_idle_timeout:timedelta = timedelta(minutes=30)
+        self._pool:deque[BwSession] = deque()
+        self._pool_task:Task|None = None
+        self._pool_hits:int = 0
+        self._pool_misses:int = 0
+        # 接続待ちの行列(FIFO)
+        self._waiting:deque[AdmissionTicket] = deque()
+        self._admit_lock:asyncio.Lock = asyncio.Lock()
+        self._avg_session_sec:float = 300.0
+        self._llm_cache_path:str = os.path.join(self.SessionsDir,LLMCACHEFILE)
+        self._llm_cache:LLMCache = LLMCache(self._llm_cache_path)
         self._trans:Translate = Translate('ja', os.path.join(self.SessionsDir,'translate_cache.json'))
+        # 複数ノードで共有するレジストリ
+        self._registry:SessionRegistry = registry if registry is not None else LocalRegistry()
+        self.node_id:str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+        self.node_url:str = node_url or ""
+        self.node_host:str|None = node_host
+        self._last_heartbeat:float = 0.0
+        # 停止中(セッションを削除せずに中断する)
+        self.suspending:bool = False
+        # 前回の停止時に中断されて再開を待っているセッション (セッションID -> 作業ディレクトリ)
+        self._dormant:dict[str,str] = {}
+        # 終了したセッションのLLMの使用量の合計
+        self._usage_closed:dict = merge_usage([])
         # 設定
         self._operator_llm:LLM = LLM.Gemini20Flash
         self._planner_llm:LLM|None = None
 
+    async def start(self):
+        """サーバ起動時の初期化(スイーパーとウォームプールを開始)"""
+        self._watcher.bind(asyncio.get_running_loop())
+        if self._n_workers>0 and self._workers is None:
+            self._workers = ProcessTaskPool(self._n_workers, sessions_dir=self.SessionsDir)
+        self._prepare_profile()
+        self._dormant = await asyncio.to_thread(scan_checkpoints, self.SessionsDir, self.session_timeout.total_seconds())
+        for sid in self._dormant:
+            await asyncio.to_thread(self._registry.put_session, sid, self.node_id)
+        if self._dormant:
+            logger.info(f"dormant sessions {list(self._dormant)}")
+        await self._start_sweeper()
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(health_monitor.run(self._health_targets, probe_model))
+        await self.heartbeat()
+        self._refill_pool()
+
+    def _prepare_profile(self) -> None:
+        """バックグラウンドでプロファイルのテンプレートを作る"""
+        if self._profile_task is None and self._profile.needs_build():
+            def done(_):
+                self._profile_task = None
+            self._profile_task = asyncio.create_task(self._profile.prepare())
+            self._profile_task.add_done_callback(done)
+
+    def _health_targets(self) -> list[str]:
+        """状態を見ておくモデル(設定中のオペレータ、プランナ、抽出用)"""
+        models = [ self._operator_llm, LLM.get_lite_model(self._operator_llm) ]
+        if self._planner_llm is not None:
+            models.append(self._planner_llm)
+        return [ llm._full_name for llm in models ]
+
+    def _node_info(self) -> NodeInfo:
+        capacity = min( self._max_sessions, len(self.sessions) + len(self._pool) + self._headroom_slots() )
+        return NodeInfo( self.node_id, self.node_url, self.node_host or "", capacity, len(self.sessions)+len(self._waiting) )
+
+    async def heartbeat(self) -> None:
+        """レジストリに自ノードの容量と負荷を登録する"""
+        self._last_heartbeat = time.time()
+        try:
+            await asyncio.to_thread(self._registry.register_node, self._node_info())
+        except Exception:
+            logger.exception("can not register node")
+
+    async def place(self) -> NodeInfo|None:
+        """新しいセッションを置くノードを選ぶ。自ノードならNone"""
+        try:
+            best = await asyncio.to_thread(self._registry.least_loaded)
+        except Exception:
+            logger.exception("can not read registry")
+            return None
+        if best is None or best.node_id==self.node_id or not best.url:
+            return None
+        mine = self._node_info()
+        if mine.free()>0 and mine.free()/max(1,mine.capacity) >= best.free()/max(1,best.capacity):
+            return None
+        return best
+
+    async def locate(self, session_id:str|None) -> NodeInfo|None:
+        """他のノードが持っているセッションならそのノードを返す"""
+        if not session_id or session_id in self.sessions:
+            return None
+        try:
+            node = await asyncio.to_thread(self._registry.get_node, session_id)
+        except Exception:
+            logger.exception("can not read registry")
+            return None
+        if node is None or node.node_id==self.node_id or not node.url:
+            return None
+        return node
+
     async def _start_sweeper(self):
         if self._sweeper_task is None:
             self._sweeper_task = asyncio.create_task(self._sweeper_loop())
 
+    def _wakeup_sweeper(self) -> None:
+        self._sweeper_wakeup.set()
+
     async def _sweeper_loop(self):
+        """次の期限まで眠り、期限が来たセッションやプールをすぐに解放する"""
+        logger.info("start sweeper")
         try:
-            logger.info("start sweeper")
             while True:
-                # 広告ブロック用のhostsファイルを更新する
-                now = time.time()
-                last_mod_sec:float = os.path.getmtime(self.hostsfile) if os.path.exists(self.hostsfile) else 0.0
-                if (now-last_mod_sec)>3600.0:
-                    await download_hosts_file_async(self.hostsfile)
-                # セッションをクリーンアップする
-                await self.cleanup_old_sessions()
-                if len(self.sessions)==0:
-                    self._sweeper_task = None
-                    return
-                await asyncio.sleep(2.0)
-        except:
-            logger.exception("error in sweeper")
+                self._sweeper_wakeup.clear()
+                wake_at:float = time.time() + self.SWEEP_MAX_SEC
+                try:
+                    # 広告ブロックのリストを更新する
+                    wake_at = min( wake_at, await self._adblock.refresh() )
+                    # 使用量を測って、逼迫していれば解放、空いていれば行列を進める
+                    if (time.time()-self._last_sample)>=self.SAMPLE_SEC:
+                        await self.sample_resources()
+                    wake_at = min( wake_at, self._last_sample+self.SAMPLE_SEC )
+                    # 期限切れのセッションを解放する
+                    next_expiry = await self.cleanup_old_sessions()
+                    if next_expiry is not None:
+                        wake_at = min( wake_at, next_expiry )
+                    # 残存プロセスが終了したポートを回収する
+                    self._ports.reap()
+                    self._prepare_profile()
+                    if (time.time()-self._last_heartbeat)>=SessionRegistry.NODE_TTL/3:
+                        await self.heartbeat()
+                    # 古くなったプールを入れ替える
+                    next_pool = await self.expire_pool()
+                    if next_pool is not None:
+                        wake_at = min( wake_at, next_pool )
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("error in sweeper")
+                    wake_at = max( wake_at, time.time()+1.0 )
+                try:
+                    await asyncio.wait_for( self._sweeper_wakeup.wait(), timeout=max(0.0, wake_at-time.time()) )
+                except asyncio.TimeoutError:
+                    pass
         finally:
             logger.info("end sweeper")
             self._sweeper_task = None
 
-    async def cleanup_old_sessions(self):
-        """古いセッションをクリーンアップ"""
-        now = datetime.now()
-        if now - self._last_cleanup < self.cleanup_interval:
-            return
-        
-        expired_sessions = [
-            sid for sid, session in self.sessions.items()
-            if now - session.last_access > self.session_timeout
-        ]
-        
+    def _schedule_expiry(self, session:BwSession) -> None:
+        """セッションの期限をヒープに入れる"""
+        deadline = session.last_access.timestamp() + self.session_timeout.total_seconds()
+        # 削除済みセッションの古いエントリが溜まったら作り直す
+        if len(self._expiry) > 2*len(self.sessions)+16:
+            self._expiry = [ e for e in self._expiry if e[1] in self.sessions ]
+            heapq.heapify(self._expiry)
+        heapq.heappush(self._expiry, (deadline, session.session_id))
+        if self._expiry[0][1]==session.session_id:
+            self._wakeup_sweeper()
+
+    async def cleanup_old_sessions(self) -> float|None:
+        """期限切れのセッションをクリーンアップして、次の期限を返す"""
+        now = time.time()
+        timeout = self.session_timeout.total_seconds()
+        expired_sessions:list[str] = []
+        while len(self._expiry)>0 and self._expiry[0][0]<=now:
+            _,sid = heapq.heappop(self._expiry)
+            session = self.sessions.get(sid)
+            if session is None or sid in expired_sessions:
+                continue
+            deadline = session.last_access.timestamp() + timeout
+            if deadline>now:
+                # 期限後にアクセスがあったので入れ直す
+                heapq.heappush(self._expiry, (deadline, sid))
+            else:
+                expired_sessions.append(sid)
+
         for sid in expired_sessions:
-            session = self.sessions[sid]
+            logger.info(f"[{sid}] session expired")
+            await self._drop_session(sid, "セッションの有効期限が切れました")
+        if len(expired_sessions)>0:
+            await self.heartbeat()
+            await self._admit()
+            self._refill_pool()
+        await self._expire_dormant(now-timeout)
+        return self._expiry[0][0] if len(self._expiry)>0 else None
+
+    async def _expire_dormant(self, limit:float) -> None:
+        """再開されないまま期限が切れた中断セッションを削除する"""
+        for sid,workdir in list(self._dormant.items()):
+            try:
+                updated = os.path.getmtime(os.path.join(workdir,'checkpoint.json'))
+            except OSError:
+                updated = 0.0
+            if updated<limit:
+                logger.info(f"[{sid}] remove dormant session")
+                self._dormant.pop(sid,None)
+                await asyncio.to_thread(shutil.rmtree, workdir, True)
+                await asyncio.to_thread(self._registry.remove_session, sid)
+
+    def is_dormant(self, session_id:str|None) -> bool:
+        return session_id is not None and session_id in self._dormant
+
+    async def _drop_session(self, session_id:str, msg:str) -> None:
+        """クライアントに通知してセッションを解放する"""
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        self._usage_closed = merge_usage([self._usage_closed, session.get_usage()])
+        session.close_stream(msg)
+        await session.cleanup()
+        await asyncio.to_thread(self._registry.remove_session, session_id)
+
+    async def sample_resources(self) -> None:
+        """セッションごとのXvnc,Chromeのプロセスツリーとホストの使用量を測る"""
+        self._last_sample = time.time()
+        groups = { sid:session.pgids() for sid,session in self.sessions.items() }
+        for session in self._pool:
+            groups[session.session_id] = session.pgids()
+        await asyncio.to_thread(self._monitor.sample, groups)
+        # ブラウザが動いているセッションの平均から1セッションの見積もりを更新する
+        used = [ u.rss for sid,u in self._monitor.sessions.items() if u.rss>0 and len(groups.get(sid,[]))>=2 ]
+        if used:
+            self._est_session_mem = self._est_session_mem*0.8 + (sum(used)/len(used))*0.2
+        if self._under_pressure():
+            await self._relieve_pressure()
+        elif len(self._waiting)>0 and self._has_capacity():
+            await self._admit()
+
+    def _headroom_slots(self) -> int:
+        """メモリとCPUの余裕から、あと何セッション受け入れられるか"""
+        host = self._monitor.host
+        if host.mem_total<=0:
+            # 使用量が取れない環境では固定数で制限する
+            return max(0, self._max_sessions - len(self.sessions))
+        if host.cpu>self.cpu_limit:
+            return 0
+        # まだブラウザの使用量が測れていないセッションは見積もりで確保しておく
+        pending = 0
+        for session in list(self.sessions.values())+list(self._pool):
+            usage = self._monitor.get(session.session_id)
+            if usage is None or usage.rss<=0:
+                pending += 1
+        free = host.mem_available - self.mem_reserve - pending*self._est_session_mem
+        return max(0, int(free//max(1.0,self._est_session_mem)))
+
+    def _has_capacity(self) -> bool:
+        """新しいセッションを受け入れられるか(プールに起動済みがあれば追加のメモリは不要)"""
+        if len(self.sessions)>=self._max_sessions:
+            return False
+        return any( s.is_ready() for s in self._pool ) or self._headroom_slots()>0
+
+    def _under_pressure(self) -> bool:
+        host = self._monitor.host
+        return host.mem_total>0 and host.mem_available<self.mem_reserve
+
+    async def _relieve_pressure(self) -> None:
+        """メモリが逼迫しているので、プールから、無ければ最もアイドルなセッションから解放する"""
+        if len(self._pool)>0:
+            session = self._pool.pop()
+            logger.warning(f"[{session.session_id}] memory pressure, release pool")
             await session.cleanup()
-            del self.sessions[sid]
-        
-        self._last_cleanup = now
+            return
+        idle = [ s for s in self.sessions.values() if not s.is_task() ]
+        if not idle:
+            return
+        session = min( idle, key=lambda s: s.last_access )
+        logger.warning(f"[{session.session_id}] memory pressure, evict session")
+        self._evicted += 1
+        await self._drop_session(session.session_id, "メモリ不足のためセッションを終了しました")
+        await self.heartbeat()
+
+    def get_resource_status(self) ->dict:
+        host = self._monitor.host
+        mb = 1024*1024
+        return {
+            'mem_total_mb': host.mem_total//mb,
+            'mem_available_mb': host.mem_available//mb,
+            'mem_reserve_mb': self.mem_reserve//mb,
+            'cpu': host.cpu,
+            'session_mem_mb': int(self._est_session_mem//mb),
+            'headroom': self._headroom_slots(),
+            'evicted': self._evicted,
+            'sessions': { sid:{'rss_mb': u.rss//mb, 'cpu': u.cpu, 'procs': u.procs} for sid,u in self._monitor.sessions.items() },
+        }
 
     def setup_session( self, session:BwSession ):
         session._operator_llm = self._operator_llm
@@ -471,13 +926,20 @@ class SessionStore:
         for session_id,session in self.sessions.items():
             self.setup_session(session)
 
-    def configure(self, operator_llm:LLM, planner_llm:LLM|None, max_sessions:int ):
+    def configure(self, operator_llm:LLM, planner_llm:LLM|None, max_sessions:int, pool_size:int|None=None ):
         if max_sessions<0 or 20<max_sessions:
             raise ValueError(f"invalid number {max_sessions}")
+        if pool_size is not None and (pool_size<0 or self.POOL_MAX_SIZE<pool_size):
+            raise ValueError(f"invalid pool size {pool_size}")
         self._operator_llm = operator_llm
         self._planner_llm = planner_llm
         self._max_sessions = max_sessions
+        if pool_size is not None:
+            self._pool_size = pool_size
         self.setup_sessions()
+        self._refill_pool()
+        if len(self._waiting)>0:
+            asyncio.create_task(self._admit())
 
     async def incr(self):
         async with self._lock:
@@ -486,6 +948,12 @@ class SessionStore:
         async with self._lock:
             self._connect-=1
 
+    def get_waiting_status(self) ->dict:
+        return {
+            'waiting': len(self._waiting),
+            'avg_session_sec': round(self._avg_session_sec,1),
+        }
+
     async def get_status(self) ->tuple[int,int,int]:
         async with self._lock:
             return self._connect, len(self.sessions), self._max_sessions
@@ -498,21 +966,60 @@ class SessionStore:
             return session
         return None
 
-    async def create(self, server_addr:str, client_addr:str|None ) -> BwSession|None:
-        """新しいセッションを作成"""
-        if len(self.sessions)>=self._max_sessions:
-            return None
+    def _new_session(self, server_addr:str, client_addr:str|None ) -> BwSession:
         while True:
-            session_id = session_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-            if session_id not in self.sessions:
+            session_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+            if session_id not in self.sessions and all( s.session_id!=session_id for s in self._pool ):
                 break
         workdir = os.path.join( self.SessionsDir, f"session_{session_id}")
         logger.info(f"[{session_id}] create session")
         os.makedirs(workdir,exist_ok=False)
-        session = BwSession(session_id, server_addr=server_addr, client_addr=client_addr, dir=workdir, hostsfile=self.hostsfile, Pool=self.Pool, lock=self._lock2)
+        return BwSession(session_id, server_addr=server_addr, client_addr=client_addr, dir=workdir, adblock=self._adblock.path, runtime=self._runtime, workers=self._workers, lock=self._lock2, ports=self._ports, watcher=self._watcher, profile=self._profile)
+
+    async def _restore_session(self, session_id:str, server_addr:str, client_addr:str|None) -> BwSession|None:
+        """中断されたセッションを作業ディレクトリごと復元する"""
+        workdir = self._dormant.pop(session_id)
+        # BwSessionはループ上で作る(チェックポイントの読み込みだけスレッドで行う)
+        session = BwSession(session_id, server_addr=server_addr, client_addr=client_addr, dir=workdir, adblock=self._adblock.path, runtime=self._runtime, workers=self._workers, lock=self._lock2, ports=self._ports, watcher=self._watcher, profile=self._profile)
+        # プロファイルは作業ディレクトリに残っている
+        session._profile_cloned = True
+        try:
+            restored = await asyncio.to_thread(session.restore)
+        except Exception:
+            logger.exception(f"[{session_id}] can not restore session")
+            restored = False
+        if not restored:
+            # 復元できなくても期限切れで削除されるように残しておく
+            self._dormant[session_id] = workdir
+            return None
+        logger.info(f"[{session_id}] restore session")
+        return session
+
+    async def create(self, server_addr:str, client_addr:str|None, resume:str|None=None ) -> BwSession|None:
+        """新しいセッションを作成(resumeが中断されたセッションならそれを復元する)"""
+        if not self._has_capacity():
+            return None
+        session = None
+        if resume is not None and resume in self._dormant and resume not in self.sessions:
+            session = await self._restore_session(resume, server_addr, client_addr)
+        if session is not None:
+            pass
+        elif (session := await self._take_from_pool()) is not None:
+            self._pool_hits += 1
+            session.server_addr = server_addr
+            session.client_addr = client_addr
+            session.touch()
+        else:
+            self._pool_misses += 1
+            session = self._new_session(server_addr, client_addr)
+        session.started = datetime.now()
         self.setup_session(session)
-        self.sessions[session_id] = session
+        self.sessions[session.session_id] = session
+        self._schedule_expiry(session)
+        await asyncio.to_thread(self._registry.put_session, session.session_id, self.node_id)
+        await self.heartbeat()
         await self._start_sweeper()
+        self._refill_pool()
         return session
 
     async def remove(self, session_id: str) -> None:
@@ -520,14 +1027,226 @@ class SessionStore:
         if session_id in self.sessions:
             logger.info(f"[{session_id}] remove session")
             session = self.sessions[session_id]
-            await session.cleanup()
+            if self.suspending and session.checkpoint.resumable:
+                # 停止時は実行中のタスクを再開できるように残す
+                await session.suspend()
+            else:
+                await session.cleanup()
             del self.sessions[session_id]
+            self._usage_closed = merge_usage([self._usage_closed, session.get_usage()])
+            await asyncio.to_thread(self._registry.remove_session, session_id)
+            await self.heartbeat()
+            sec = (datetime.now()-session.started).total_seconds()
+            self._avg_session_sec = self._avg_session_sec*0.8 + sec*0.2
+            # 空いた枠を待っているクライアントに渡す
+            await self._admit()
+            self._refill_pool()
 
-    async def cleanup_all(self):
+    async def enqueue(self, server_addr:str, client_addr:str|None, resume:str|None=None ) -> AdmissionTicket:
+        """行列に並ぶ。空きがあればその場でセッションが割り当てられる"""
+        ticket = AdmissionTicket(server_addr, client_addr, resume)
+        self._waiting.append(ticket)
+        await self._admit()
+        return ticket
+
+    async def leave(self, ticket:AdmissionTicket) -> None:
+        """行列から抜ける(割り当て済みのセッションは削除する)"""
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            self._notify_waiting()
+        if ticket.session.done() and not ticket.session.cancelled() and ticket.session.exception() is None:
+            await self.remove(ticket.session.result().session_id)
+        else:
+            ticket.session.cancel()
+
+    def position(self, ticket:AdmissionTicket) -> int:
+        """行列の何番目か(1から)。並んでいなければ0"""
         try:
-            self.Pool.shutdown(wait=True,cancel_futures=True)
+            return self._waiting.index(ticket)+1
+        except ValueError:
+            return 0
+
+    def estimate_wait(self, position:int) -> float:
+        """待ち時間の見積もり(秒)"""
+        if position<=0:
+            return 0.0
+        return self._avg_session_sec * position / max(1,self._max_sessions)
+
+    def _notify_waiting(self) -> None:
+        for ticket in self._waiting:
+            ticket.notify()
+
+    async def _admit(self) -> None:
+        """空き枠を行列の先頭から順に割り当てる"""
+        async with self._admit_lock:
+            admitted = False
+            while len(self._waiting)>0 and self._has_capacity():
+                ticket = self._waiting.popleft()
+                admitted = True
+                if ticket.session.done():
+                    continue
+                try:
+                    session = await self.create(ticket.server_addr, ticket.client_addr, ticket.resume)
+                except Exception as ex:
+                    ticket.session.set_exception(ex)
+                    continue
+                if session is None:
+                    self._waiting.appendleft(ticket)
+                    break
+                ticket.session.set_result(session)
+            if admitted:
+                self._notify_waiting()
+
+    async def resume_task(self, session:BwSession) -> bool:
+        """チェックポイントに残っている中断されたタスクを再開する"""
+        if not session.checkpoint.resumable or session.is_task():
+            return False
+        data = dict(session.checkpoint.data)
+        try:
+            llm = LLM[data['llm']] if data.get('llm') else self._operator_llm
+            planner_llm = LLM[data['plan_llm']] if data.get('plan_llm') else None
+        except KeyError:
+            llm, planner_llm = self._operator_llm, self._planner_llm
+        await session.start_task(data.get('mode',0), data['prompt'], llm, planner_llm, self._llm_cache, self._trans, None, resume=data)
+        return True
+
+    def _pool_target(self) ->int:
+        """プールに保持する数(起動中のブラウザ総数がmax_sessionsとメモリの余裕を超えない範囲)"""
+        return max(0, min(self._pool_size, self._max_sessions - len(self.sessions), len(self._pool) + self._headroom_slots()))
+
+    async def _take_from_pool(self) -> BwSession|None:
+        """プールから起動済みのセッションを取り出す"""
+        while len(self._pool)>0:
+            session = self._pool.popleft()
+            if session.is_ready():
+                logger.info(f"[{session.session_id}] take from pool")
+                return session
+            await session.cleanup()
+        return None
+
+    def _refill_pool(self) -> None:
+        """バックグラウンドでプールを補充する"""
+        if self._pool_task is None and len(self._pool)<self._pool_target():
+            self._pool_task = asyncio.create_task(self._fill_pool())
+
+    async def _fill_pool(self) -> None:
+        try:
+            while len(self._pool)<self._pool_target():
+                session = self._new_session("", None)
+                try:
+                    async with self._lock2:
+                        await session.setup_vnc_server()
+                        await session.launch_chrome()
+                except Exception as ex:
+                    logger.warning(f"[{session.session_id}] can not prepare pool {str(ex)}")
+                    await session.cleanup()
+                    return
+                if not session.is_ready() or len(self._pool)>=self._pool_target():
+                    await session.cleanup()
+                    return
+                session.touch()
+                self._pool.append(session)
+                self._wakeup_sweeper()
+                logger.info(f"[{session.session_id}] add to pool {len(self._pool)}/{self._pool_target()}")
         except:
-            pass
+            logger.exception("error in pool")
+        finally:
+            self._pool_task = None
+
+    async def expire_pool(self) -> float|None:
+        """アイドル時間を超えたもの、停止したもの、上限を超えたものをプールから外して、次の期限を返す"""
+        now = datetime.now()
+        keep:deque[BwSession] = deque()
+        expired:list[BwSession] = []
+        target = self._pool_target()
+        for session in self._pool:
+            if len(keep)<target and session.is_ready() and now - session.last_access <= self.pool_idle_timeout:
+                keep.append(session)
+            else:
+                expired.append(session)
+        self._pool = keep
+        for session in expired:
+            logger.info(f"[{session.session_id}] expire from pool")
+            await session.cleanup()
+        if len(expired)>0:
+            self._refill_pool()
+        if len(self._pool)==0:
+            return None
+        return min( s.last_access for s in self._pool ).timestamp() + self.pool_idle_timeout.total_seconds()
+
+    def get_pool_status(self) ->dict:
+        total = self._pool_hits + self._pool_misses
+        return {
+            'size': len(self._pool),
+            'target': self._pool_target(),
+            'max': self._pool_size,
+            'hits': self._pool_hits,
+            'misses': self._pool_misses,
+            'hit_rate': round(self._pool_hits/total,3) if total>0 else 0.0,
+        }
+
+    def get_adblock_status(self) ->dict:
+        return self._adblock.get_status()
+
+    def get_profile_status(self) ->dict:
+        return self._profile.get_status()
+
+    def get_health_status(self) ->dict:
+        return health_monitor.get_status()
+
+    def get_cache_status(self) ->dict:
+        return self._llm_cache.get_status()
+
+    def get_hedge_status(self) ->list[dict]:
+        return get_hedge_status()
+
+    def get_coalesce_status(self) ->dict:
+        return get_coalesce_status()
+
+    def get_usage_status(self, detail:bool=False) ->dict:
+        """LLMの使用量。起動してからの合計とモデル別、detailなら接続中のセッション別も返す"""
+        sessions = { sid:session.get_usage() for sid,session in self.sessions.items() }
+        res = merge_usage([self._usage_closed, *sessions.values()])
+        if detail:
+            res['sessions'] = sessions
+        return res
+
+    def get_ports_status(self) ->dict:
+        return self._ports.get_status()
+
+    def get_runtime_status(self) ->dict:
+        res = self._runtime.get_status()
+        if self._workers is not None:
+            res['process'] = self._workers.get_status()
+        return res
+
+    async def cleanup_all(self):
+        # 実行中のタスクはチェックポイントを残して中断する
+        self.suspending = True
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+        if self._profile_task is not None:
+            self._profile_task.cancel()
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        while len(self._waiting)>0:
+            self._waiting.popleft().session.cancel()
+        self._pool_size = 0
+        if self._pool_task is not None:
+            self._pool_task.cancel()
+        while len(self._pool)>0:
+            await self._pool.popleft().cleanup()
         for session_id in list(self.sessions.keys()):
             await self.remove(session_id)
+        try:
+            self._registry.unregister_node(self.node_id)
+        except:
+            pass
+        try:
+            self._runtime.shutdown()
+            if self._workers is not None:
+                self._workers.shutdown()
+        except:
+            pass
 
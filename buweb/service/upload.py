@@ -0,0 +1,109 @@
+import os
+import asyncio
+from typing import AsyncIterable
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NeedData
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class QuotaExceededException(Exception):
+    pass
+
+def sanitize_filename(filename:str|None) -> str|None:
+    """パスを取り除いたファイル名(使えない名前ならNone)"""
+    if not filename:
+        return None
+    name = os.path.basename(filename.replace('\\','/')).strip()
+    name = ''.join( c for c in name if c>=' ' and c!='\x7f' )
+    if name in ('','.','..'):
+        return None
+    return name
+
+class UploadWriter:
+    """アップロードされたデータを一時ファイルにまとめて書き、完了したら置き換える
+
+    書き込みはスレッドで行い、イベントループを止めない。
+    """
+    BUFFER_SIZE:int = 1024*1024
+
+    def __init__(self, path:str, limit:int):
+        self.path:str = path
+        self.size:int = 0
+        self._limit:int = limit
+        self._tmp:str = f"{path}.part"
+        self._buf:bytearray = bytearray()
+        self._fp = None
+
+    async def open(self) -> None:
+        self._fp = await asyncio.to_thread(open, self._tmp, 'wb')
+
+    async def write(self, data:bytes) -> None:
+        self.size += len(data)
+        if self.size>self._limit:
+            raise QuotaExceededException(f"アップロードできる容量を超えました")
+        self._buf += data
+        if len(self._buf)>=self.BUFFER_SIZE:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if self._buf and self._fp is not None:
+            buf = bytes(self._buf)
+            self._buf.clear()
+            await asyncio.to_thread(self._fp.write, buf)
+
+    async def close(self) -> None:
+        """書き込みを完了する"""
+        await self._flush()
+        if self._fp is not None:
+            fp, self._fp = self._fp, None
+            await asyncio.to_thread(fp.close)
+            await asyncio.to_thread(os.replace, self._tmp, self.path)
+
+    async def abort(self) -> None:
+        """書きかけのファイルを消す"""
+        self._buf.clear()
+        if self._fp is not None:
+            fp, self._fp = self._fp, None
+            await asyncio.to_thread(fp.close)
+        try:
+            await asyncio.to_thread(os.unlink, self._tmp)
+        except OSError:
+            pass
+
+async def receive_multipart(body:AsyncIterable[bytes], boundary:str, open_file, *, field:str='file', sizes:dict[str,int]|None=None) -> list[str]:
+    """multipart/form-dataを受信しながらfieldのファイルを書き込む
+
+    open_file(filename, sizes)はUploadWriterを返すコルーチン。sizesはこのリクエストで
+    書き終えたファイルのサイズで、残りの容量から引くのに使う。途中で例外になっても
+    書き終えたファイルが分かるように呼び出し側が渡すこともできる。保存したファイル名の一覧を返す。
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    if sizes is None:
+        sizes = {}
+    writer:UploadWriter|None = None
+    try:
+        async def drain() -> bool:
+            nonlocal writer
+            while True:
+                event = decoder.next_event()
+                if isinstance(event, NeedData):
+                    return False
+                if isinstance(event, Epilogue):
+                    return True
+                if isinstance(event, File) and event.name==field:
+                    writer = await open_file(event.filename, sizes)
+                elif isinstance(event, Data) and writer is not None:
+                    await writer.write(event.data)
+                    if not event.more_data:
+                        await writer.close()
+                        sizes[os.path.basename(writer.path)] = writer.size
+                        writer = None
+        async for chunk in body:
+            decoder.receive_data(chunk)
+            if await drain():
+                return list(sizes)
+        decoder.receive_data(None)
+        await drain()
+        return list(sizes)
+    finally:
+        if writer is not None:
+            await writer.abort()
@@ -0,0 +1,284 @@
+import os
+import asyncio
+import multiprocessing
+from multiprocessing.process import BaseProcess
+from concurrent.futures import Future
+from threading import Thread, Lock, Timer
+from typing import Any, Callable
+from langchain_core.caches import BaseCache
+from buweb.model.cache import LLMCache, LLMCACHEFILE
+from browser_use import Browser
+from buweb.model.model import LLM, RATELIMITFILE, set_rate_limit_db
+from buweb.model.usage import UsageScope, usage_scope
+from buweb.model.translate import Translate
+from buweb.agent.buw_agent import BuwWriter
+from buweb.task.operator import BwTask
+from buweb.task.research import BwResearchTask
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class WorkerCrashedException(Exception):
+    pass
+
+def build_task(mode:int, *, dir:str, llm_cache:BaseCache|None, llm:LLM, plan_llm:LLM|None,
+               cdp_port:int, browser:Browser|None, sensitive_data:dict[str,str]|None, writer:BuwWriter,
+               available_file_paths:list[str]|None=None,
+               resume:dict|None=None, checkpoint:Callable[[dict],None]|None=None) -> BwTask|BwResearchTask:
+    """modeに応じたタスクを作る(1:リサーチ それ以外:オペレータ)"""
+    if mode==1:
+        return BwResearchTask( dir=dir,
+                        llm_cache=llm_cache, llm=llm, plan_llm=plan_llm,
+                        cdp_port=cdp_port, browser=browser,
+                        sensitive_data=sensitive_data,
+                        available_file_paths=available_file_paths,
+                        resume=resume, checkpoint=checkpoint,
+                        writer=writer)
+    else:
+        return BwTask( dir=dir,
+                        llm_cache=llm_cache, llm=llm, plan_llm=plan_llm,
+                        cdp_port=cdp_port, browser=browser,
+                        sensitive_data=sensitive_data,
+                        available_file_paths=available_file_paths,
+                        resume=resume, checkpoint=checkpoint,
+                        writer=writer)
+
+#---------------------------------
+# ワーカープロセス側
+#---------------------------------
+def _worker_main(cmd_queue, event_queue, sessions_dir:str) -> None:
+    asyncio.run(_worker_loop(cmd_queue, event_queue, sessions_dir))
+
+async def _worker_loop(cmd_queue, event_queue, sessions_dir:str) -> None:
+    loop = asyncio.get_running_loop()
+    set_rate_limit_db(os.path.join(sessions_dir,RATELIMITFILE))
+    llm_cache:BaseCache = LLMCache(os.path.join(sessions_dir,LLMCACHEFILE))
+    trans:Translate = Translate('ja', os.path.join(sessions_dir,'translate_cache.json'))
+    running:dict[str,tuple[asyncio.Task,dict]] = {}
+    exit_future:asyncio.Future = loop.create_future()
+
+    async def run(task_id:str, args:dict) -> None:
+        holder:dict = running[task_id][1]
+        def write(*msg):
+            event_queue.put( (task_id,'log',msg) )
+        def checkpoint(data:dict):
+            event_queue.put( (task_id,'checkpoint',data) )
+        def report(*chunk):
+            event_queue.put( (task_id,'report',chunk) )
+        def usage(data:dict):
+            event_queue.put( (task_id,'usage',(args['n_task'],data)) )
+        buw = BuwWriter( n_task=args['n_task'], writer=write, trans=trans, reporter=report )
+        scope = UsageScope(step=buw.step_key, listener=usage)
+        usage_scope.set(scope)
+        task:BwTask|BwResearchTask|None = None
+        try:
+            task = build_task( args['mode'], dir=args['dir'], llm_cache=llm_cache,
+                            llm=LLM[args['llm']], plan_llm=LLM[args['plan_llm']] if args['plan_llm'] else None,
+                            cdp_port=args['cdp_port'], browser=None,
+                            sensitive_data=args['sensitive_data'], writer=buw,
+                            available_file_paths=args.get('available_file_paths'),
+                            resume=args.get('resume'), checkpoint=checkpoint )
+            holder['task'] = task
+            await task.start(args['prompt'])
+            await task.stop()
+            scope.flush()
+            event_queue.put( (task_id,'done',None) )
+        except asyncio.CancelledError:
+            scope.flush()
+            event_queue.put( (task_id,'error','cancelled') )
+        except Exception as ex:
+            logger.exception(f"[{task_id}] {str(ex)}")
+            scope.flush()
+            event_queue.put( (task_id,'error',str(ex)) )
+        finally:
+            if task is not None:
+                await task.close()
+            running.pop(task_id,None)
+
+    async def stop(task_id:str, suspend:bool) -> None:
+        item = running.get(task_id)
+        if item is None:
+            return
+        atask,holder = item
+        task = holder.get('task')
+        if task is not None:
+            await task.stop(suspend)
+        try:
+            await asyncio.wait_for(asyncio.shield(atask), timeout=5.0)
+        except (asyncio.TimeoutError, asyncio.CancelledError, Exception):
+            atask.cancel()
+
+    def on_command(cmd:tuple) -> None:
+        if cmd[0]=='run':
+            _,task_id,args = cmd
+            running[task_id] = (loop.create_task(run(task_id,args)), {})
+        elif cmd[0]=='stop':
+            loop.create_task(stop(cmd[1], cmd[2]))
+        elif cmd[0]=='exit' and not exit_future.done():
+            exit_future.set_result(None)
+
+    def read_commands() -> None:
+        while True:
+            cmd = cmd_queue.get()
+            loop.call_soon_threadsafe(on_command, cmd)
+            if cmd[0]=='exit':
+                return
+    Thread(target=read_commands, name="worker-cmd", daemon=True).start()
+    await exit_future
+    for atask,_ in list(running.values()):
+        atask.cancel()
+
+#---------------------------------
+# メインプロセス側
+#---------------------------------
+class _TaskHandle:
+    def __init__(self, worker:"_Worker", writer:Callable[...,None], checkpoint:Callable[[dict],None]|None, reporter:Callable[...,None]|None, usage:Callable[...,None]|None):
+        self.worker:_Worker = worker
+        self.writer:Callable[...,None] = writer
+        self.checkpoint:Callable[[dict],None]|None = checkpoint
+        self.reporter:Callable[...,None]|None = reporter
+        self.usage:Callable[...,None]|None = usage
+        self.future:Future[None] = Future()
+
+class _Worker:
+    def __init__(self, idx:int, proc:BaseProcess, cmd_queue):
+        self.idx:int = idx
+        self.proc:BaseProcess = proc
+        self.cmd_queue = cmd_queue
+        self.tasks:set[str] = set()
+
+class ProcessTaskPool:
+    """タスクをワーカープロセスで実行する
+
+    GILを避けてセッション数に応じてCPUコアを使えるようにする。
+    ワーカーが落ちた場合やstop後も止まらないタスクはそのワーカーだけを作り直すので、
+    他のワーカーで動いているセッションには影響しない。
+    """
+    def __init__(self, n_workers:int|None=None, *, sessions_dir:str, stop_timeout:float=15.0):
+        self._ctx = multiprocessing.get_context('spawn')
+        self._n_workers:int = max(1, n_workers if n_workers else (os.cpu_count() or 1))
+        self._sessions_dir:str = sessions_dir
+        self._stop_timeout:float = stop_timeout
+        self._lock:Lock = Lock()
+        self._closed:bool = False
+        self._event_queue = self._ctx.Queue()
+        self._tasks:dict[str,_TaskHandle] = {}
+        self._restarts:int = 0
+        self._workers:list[_Worker] = [ self._spawn(i) for i in range(self._n_workers) ]
+        Thread(target=self._read_events, name="worker-events", daemon=True).start()
+
+    def _spawn(self, idx:int) -> _Worker:
+        cmd_queue = self._ctx.Queue()
+        proc = self._ctx.Process(target=_worker_main, args=(cmd_queue, self._event_queue, self._sessions_dir), name=f"task-worker-{idx}", daemon=True)
+        proc.start()
+        worker = _Worker(idx, proc, cmd_queue)
+        Thread(target=self._watch, args=(worker,), name=f"worker-watch-{idx}", daemon=True).start()
+        logger.info(f"start worker {idx} pid:{proc.pid}")
+        return worker
+
+    def _watch(self, worker:_Worker) -> None:
+        """ワーカーの終了を待って、実行中だったタスクを失敗させて作り直す"""
+        worker.proc.join()
+        with self._lock:
+            lost = [ self._tasks.pop(tid) for tid in worker.tasks if tid in self._tasks ]
+            worker.tasks.clear()
+            if not self._closed:
+                logger.warning(f"worker {worker.idx} exited code:{worker.proc.exitcode}")
+                self._restarts += 1
+                self._workers[worker.idx] = self._spawn(worker.idx)
+        for handle in lost:
+            if not handle.future.done():
+                handle.future.set_exception(WorkerCrashedException(f"ワーカーが停止しました code:{worker.proc.exitcode}"))
+
+    def _read_events(self) -> None:
+        while True:
+            try:
+                item = self._event_queue.get()
+            except (EOFError, OSError):
+                return
+            if item is None:
+                return
+            task_id,kind,payload = item
+            with self._lock:
+                handle = self._tasks.get(task_id)
+                if handle is not None and kind not in ('log','checkpoint','report','usage'):
+                    self._tasks.pop(task_id,None)
+                    handle.worker.tasks.discard(task_id)
+            if handle is None:
+                continue
+            if kind=='log':
+                try:
+                    handle.writer(*payload)
+                except Exception:
+                    logger.exception(f"[{task_id}] error in writer")
+            elif kind=='checkpoint':
+                if handle.checkpoint is not None:
+                    try:
+                        handle.checkpoint(payload)
+                    except Exception:
+                        logger.exception(f"[{task_id}] error in checkpoint")
+            elif kind=='report':
+                if handle.reporter is not None:
+                    try:
+                        handle.reporter(*payload)
+                    except Exception:
+                        logger.exception(f"[{task_id}] error in reporter")
+            elif kind=='usage':
+                if handle.usage is not None:
+                    try:
+                        handle.usage(*payload)
+                    except Exception:
+                        logger.exception(f"[{task_id}] error in usage")
+            elif kind=='done':
+                handle.future.set_result(None)
+            else:
+                handle.future.set_exception(RuntimeError(payload))
+
+    def submit(self, task_id:str, args:dict[str,Any], writer:Callable[...,None], checkpoint:Callable[[dict],None]|None=None, reporter:Callable[...,None]|None=None, usage:Callable[...,None]|None=None) -> Future[None]:
+        """空いているワーカーにタスクを投入する。ログはwriter、進捗はcheckpoint、レポートはreporter、LLMの使用量はusageに渡される"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("worker pool is closed")
+            worker = min(self._workers, key=lambda w: len(w.tasks))
+            handle = _TaskHandle(worker, writer, checkpoint, reporter, usage)
+            self._tasks[task_id] = handle
+            worker.tasks.add(task_id)
+            worker.cmd_queue.put( ('run',task_id,args) )
+        return handle.future
+
+    def cancel(self, task_id:str, suspend:bool=False) -> None:
+        """タスクを止める。stop_timeout秒経っても止まらなければワーカーごと停止する"""
+        with self._lock:
+            handle = self._tasks.get(task_id)
+            if handle is None:
+                return
+            handle.worker.cmd_queue.put( ('stop',task_id,suspend) )
+        def kill():
+            if not handle.future.done() and handle.worker.proc.is_alive():
+                logger.warning(f"[{task_id}] task did not stop, kill worker {handle.worker.idx}")
+                handle.worker.proc.kill()
+        timer = Timer(self._stop_timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self._n_workers,
+                'running': [ len(w.tasks) for w in self._workers ],
+                'restarts': self._restarts,
+            }
+
+    def shutdown(self, timeout:float=10.0) -> None:
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.cmd_queue.put( ('exit',) )
+            except Exception:
+                pass
+        for worker in workers:
+            worker.proc.join(timeout)
+            if worker.proc.is_alive():
+                worker.proc.kill()
+        self._event_queue.put(None)
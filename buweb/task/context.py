@@ -0,0 +1,40 @@
+from browser_use import Browser
+from browser_use.browser.context import BrowserContext, BrowserContextConfig
+from playwright.async_api import Browser as PlaywrightBrowser, BrowserContext as PlaywrightBrowserContext
+from logging import Logger,getLogger
+logger:Logger = getLogger(__name__)
+
+class BwBrowserContext(BrowserContext):
+    """storage_stateを渡すと、作成時にそのクッキーを復元するコンテキスト
+
+    広告・トラッカーの遮断はセッション側(CdpAdBlocker)がChromeの起動中ずっと行う。
+    """
+
+    def __init__(self, browser:Browser, config:BrowserContextConfig=BrowserContextConfig(), *, storage_state:dict|None=None, **kwargs):
+        super().__init__(browser, config, **kwargs)
+        self._storage_state:dict|None = storage_state
+        self._context:PlaywrightBrowserContext|None = None
+
+    async def _create_context(self, browser:PlaywrightBrowser) -> PlaywrightBrowserContext:
+        context = await super()._create_context(browser)
+        self._context = context
+        if self._storage_state and self._storage_state.get('cookies'):
+            try:
+                await context.add_cookies(self._storage_state['cookies'])
+            except Exception as ex:
+                logger.warning(f"can not restore cookies {str(ex)}")
+            self._storage_state = None
+        return context
+
+    async def get_storage_state(self) -> dict|None:
+        """クッキーとlocalStorage(チェックポイント用)"""
+        if self._context is None:
+            return None
+        try:
+            return dict(await self._context.storage_state())
+        except Exception:
+            return None
+
+    async def close(self) -> None:
+        self._context = None
+        await super().close()
@@ -32,7 +32,12 @@ from logging import Logger,getLogger, ERROR as LogError
 
 from buweb.agent.buw_agent import BuwWriter, BuwAgent
 from buweb.controller.buw_controller import BwController
-from buweb.model.model import LLM, create_model
+from buweb.task.context import BwBrowserContext
+from buweb.model.model import LLM, create_model, create_hedged_model, probe_model, tool_calling_method
+from buweb.model.health import health_monitor
+from buweb.model.cache import LLMCache, LLMCACHEFILE
+from buweb.model.retry import retry_listener
+from buweb.utils.utils import safe_close
 
 logger:Logger = getLogger(__name__)
 
@@ -43,11 +48,14 @@ class BwTask:
     def __init__(self,*, dir:str,
                 llm_cache:BaseCache|None=None, llm:LLM=LLM.Gpt4oMini, plan_llm:LLM|None=None,
                 chrome_instance_path:str|None=None, cdp_port:int|None=None, trace_path:str|None=None,
+                browser:Browser|None=None,
                 sensitive_data:dict[str,str]|None=None,
+                available_file_paths:list[str]|None=None,
+                resume:dict|None=None, checkpoint:Callable[[dict],None]|None=None,
                 writer:BuwWriter|None=None):
         self._work_dir:str = dir
         if llm_cache is None:
-            llm_cache = SQLiteCache( os.path.join(dir,'langchain_cache.db') )
+            llm_cache = LLMCache( os.path.join(dir,LLMCACHEFILE) )
         self._operator_llm:LLM = llm
         self._plan_llm:LLM|None = plan_llm
         self._llm_cache:BaseCache = llm_cache
@@ -58,27 +66,37 @@ class BwTask:
             viewport_expansion=0,
             browser_window_size={'width':1366,'height':768},
         )
-        if isinstance(cdp_port,int) and cdp_port>0:
-            bw_config = BrowserConfig(
-                cdp_url=f"http://127.0.0.1:{cdp_port}"
-            )
+        # 渡されたブラウザはタスク終了後も閉じない
+        self._own_browser:bool = browser is None
+        if browser is not None:
+            self._browser:Browser = browser
         else:
-            p = None
-            for p in [ chrome_instance_path, "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "/usr/bin/google-chrome", "/opt/google/chrome/google-chrome" ]:
-                if p and os.path.exists( p ):
-                    chrome_instance_path = p
-                    break
-            if p is None:
-                raise ValueError("")
-            bw_config = BrowserConfig(
-                #chrome_instance_path=chrome_instance_path,
-                #extra_chromium_args=[str(self.display_number)],
-            )
+            if isinstance(cdp_port,int) and cdp_port>0:
+                bw_config = BrowserConfig(
+                    cdp_url=f"http://127.0.0.1:{cdp_port}"
+                )
+            else:
+                p = None
+                for p in [ chrome_instance_path, "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "/usr/bin/google-chrome", "/opt/google/chrome/google-chrome" ]:
+                    if p and os.path.exists( p ):
+                        chrome_instance_path = p
+                        break
+                if p is None:
+                    raise ValueError("")
+                bw_config = BrowserConfig(
+                    #chrome_instance_path=chrome_instance_path,
+                    #extra_chromium_args=[str(self.display_number)],
+                )
 
-        self._browser:Browser = Browser( bw_config )
-        self._browser_context:BrowserContext = BrowserContext( self._browser, bw_context_config)
+            self._browser = Browser( bw_config )
+        self._browser_context:BwBrowserContext = BwBrowserContext( self._browser, bw_context_config,
+                                                                   storage_state=resume.get('storage_state') if resume else None )
         self._agent:BuwAgent|None = None
         self._sensitive_data=sensitive_data
+        self._available_file_paths:list[str]|None = available_file_paths
+        # 中断前の状態と、進捗を保存するコールバック
+        self._resume:dict = resume or {}
+        self._checkpoint:Callable[[dict],None]|None = checkpoint
 
     def logPrint(self,msg):
         if self._writer is not None:
@@ -92,7 +110,12 @@ class BwTask:
         else:
             logger.info( f"##logPrint {msg}")
 
+    def _on_retry(self, name:str, wait:float, ex:BaseException) -> None:
+        self.logPrint(f"{name}: {type(ex).__name__} {wait:.0f}秒後に再試行します")
+
     async def start(self,task:str):
+        # このタスク内のLLM呼び出しの再試行を通知する
+        retry_listener.set(self._on_retry)
 
         alog=getLogger("browser_use")
         alog.setLevel(LogError)
@@ -105,13 +128,18 @@ class BwTask:
         x_extractor = LLM.get_lite_model(self._operator_llm)
         self.logPrint(f"extractor:{x_extractor._full_name}")
         llm_cache:BaseCache = self._llm_cache
-        operator_llm:BaseChatModel = create_model(self._operator_llm, cache=llm_cache)
-        test_res = await operator_llm.ainvoke(f"{now_datetime}動作テストです。正常稼働ならYesを返信して。")
-        extraction_llm:BaseChatModel = create_model(x_extractor, cache=llm_cache)
+        operator_llm:BaseChatModel = create_hedged_model(self._operator_llm, cache=llm_cache)
+        if not health_monitor.is_healthy(self._operator_llm._full_name):
+            # 直近で失敗が続いているときだけ、キャッシュを通さずに呼び出して確認する
+            await probe_model(self._operator_llm)
+        extraction_llm:BaseChatModel = create_hedged_model(x_extractor, cache=llm_cache)
         planner_llm:BaseChatModel|None = create_model(self._plan_llm, cache=llm_cache) if self._plan_llm is not None else None
 
-        plan_text:str|None = None
-        if planner_llm is not None:
+        # 中断したタスクを再開する場合は前回のプランと進捗を使う
+        resumed:dict = self._resume.get('operator') or {}
+        steps:list[dict] = list(resumed.get('steps',[]))
+        plan_text:str|None = resumed.get('plan')
+        if planner_llm is not None and not resumed:
             pre_prompt = [
                 "現在時刻:{now_datetime}",
                 "ブラウザを使って以下のタスクを実行するために、目的、ブラウザで収集すべき情報、手順、ゴールを考えて、簡潔で短い文章で実行プランを出力して。",
@@ -129,6 +157,25 @@ class BwTask:
         if plan_text is not None:
             web_task += f"\n\n実行プラン:\n{plan_text}"
         web_task += f"\n\n# 作業手順\n与えられたタスクと設定したゴールを満たしたか考えながら実行プランにそって実行して下さい。必要に応じて前の作業にもどったりプランを修正することも可能です。"
+        if steps:
+            done = "\n".join( f"{i+1}. {st.get('goal','')} {st.get('memory','')} {st.get('result','')} ({st.get('url','')})" for i,st in enumerate(steps) )
+            web_task += f"\n\n# 中断前の進捗\nこのタスクは中断されたので途中から再開します。以下のステップは完了済みです。\n{done}"
+            self.logPrint(f"{len(steps)}ステップ目から再開します")
+        await self._save_checkpoint({'operator': {'plan': plan_text, 'steps': list(steps)}})
+
+        async def on_step(agent:BuwAgent) -> None:
+            if not agent.state.history.history:
+                return
+            item = agent.state.history.history[-1]
+            out = item.model_output
+            result = " ".join( r.extracted_content for r in item.result if r.extracted_content )
+            steps.append({
+                'goal': out.current_state.next_goal if out else '',
+                'memory': out.current_state.memory if out else '',
+                'result': result[:500],
+                'url': item.state.url,
+            })
+            await self._save_checkpoint({'operator': {'plan': plan_text, 'steps': list(steps)}})
 
         #---------------------------------
         #br_context = await self.get_browser_context()
@@ -143,13 +190,15 @@ class BwTask:
             self._agent = BuwAgent(
                 task=web_task,
                 llm=operator_llm, page_extraction_llm=extraction_llm, planner_llm=planner_llm, planner_interval=1,
+                tool_calling_method=tool_calling_method(operator_llm), # type: ignore[arg-type]
                 use_vision=False,
                 controller=wcnt,
                 browser=self._browser,
                 browser_context=self._browser_context,
                 sensitive_data=self._sensitive_data,
+                available_file_paths=self._available_file_paths,
             )
-            result: AgentHistoryList = await self._agent.run(wr=self._writer)
+            result: AgentHistoryList = await self._agent.run(max_steps=max(1,100-len(steps)), wr=self._writer, on_step=on_step)
             if result.is_done():
                 final_str = result.final_result()
         except Exception as ex:
@@ -159,22 +208,36 @@ class BwTask:
             self._agent = None
         #---------------------------------
         if final_str:
-            post_llm = create_model(LLM.Gemini20Flash) # ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
+            post_llm = create_model(LLM.get_report_model(self._operator_llm), cache=llm_cache) # ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
             report_task = f"# 現在時刻: {now_datetime}\n\n# 与えられたタスク:\n{task}"
             if plan_text is not None:
                 report_task += f"\n\n# 実行プラン:\n{plan_text}"
             report_task += f"\n\n# 実行結果\n{final_str}\n\n# 実行結果の内容を日本語でレポートしてください。"
-            post_result:BaseMessage = await post_llm.ainvoke( report_task )
-            if isinstance(post_result.content,str):
-                report = post_result.content
-            else:
-                report = final_str
             self.logPrint("---------------------------------")
-            self.logPrint(report)
+            # レポートは生成しながらreportイベントで送る
+            report = await self._writer.stream_report( post_llm, report_task, title="レポート" )
+            if not report:
+                self.logPrint(final_str)
     
-    async def stop(self):
+    async def stop(self, suspend:bool=False):
+        """タスクを止める(suspend=Trueは再開のための中断)"""
         try:
             if self._agent is not None:
                 self._agent.stop()
         except:
-            pass
\ No newline at end of file
+            pass
+
+    async def _save_checkpoint(self, data:dict) -> None:
+        """進捗とブラウザのstorage stateを保存する"""
+        if self._checkpoint is None:
+            return
+        state = await self._browser_context.get_storage_state()
+        if state:
+            data['storage_state'] = state
+        await asyncio.to_thread(self._checkpoint, data)
+
+    async def close(self):
+        """コンテキストと自分で作ったブラウザを閉じる"""
+        await safe_close(self._browser_context)
+        if self._own_browser:
+            await safe_close(self._browser)
\ No newline at end of file
@@ -29,7 +29,11 @@ from logging import Logger,getLogger
 
 from buweb.agent.buw_agent import BuwAgent, BuwWriter
 from buweb.controller.buw_controller import BwController
-from buweb.model.model import LLM, create_model
+from buweb.task.context import BwBrowserContext
+from buweb.model.model import LLM, create_model, create_hedged_model, probe_model
+from buweb.model.health import health_monitor
+from buweb.model.cache import LLMCache, LLMCACHEFILE
+from buweb.model.retry import retry_listener
 from buweb.Research.task.deep_research import deep_research
 
 logger:Logger = getLogger(__name__)
@@ -47,11 +51,14 @@ class BwResearchTask:
     def __init__(self,*, dir:str,
                 llm_cache:BaseCache|None=None, llm:LLM=LLM.Gpt4oMini, plan_llm:LLM|None=None,
                 chrome_instance_path:str|None=None, cdp_port:int|None=None, trace_path:str|None=None,
+                browser:Browser|None=None,
                 sensitive_data:dict[str,str]|None=None,
+                available_file_paths:list[str]|None=None,
+                resume:dict|None=None, checkpoint:Callable[[dict],None]|None=None,
                 writer:BuwWriter|None=None):
         self._work_dir:str = dir
         if llm_cache is None:
-            llm_cache = SQLiteCache( os.path.join(dir,'langchain_cache.db') )
+            llm_cache = LLMCache( os.path.join(dir,LLMCACHEFILE) )
         self._operator_llm:LLM = llm
         self._plan_llm:LLM|None = plan_llm
         self._llm_cache:BaseCache = llm_cache
@@ -62,27 +69,37 @@ class BwResearchTask:
             viewport_expansion=0,
             browser_window_size={'width':1366,'height':768},
         )
-        if isinstance(cdp_port,int) and cdp_port>0:
-            bw_config = BrowserConfig(
-                cdp_url=f"http://127.0.0.1:{cdp_port}"
-            )
+        # 渡されたブラウザはタスク終了後も閉じない
+        self._own_browser:bool = browser is None
+        if browser is not None:
+            self._browser:Browser = browser
         else:
-            p = None
-            for p in [ chrome_instance_path, "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "/usr/bin/google-chrome", "/opt/google/chrome/google-chrome" ]:
-                if p and os.path.exists( p ):
-                    chrome_instance_path = p
-                    break
-            if p is None:
-                raise ValueError("")
-            bw_config = BrowserConfig(
-                #chrome_instance_path=chrome_instance_path,
-                #extra_chromium_args=[str(self.display_number)],
-            )
-
-        self._browser:Browser = Browser( bw_config )
-        self._browser_context:BrowserContext = BrowserContext( self._browser, bw_context_config)
+            if isinstance(cdp_port,int) and cdp_port>0:
+                bw_config = BrowserConfig(
+                    cdp_url=f"http://127.0.0.1:{cdp_port}"
+                )
+            else:
+                p = None
+                for p in [ chrome_instance_path, "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome", "/usr/bin/google-chrome", "/opt/google/chrome/google-chrome" ]:
+                    if p and os.path.exists( p ):
+                        chrome_instance_path = p
+                        break
+                if p is None:
+                    raise ValueError("")
+                bw_config = BrowserConfig(
+                    #chrome_instance_path=chrome_instance_path,
+                    #extra_chromium_args=[str(self.display_number)],
+                )
+
+            self._browser = Browser( bw_config )
+        self._browser_context:BwBrowserContext = BwBrowserContext( self._browser, bw_context_config,
+                                                                   storage_state=resume.get('storage_state') if resume else None )
         self._inter:dict = {}
         self._sensitive_data=sensitive_data
+        self._available_file_paths:list[str]|None = available_file_paths
+        # 中断前の状態と、進捗を保存するコールバック
+        self._resume:dict = resume or {}
+        self._checkpoint:Callable[[dict],None]|None = checkpoint
 
     def logPrint(self,msg):
         if self._writer is not None:
@@ -97,7 +114,12 @@ class BwResearchTask:
         else:
             logger.info(f"{title}: {msg}")
 
+    def _on_retry(self, name:str, wait:float, ex:BaseException) -> None:
+        self.logPrint(f"{name}: {type(ex).__name__} {wait:.0f}秒後に再試行します")
+
     async def start(self,task:str):
+        # このタスク内のLLM呼び出しの再試行を通知する
+        retry_listener.set(self._on_retry)
 
         now = datetime.now()
         now_datetime = now.strftime("%A, %Y-%m-%d %H:%M")
@@ -110,13 +132,16 @@ class BwResearchTask:
         if x_extractor:
             self.logPrint(f"extractor:{x_extractor._full_name}")
         llm_cache:BaseCache = self._llm_cache
-        operator_llm:BaseChatModel = create_model(self._operator_llm, cache=llm_cache)
-        test_res = await operator_llm.ainvoke("動作テストです。正常稼働ならYesを返信して。")
-        extraction_llm:BaseChatModel = create_model(x_extractor, cache=llm_cache)
+        operator_llm:BaseChatModel = create_hedged_model(self._operator_llm, cache=llm_cache)
+        if not health_monitor.is_healthy(self._operator_llm._full_name):
+            # 直近で失敗が続いているときだけ、キャッシュを通さずに呼び出して確認する
+            await probe_model(self._operator_llm)
+        extraction_llm:BaseChatModel = create_hedged_model(x_extractor, cache=llm_cache)
         planner_llm:BaseChatModel|None = create_model(self._plan_llm, cache=llm_cache) if self._plan_llm is not None else None
 
         plan_text:str|None = None
-        if planner_llm is not None:
+        # 再開する場合は収集済みの結果から続けるのでプランは作り直さない
+        if planner_llm is not None and not self._resume.get('research'):
             pre_prompt = [
                 "現在時刻:{now_datetime}",
                 "ブラウザを使って以下のタスクを実行するために、目的、ブラウザで収集すべき情報、手順、ゴールを考えて、簡潔で短い文章で実行プランを出力して。",
@@ -142,34 +167,61 @@ class BwResearchTask:
             browser=self._browser,
             browser_context=self._browser_context,
             sensitive_data=self._sensitive_data,
+            available_file_paths=self._available_file_paths,
+            resume=self._resume.get('research'), checkpoint=self._save_checkpoint,
             writer=self._writer,
             save_dir=self._work_dir, inter=self._inter,
         )
 
         #---------------------------------
         if report_str:
-            post_llm = create_model(LLM.Gemini20Flash) # ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
+            post_llm = create_model(LLM.get_report_model(self._operator_llm), cache=llm_cache) # ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
             report_task = f"# 現在時刻: {now_datetime}\n\n# 与えられたタスク:\n{task}"
             if plan_text is not None:
                 report_task += f"\n\n# 実行プラン:\n{plan_text}"
             report_task += f"\n\n# 実行結果\n{report_str}\n\n# 上記の結果を日本語でレポートしてください。"
-            post_result:BaseMessage = await post_llm.ainvoke( report_task )
-            if isinstance(post_result.content,str):
-                report = post_result.content
-            else:
-                report = report_str
             self.logPrint("---------------------------------")
-            self.logPrint(report)
+            if self._writer is not None:
+                # レポートは生成しながらreportイベントで送る
+                report = await self._writer.stream_report( post_llm, report_task, title="レポート" )
+                if not report:
+                    self.logPrint(report_str)
+            else:
+                post_result:BaseMessage = await post_llm.ainvoke( report_task )
+                if isinstance(post_result.content,str):
+                    report = post_result.content
+                else:
+                    report = report_str
+                self.logPrint(report)
     
-    async def stop(self):
+    async def stop(self, suspend:bool=False):
+        """タスクを止める(suspend=Trueは再開のための中断でレポートを作らない)"""
         try:
             self._inter['stop'] = True
+            if suspend:
+                self._inter['suspend'] = True
             agent_list:list[Agent] = self._inter.get('agents',[])
             for agent in agent_list:
                 if agent:
                     if not agent.state.stopped:
                         agent.stop()
                     await safe_close(agent.browser_context)
-                    await safe_close(agent.browser)
+                    if self._own_browser:
+                        await safe_close(agent.browser)
         except:
-            pass
\ No newline at end of file
+            pass
+
+    async def _save_checkpoint(self, data:dict) -> None:
+        """進捗とブラウザのstorage stateを保存する"""
+        if self._checkpoint is None:
+            return
+        state = await self._browser_context.get_storage_state()
+        if state:
+            data['storage_state'] = state
+        await asyncio.to_thread(self._checkpoint, data)
+
+    async def close(self):
+        """コンテキストと自分で作ったブラウザを閉じる"""
+        await safe_close(self._browser_context)
+        if self._own_browser:
+            await safe_close(self._browser)
\ No newline at end of file
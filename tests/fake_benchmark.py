@@ -0,0 +1,119 @@
+import sys, os, asyncio
+os.environ["ANONYMIZED_TELEMETRY"] = "false"
+sys.path.append('.')
+import time
+import json
+import argparse
+from shutil import rmtree
+from pydantic import BaseModel, Field
+
+from browser_use import Browser, BrowserConfig
+from buweb.model.model import LLM, create_model
+from buweb.model.fake import FAKE_LLM_SCRIPT_ENV
+from buweb.model.usage import UsageScope, usage_scope, merge_usage
+from buweb.agent.buw_agent import BuwWriter
+from buweb.service.worker import build_task
+
+# LLM.Fakeでタスクを動かして、スループットと応答時間、トークン数を測る
+#
+#   python tests/fake_benchmark.py --mode operator --tasks 20 --concurrency 5
+#   python tests/fake_benchmark.py --mode research --script fake_script.json
+#   python tests/fake_benchmark.py --mode llm --tasks 200 --concurrency 50
+#
+# llmはブラウザを使わずにエージェントのステップと同じ形の呼び出しだけを繰り返す。
+# 応答時間の分布やステップ数は--scriptのJSONで変える(buweb/model/fake.pyのDEFAULT_SCRIPT)。
+
+class BenchState(BaseModel):
+    thought: str = Field(..., description="thought")
+    next_goal: str = Field(..., description="next goal")
+
+class BenchOutput(BaseModel):
+    current_state: BenchState
+    action: list[dict] = Field(..., json_schema_extra={'min_items': 1})
+
+async def run_llm(no:int, steps:int) -> None:
+    """エージェントのステップ相当の構造化出力とレポートのストリーミング"""
+    llm = create_model(LLM.Fake)
+    structured = llm.with_structured_output(BenchOutput)
+    messages:list = [ ("system", "You are a browser agent."), ("human", f"benchmark task {no}") ]
+    for step in range(steps):
+        out = await structured.ainvoke(messages)
+        messages.append( ("ai", json.dumps(out.model_dump() if isinstance(out,BaseModel) else out)) )
+        messages.append( ("human", f"step {step+1} done") )
+    async for _ in llm.astream(f"write a report of benchmark task {no}"):
+        pass
+
+async def run_task(mode:int, no:int, workdir:str, browser:Browser) -> None:
+    dir = os.path.join(workdir, f"task{no:04d}")
+    os.makedirs(dir, exist_ok=True)
+    task = build_task( mode, dir=dir, llm_cache=None, llm=LLM.Fake, plan_llm=None,
+                       cdp_port=0, browser=browser, sensitive_data=None,
+                       writer=BuwWriter(n_task=no, writer=lambda *args: None) )
+    try:
+        await task.start(f"benchmark task {no}")
+        await task.stop()
+    finally:
+        await task.close()
+
+def percentile(values:list[float], p:float) -> float:
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p))] if values else 0.0
+
+async def main():
+    parser = argparse.ArgumentParser(description="benchmark with the fake LLM provider")
+    parser.add_argument('--mode', choices=['llm','operator','research'], default='llm')
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=3, help="llmモードのステップ数")
+    parser.add_argument('--script', default=None, help="fake LLMの台本(JSON)")
+    parser.add_argument('--workdir', default="tmp/fake_benchmark")
+    args = parser.parse_args()
+    if args.script:
+        os.environ[FAKE_LLM_SCRIPT_ENV] = os.path.abspath(args.script)
+
+    workdir = os.path.abspath(args.workdir)
+    rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir, exist_ok=True)
+    browser:Browser|None = None
+    if args.mode!='llm':
+        browser = Browser(BrowserConfig(headless=True))
+
+    sem = asyncio.Semaphore(max(1,args.concurrency))
+    elapsed:list[float] = []
+    usages:list[dict] = []
+    errors:int = 0
+
+    async def one(no:int) -> None:
+        nonlocal errors
+        async with sem:
+            scope = UsageScope()
+            usage_scope.set(scope)
+            t0 = time.monotonic()
+            try:
+                if args.mode=='llm':
+                    await run_llm(no, args.steps)
+                else:
+                    await run_task(1 if args.mode=='research' else 0, no, workdir, browser) # type: ignore[arg-type]
+            except Exception as ex:
+                errors += 1
+                print(f"task {no} failed: {type(ex).__name__} {str(ex)}")
+            elapsed.append(time.monotonic()-t0)
+            usages.append(scope.to_dict())
+
+    t0 = time.monotonic()
+    try:
+        await asyncio.gather( *[ one(i+1) for i in range(args.tasks) ] )
+    finally:
+        if browser is not None:
+            await browser.close()
+    total = time.monotonic()-t0
+
+    usage = merge_usage(usages)
+    print("------------------------")
+    print(f"mode:{args.mode} tasks:{args.tasks} concurrency:{args.concurrency} errors:{errors}")
+    print(f"total:{total:.2f}sec throughput:{args.tasks/total*60:.1f}tasks/min")
+    print(f"task p50:{percentile(elapsed,0.5):.2f}sec p95:{percentile(elapsed,0.95):.2f}sec max:{max(elapsed,default=0.0):.2f}sec")
+    print(json.dumps(usage, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
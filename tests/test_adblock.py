@@ -0,0 +1,108 @@
+import sys, os, asyncio
+os.environ["ANONYMIZED_TELEMETRY"] = "false"
+sys.path.append('.')
+import time
+import tempfile
+
+import pytest
+
+from buweb.service.adblock import parse_hosts, compact, write_blocklist, read_blocklist, DomainBlocker, blocked_url_patterns
+
+# hostsからコンパイルしたリストでドメインとサブドメインを遮断できるか
+
+HOSTS = """
+# コメント
+127.0.0.1 localhost
+::1 ip6-localhost ip6-loopback
+0.0.0.0 0.0.0.0
+0.0.0.0 ads.example.com   # 行末のコメント
+0.0.0.0 x.ads.example.com
+0.0.0.0 Tracker.Example.NET.
+0.0.0.0 a.b.c.doubleclick.net
+0.0.0.0 doubleclick.net
+0.0.0.0 nodot
+0.0.0.0 one.example.org two.example.org
+adserver.example.jp
+"""
+
+def test_parse_hosts():
+    assert parse_hosts(HOSTS) == {
+        'ads.example.com', 'tracker.example.net', 'doubleclick.net',
+        'one.example.org', 'two.example.org', 'adserver.example.jp',
+    }
+
+def test_compact():
+    assert compact({'a.b.example.com', 'b.example.com', 'example.org', 'x.example.org', 'example.com.au'}) == {'b.example.com', 'example.org', 'example.com.au'}
+    # 親ドメインだけが別にある場合は残す
+    assert compact({'ads.example.com', 'example.net'}) == {'ads.example.com', 'example.net'}
+
+def test_blocklist_round_trip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,'adblock.bin')
+        domains = parse_hosts(HOSTS)
+        write_blocklist(path, domains)
+        assert read_blocklist(path) == frozenset(domains)
+        write_blocklist(path, set())
+        assert read_blocklist(path) == frozenset()
+        assert not os.path.exists(f"{path}.tmp")
+
+def test_read_blocklist_broken():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,'adblock.bin')
+        with open(path,'wb') as f:
+            f.write(b'0.0.0.0 ads.example.com\n')
+        with pytest.raises(ValueError):
+            read_blocklist(path)
+        write_blocklist(path, {'ads.example.com'})
+        with open(path,'rb') as f:
+            data = f.read()
+        with open(path,'wb') as f:
+            f.write(data[:-4])
+        with pytest.raises(Exception):
+            read_blocklist(path)
+
+def test_is_blocked_suffix():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,'adblock.bin')
+        write_blocklist(path, parse_hosts(HOSTS))
+        blocker = DomainBlocker(path)
+        assert len(blocker) == 6
+        assert blocker.is_blocked('ads.example.com')
+        assert blocker.is_blocked('x.y.ads.example.com')
+        assert blocker.is_blocked('ADS.Example.com.')
+        assert blocker.is_blocked('stats.doubleclick.net')
+        # 親ドメインや名前の一部が同じだけのホストは遮断しない
+        assert not blocker.is_blocked('example.com')
+        assert not blocker.is_blocked('www.example.com')
+        assert not blocker.is_blocked('notads.example.com')
+        assert not blocker.is_blocked('doubleclick.net.example.com')
+        assert not blocker.is_blocked('net')
+
+def test_blocker_reload():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,'adblock.bin')
+        write_blocklist(path, {'ads.example.com'})
+        blocker = DomainBlocker(path)
+        assert not blocker.is_blocked('tracker.example.net')
+        write_blocklist(path, {'tracker.example.net'})
+        os.utime(path, (time.time()+10, time.time()+10))
+        # CHECK_SECが過ぎるまでは読み直さない
+        assert not blocker.check()
+        blocker._checked = 0.0
+        assert blocker.is_blocked('tracker.example.net')
+        assert not blocker.is_blocked('ads.example.com')
+
+def test_blocked_url_patterns():
+    assert blocked_url_patterns({'b.example.net', 'a.example.com'}) == [
+        '*://a.example.com/*', '*.a.example.com/*',
+        '*://b.example.net/*', '*.b.example.net/*',
+    ]
+
+if __name__ == "__main__":
+    test_parse_hosts()
+    test_compact()
+    test_blocklist_round_trip()
+    test_read_blocklist_broken()
+    test_is_blocked_suffix()
+    test_blocker_reload()
+    test_blocked_url_patterns()
@@ -0,0 +1,88 @@
+import sys, os, asyncio
+os.environ["ANONYMIZED_TELEMETRY"] = "false"
+sys.path.append('.')
+import tempfile
+from datetime import datetime
+
+import pytest
+
+from buweb.model.model import LLM, CustomRateLimiter, RateLimitExceeded, parse_rate_limits
+
+# スライディングウィンドウと日付の切り替えで上限どおりに制限できるか
+
+def ts(text:str) -> float:
+    return datetime.strptime(text, "%Y-%m-%d %H:%M:%S").timestamp()
+
+def check_window(try_acquire):
+    t0 = ts("2025-03-01 12:00:00")
+    assert try_acquire(t0, "2025-03-01") == 0.0
+    assert try_acquire(t0+10, "2025-03-01") == 0.0
+    # 1分に2回まで。最初の記録が窓から外れるまで待たされる
+    assert try_acquire(t0+20, "2025-03-01") == pytest.approx(40.0)
+    assert try_acquire(t0+60, "2025-03-01") == 0.0
+    assert try_acquire(t0+65, "2025-03-01") == pytest.approx(5.0)
+    assert try_acquire(t0+70, "2025-03-01") == 0.0
+
+def check_daily(try_acquire):
+    t0 = ts("2025-03-01 23:50:00")
+    assert try_acquire(t0, "2025-03-01") == 0.0
+    assert try_acquire(t0+120, "2025-03-01") == 0.0
+    assert try_acquire(t0+240, "2025-03-01") == 0.0
+    # 1日に3回まで。翌日の0時まで待たされる
+    assert try_acquire(t0+360, "2025-03-01") == pytest.approx(ts("2025-03-02 00:00:00")-(t0+360))
+    # 日付が変われば数え直す
+    assert try_acquire(t0+720, "2025-03-02") == 0.0
+
+def test_window_mem():
+    limiter = CustomRateLimiter(2, 100, None)
+    check_window(limiter._try_acquire_mem)
+
+def test_daily_mem():
+    limiter = CustomRateLimiter(10, 3, None)
+    check_daily(limiter._try_acquire_mem)
+
+def test_window_db():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        limiter = CustomRateLimiter(2, 100, os.path.join(tmpdir,'ratelimit.db'))
+        check_window(limiter._try_acquire_db)
+
+def test_daily_db():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        limiter = CustomRateLimiter(10, 3, os.path.join(tmpdir,'ratelimit.db'))
+        check_daily(limiter._try_acquire_db)
+
+def test_db_shared_by_name():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir,'ratelimit.db')
+        # 別のプロセスの代わりに同じファイルを使う別のインスタンス
+        a = CustomRateLimiter(2, 100, path, name='m1')
+        b = CustomRateLimiter(2, 100, path, name='m1')
+        other = CustomRateLimiter(2, 100, path, name='m2')
+        t0 = ts("2025-03-01 12:00:00")
+        assert a._try_acquire_db(t0, "2025-03-01") == 0.0
+        assert b._try_acquire_db(t0+1, "2025-03-01") == 0.0
+        assert a._try_acquire_db(t0+2, "2025-03-01") == pytest.approx(58.0)
+        assert other._try_acquire_db(t0+2, "2025-03-01") == 0.0
+
+def test_sync_acquire_on_loop_does_not_sleep():
+    limiter = CustomRateLimiter(1, 100, None)
+    async def main():
+        assert limiter.acquire()
+        with pytest.raises(RateLimitExceeded):
+            limiter.acquire()
+        assert not await limiter.aacquire(blocking=False)
+    asyncio.run(main())
+
+def test_parse_rate_limits():
+    limits = parse_rate_limits(f" {LLM.Gpt4oMini.name}=30/1000 , {LLM.Gemini20Flash.name}= ,unknown=1/1")
+    assert limits[LLM.Gpt4oMini] == (30, 1000)
+    assert LLM.Gemini20Flash not in limits
+
+if __name__ == "__main__":
+    test_window_mem()
+    test_daily_mem()
+    test_window_db()
+    test_daily_db()
+    test_db_shared_by_name()
+    test_sync_acquire_on_loop_does_not_sleep()
+    test_parse_rate_limits()
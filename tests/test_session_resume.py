@@ -0,0 +1,50 @@
+import sys, os, asyncio
+os.environ["ANONYMIZED_TELEMETRY"] = "false"
+sys.path.append('.')
+import json
+import tempfile
+
+from buweb.service.checkpoint import scan_checkpoints
+from buweb.service.session import SessionStore
+
+# 中断されたセッションをチェックポイントから復元できるか
+
+def write_checkpoint(sessions_dir:str, session_id:str, data:dict|str) -> str:
+    workdir = os.path.join(sessions_dir, f"session_{session_id}")
+    os.makedirs(os.path.join(workdir,'uploads'), exist_ok=True)
+    with open(os.path.join(workdir,'checkpoint.json'),'w') as f:
+        f.write( data if isinstance(data,str) else json.dumps(data) )
+    return workdir
+
+async def resume(sessions_dir:str, session_id:str):
+    store = SessionStore(pool_size=0, dir=sessions_dir)
+    store._dormant = scan_checkpoints(store.SessionsDir, store.session_timeout.total_seconds())
+    session = await store._restore_session(session_id, "127.0.0.1", None)
+    return store, session
+
+def test_resume_suspended_session():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = write_checkpoint(tmpdir, 'abc12345', {'n_tasks': 2, 'running': True, 'prompt': 'test', 'uploads': {'a.txt': 3, 'gone.txt': 5}})
+        with open(os.path.join(workdir,'uploads','a.txt'),'w') as f:
+            f.write('abc')
+        store, session = asyncio.run(resume(tmpdir, 'abc12345'))
+        assert session is not None
+        assert session.session_id == 'abc12345'
+        assert session.WorkDir == workdir
+        assert session._n_tasks == 2
+        assert session.uploads == {'a.txt': 3}
+        assert session.checkpoint.resumable
+        assert not store.is_dormant('abc12345')
+
+def test_resume_broken_checkpoint_stays_dormant():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = write_checkpoint(tmpdir, 'xyz98765', '{broken')
+        store, session = asyncio.run(resume(tmpdir, 'xyz98765'))
+        assert session is None
+        # 期限切れで削除されるように追跡を続ける
+        assert store.is_dormant('xyz98765')
+        assert store._dormant['xyz98765'] == workdir
+
+if __name__ == "__main__":
+    test_resume_suspended_session()
+    test_resume_broken_checkpoint_stays_dormant()
@@ -0,0 +1,89 @@
+import sys, os, asyncio
+os.environ["ANONYMIZED_TELEMETRY"] = "false"
+sys.path.append('.')
+import json
+import tempfile
+
+from buweb.service.session import SessionStore
+from buweb.service.upload import QuotaExceededException
+
+# 1つのリクエストで複数のファイルを受け取ったときに容量を正しく数えるか
+
+BOUNDARY = 'testboundary'
+
+def multipart(files:list[tuple[str,bytes]], field:str='file') -> bytes:
+    body = b''
+    for name,data in files:
+        body += f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{name}\"\r\nContent-Type: application/octet-stream\r\n\r\n".encode()
+        body += data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+async def chunks(body:bytes, size:int=7):
+    for i in range(0,len(body),size):
+        yield body[i:i+size]
+
+async def upload(tmpdir:str, quota:int, files:list[tuple[str,bytes]], uploads:dict[str,int]|None=None):
+    store = SessionStore(pool_size=0, dir=tmpdir)
+    session = store._new_session("127.0.0.1", None)
+    session.upload_quota = quota
+    for name,size in (uploads or {}).items():
+        os.makedirs(session.upload_dir(), exist_ok=True)
+        with open(os.path.join(session.upload_dir(),name),'wb') as f:
+            f.write(b'x'*size)
+        session.uploads[name] = size
+    try:
+        names = await session.store_upload(chunks(multipart(files)), BOUNDARY)
+        return session, names, None
+    except QuotaExceededException as ex:
+        return session, None, ex
+
+def uploaded_files(session) -> list[str]:
+    return sorted(os.listdir(session.upload_dir()))
+
+def test_upload_multiple_parts():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        session, names, ex = asyncio.run(upload(tmpdir, 100, [('a.txt',b'a'*30), ('b.txt',b'b'*40)]))
+        assert ex is None
+        assert names == ['a.txt','b.txt']
+        assert session.uploads == {'a.txt': 30, 'b.txt': 40}
+        assert uploaded_files(session) == ['a.txt','b.txt']
+        with open(os.path.join(session.WorkDir,'checkpoint.json')) as f:
+            assert json.load(f)['uploads'] == {'a.txt': 30, 'b.txt': 40}
+
+def test_quota_counts_earlier_parts():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 1つずつなら収まるが、前のパートと合わせると超える
+        session, names, ex = asyncio.run(upload(tmpdir, 100, [('a.txt',b'a'*60), ('b.txt',b'b'*60)]))
+        assert ex is not None
+        # 書き終えたパートは残して数え、書きかけのファイルは消す
+        assert session.uploads == {'a.txt': 60}
+        assert uploaded_files(session) == ['a.txt']
+        with open(os.path.join(session.WorkDir,'checkpoint.json')) as f:
+            assert json.load(f)['uploads'] == {'a.txt': 60}
+
+def test_quota_counts_stored_uploads():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        session, names, ex = asyncio.run(upload(tmpdir, 100, [('b.txt',b'b'*30)], uploads={'a.txt': 80}))
+        assert ex is not None
+        assert session.uploads == {'a.txt': 80}
+        assert uploaded_files(session) == ['a.txt']
+
+def test_quota_replaces_same_name():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 同じ名前で上書きするなら前のサイズは数えない
+        session, names, ex = asyncio.run(upload(tmpdir, 100, [('a.txt',b'a'*90)], uploads={'a.txt': 80}))
+        assert ex is None
+        assert session.uploads == {'a.txt': 90}
+
+def test_quota_full():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        session, names, ex = asyncio.run(upload(tmpdir, 100, [('b.txt',b'b')], uploads={'a.txt': 100}))
+        assert ex is not None
+        assert uploaded_files(session) == ['a.txt']
+
+if __name__ == "__main__":
+    test_upload_multiple_parts()
+    test_quota_counts_earlier_parts()
+    test_quota_counts_stored_uploads()
+    test_quota_replaces_same_name()
+    test_quota_full()